@@ -0,0 +1,110 @@
+import argparse
+import sys
+import tempfile
+import time
+from dataclasses import replace
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+import tifffile as tif
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent / "bin"))
+
+from collect_output import modify_and_save_img  # noqa: E402
+from utils_tiff import TiffEncoding  # noqa: E402
+
+segmentation_channels = {"nucleus": "DAPI", "cell": "CD45"}
+
+encodings = [
+    TiffEncoding(),
+    TiffEncoding(compression="zlib"),
+    TiffEncoding(compression="zlib", predictor=True),
+    TiffEncoding(compression="zlib", predictor=True, tile_size=512),
+    TiffEncoding(compression="zstd", predictor=True, tile_size=512),
+    TiffEncoding(compression="lzw", predictor=True, tile_size=512),
+]
+
+
+def make_test_image(path: Path, num_channels: int, size: int):
+    """Image with smooth background, blobs and noise, roughly like fluorescence"""
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[0:size, 0:size]
+    channels = []
+    for c in range(num_channels):
+        img = 200 + 100 * np.sin(xx / (50 + c)) * np.cos(yy / (70 + c))
+        centers = rng.integers(0, size, (size // 8, 2))
+        img[centers[:, 0], centers[:, 1]] += 3000
+        img += rng.normal(0, 20, img.shape)
+        channels.append(np.clip(img, 0, 65535).astype(np.uint16))
+    ch_names = ["DAPI", "CD45"] + [f"Marker{c}" for c in range(2, num_channels)]
+    tif.imwrite(
+        path,
+        np.stack(channels),
+        photometric="minisblack",
+        metadata={
+            "axes": "CYX",
+            "Channel": {"Name": ch_names},
+            "PhysicalSizeX": 0.325,
+            "PhysicalSizeXUnit": "µm",
+            "PhysicalSizeY": 0.325,
+            "PhysicalSizeYUnit": "µm",
+        },
+    )
+
+
+def describe(encoding: TiffEncoding) -> str:
+    tile = f"tile{encoding.tile_size}" if encoding.tile_size else "strips"
+    predictor = "+pred" if encoding.predictor else ""
+    return f"{encoding.compression}{predictor} {tile}"
+
+
+def check_ifd_mapping(path: Path):
+    """Every plane must be stored in its own IFD referenced by TiffData"""
+    with tif.TiffFile(path) as TF:
+        num_pages = len(TF.pages)
+        num_tiffdata = TF.ome_metadata.count("<TiffData")
+    if num_pages != num_tiffdata:
+        raise ValueError(f"{num_pages} pages, but {num_tiffdata} TiffData entries")
+
+
+def main(img_path: Optional[Path], num_channels: int, size: int, threads: List[int]):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        if img_path is None:
+            img_path = tmp_dir / "benchmark.ome.tif"
+            make_test_image(img_path, num_channels, size)
+        in_size = img_path.stat().st_size
+        print("source:", img_path, "| bytes:", in_size)
+        print(f"{'encoding':<24}{'threads':>8}{'bytes':>14}{'ratio':>8}{'sec':>8}")
+        for base_encoding in encodings:
+            for num_threads in threads:
+                encoding = replace(base_encoding, encoder_threads=num_threads)
+                out_path = tmp_dir / "out.ome.tiff"
+                start = time.perf_counter()
+                modify_and_save_img(
+                    img_path, out_path, segmentation_channels, encoding=encoding
+                )
+                elapsed = time.perf_counter() - start
+                check_ifd_mapping(out_path)
+                out_size = out_path.stat().st_size
+                print(
+                    f"{describe(encoding):<24}{num_threads:>8}{out_size:>14}"
+                    f"{in_size / out_size:>8.2f}{elapsed:>8.2f}"
+                )
+                out_path.unlink()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Bytes written vs time spent for output encoding options"
+    )
+    parser.add_argument(
+        "--img_path", type=Path, default=None, help="OME-TIFF to use as a source"
+    )
+    parser.add_argument("--num_channels", type=int, default=8)
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4])
+    args = parser.parse_args()
+
+    main(args.img_path, args.num_channels, args.size, args.threads)
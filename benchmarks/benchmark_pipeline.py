@@ -0,0 +1,246 @@
+import argparse
+import json
+import multiprocessing as mp
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent / "bin"))
+
+import collect_dataset_info  # noqa: E402
+import collect_output  # noqa: E402
+import prepare_segmentation_channels  # noqa: E402
+from execution import ExecutionOptions, schedulers  # noqa: E402
+from run_manifest import ResumeOptions  # noqa: E402
+from synthetic_dataset import (  # noqa: E402
+    DatasetOptions,
+    SyntheticDataset,
+    add_dataset_args,
+    generate_dataset,
+)
+from utils import get_peak_rss, perf_report  # noqa: E402
+
+# metrics where a larger value is a regression
+lower_is_better = ("wall_time_s", "peak_rss_mb")
+# metrics where a smaller value is a regression
+higher_is_better = ("mb_per_s", "slices_per_s")
+# reference results of the default dataset, committed with the benchmark
+default_baseline_path = Path(__file__).absolute().parent / "baseline.json"
+# steps that should find all source headers in the cache filled by collect_dataset_info
+cached_header_steps = ("prepare_segmentation_channels",)
+
+
+def run_step(
+    step: str,
+    dataset: SyntheticDataset,
+    work_dir: Path,
+    execution: ExecutionOptions,
+) -> Dict[str, float]:
+    """Runs main of one step, called in a fresh process to measure its peak RSS"""
+    cache_path = work_dir / "metadata_cache.sqlite"
+    pipeline_config_path = work_dir / "pipeline_config.yaml"
+    resume = ResumeOptions(force=True)
+    start = time.perf_counter()
+    if step == "collect_dataset_info":
+        collect_dataset_info.main(
+            dataset.data_dir,
+            dataset.meta_path,
+            execution.num_workers,
+            cache_path,
+            out_dir=work_dir,
+        )
+    elif step == "prepare_segmentation_channels":
+        prepare_segmentation_channels.main(
+            dataset.data_dir,
+            pipeline_config_path,
+            execution,
+            resume=resume,
+            metadata_cache_path=cache_path,
+            out_dir=work_dir / step,
+        )
+    elif step == "collect_output":
+        collect_output.main(
+            dataset.data_dir,
+            dataset.mask_dir,
+            pipeline_config_path,
+            execution,
+            mask_scheduler="threads",
+            resume=resume,
+            metadata_cache_path=cache_path,
+            out_dir=work_dir / step,
+        )
+    else:
+        raise ValueError(f"Unknown step {step}")
+    wall_time = time.perf_counter() - start
+    peak_rss = max(get_peak_rss(), get_peak_rss(resource.RUSAGE_CHILDREN))
+    header_reads = sum(
+        task["task"].startswith("read header ") for task in perf_report.tasks
+    )
+    return dict(
+        wall_time_s=wall_time,
+        peak_rss_mb=peak_rss / 1024**2,
+        header_reads=header_reads,
+    )
+
+
+steps = ["collect_dataset_info", "prepare_segmentation_channels", "collect_output"]
+
+
+def measure_steps(
+    dataset: SyntheticDataset, work_dir: Path, execution: ExecutionOptions
+) -> Dict[str, Dict[str, float]]:
+    results = dict()
+    total_mb = dataset.total_bytes / 1024**2
+    for step in steps:
+        # spawn, so peak RSS of one step does not include the previous ones
+        with ProcessPoolExecutor(1, mp_context=mp.get_context("spawn")) as executor:
+            metrics = executor.submit(
+                run_step, step, dataset, work_dir, execution
+            ).result()
+        metrics["mb_per_s"] = total_mb / metrics["wall_time_s"]
+        metrics["slices_per_s"] = dataset.num_slices / metrics["wall_time_s"]
+        results[step] = {key: round(value, 3) for key, value in metrics.items()}
+    return results
+
+
+def find_regressions(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    tolerance: float,
+) -> list:
+    regressions = []
+    for step, metrics in results.items():
+        for key, value in metrics.items():
+            base_value = baseline.get(step, {}).get(key)
+            if not base_value or key not in lower_is_better + higher_is_better:
+                continue
+            change = (value - base_value) / base_value
+            if key in higher_is_better:
+                change = -change
+            if change > tolerance:
+                regressions.append(f"{step} {key}: {base_value} -> {value}")
+    return regressions
+
+
+def find_cache_misses(results: Dict[str, Dict[str, float]]) -> list:
+    return [
+        f"{step} read {results[step]['header_reads']:.0f} headers "
+        "missing from the metadata cache"
+        for step in cached_header_steps
+        if results[step]["header_reads"]
+    ]
+
+
+def format_metrics(name: str, metrics: Dict[str, float]) -> str:
+    return (
+        f"{name:<32}{metrics['wall_time_s']:>8.2f}{metrics['mb_per_s']:>10.1f}"
+        f"{metrics['slices_per_s']:>10.2f}{metrics['peak_rss_mb']:>10.0f}"
+    )
+
+
+def print_results(
+    results: Dict[str, Dict[str, float]],
+    baseline: Optional[Dict[str, Dict[str, float]]],
+):
+    print(f"\n{'step':<32}{'sec':>8}{'MB/s':>10}{'slices/s':>10}{'peak MB':>10}")
+    for step, metrics in results.items():
+        print(format_metrics(step, metrics))
+        if baseline is not None and step in baseline:
+            print(format_metrics("  baseline", baseline[step]))
+
+
+def main(
+    dataset_options: DatasetOptions,
+    execution: ExecutionOptions,
+    baseline_path: Optional[Path],
+    save_baseline: Optional[Path],
+    tolerance: float,
+) -> int:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        dataset = generate_dataset(tmp_dir / "source", dataset_options)
+        print(
+            "dataset:",
+            dataset.num_slices,
+            "slices |",
+            dataset.total_bytes,
+            "bytes |",
+            dataset_options,
+        )
+        results = measure_steps(dataset, tmp_dir / "work", execution)
+
+    baseline = None
+    if baseline_path is not None:
+        with open(baseline_path, "r") as s:
+            saved = json.load(s)
+        if saved["dataset"] == vars(dataset_options):
+            baseline = saved["results"]
+        else:
+            print("Baseline", baseline_path, "is of a different dataset, not compared")
+    print_results(results, baseline)
+
+    cache_misses = find_cache_misses(results)
+    for cache_miss in cache_misses:
+        print("Cache miss:", cache_miss)
+    if cache_misses:
+        return 1
+
+    if save_baseline is not None:
+        with open(save_baseline, "w") as s:
+            json.dump(dict(dataset=vars(dataset_options), results=results), s, indent=1)
+        print("Baseline saved to", save_baseline)
+
+    if baseline is not None:
+        regressions = find_regressions(results, baseline, tolerance)
+        for regression in regressions:
+            print("Regression:", regression)
+        if regressions:
+            return 1
+        print("No regressions above", tolerance * 100, "%")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Throughput and peak memory of every pipeline step "
+        "on a synthetic dataset"
+    )
+    add_dataset_args(parser)
+    parser.add_argument(
+        "--scheduler", type=str, choices=schedulers, default="processes"
+    )
+    parser.add_argument("--num_workers", type=int, default=None)
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        default=default_baseline_path,
+        help="JSON saved with --save_baseline to compare results against, "
+        "by default the committed baseline of the default dataset",
+    )
+    parser.add_argument(
+        "--save_baseline",
+        type=Path,
+        default=None,
+        help="save results to this JSON to use as a baseline later",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="relative change of a metric that counts as a regression",
+    )
+    args = parser.parse_args()
+
+    sys.exit(
+        main(
+            DatasetOptions.from_args(args),
+            ExecutionOptions(scheduler=args.scheduler, num_workers=args.num_workers),
+            args.baseline,
+            args.save_baseline,
+            args.tolerance,
+        )
+    )
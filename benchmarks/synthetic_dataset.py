@@ -0,0 +1,231 @@
+import argparse
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import tifffile as tif
+import yaml
+
+layouts = {"hubmap": "HuBMAP_OME", "lab_processed": "lab_processed/images"}
+units = {"um": "µm", "um_escaped": "&#181;m", "um_ascii": "um", "nm": "nm"}
+segmentation_channels = {"nucleus": "DAPI", "cell": "CD45"}
+ome_namespace = "http://www.openmicroscopy.org/Schemas/OME/2016-06"
+
+
+@dataclass
+class DatasetOptions:
+    """Shape of the synthetic dataset and variants of its OME-XML"""
+
+    num_regions: int = 2
+    num_slices: int = 2
+    num_channels: int = 8
+    size: int = 1024
+    dtype: str = "uint16"
+    compression: str = "none"
+    layout: str = "hubmap"
+    unit: str = "um"
+    namespaced: bool = True
+    structured_annotations: bool = True
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "DatasetOptions":
+        return cls(
+            num_regions=args.num_regions,
+            num_slices=args.num_slices,
+            num_channels=args.num_channels,
+            size=args.size,
+            dtype=args.dtype,
+            compression=args.compression,
+            layout=args.layout,
+            unit=args.unit,
+            namespaced=not args.no_namespace,
+            structured_annotations=not args.no_structured_annotations,
+        )
+
+
+@dataclass
+class SyntheticDataset:
+    data_dir: Path
+    mask_dir: Path
+    meta_path: Path
+    img_paths: List[Path]
+
+    @property
+    def num_slices(self) -> int:
+        return len(self.img_paths)
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(path.stat().st_size for path in self.img_paths)
+
+
+def get_channel_names(num_channels: int) -> List[str]:
+    names = ["DAPI", "CD45"] + [f"Marker{c}" for c in range(2, num_channels)]
+    return names[:num_channels]
+
+
+def make_channels(num_channels: int, size: int, dtype: str, seed: int = 0):
+    """Smooth background, bright blobs and noise, roughly like fluorescence"""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float32)
+    max_val = np.iinfo(dtype).max if np.issubdtype(dtype, np.integer) else 1.0
+    channels = []
+    for c in range(num_channels):
+        img = 0.05 + 0.03 * np.sin(xx / (50 + c)) * np.cos(yy / (70 + c))
+        centers = rng.integers(0, size, (size // 8, 2))
+        img[centers[:, 0], centers[:, 1]] += 0.8
+        img += rng.normal(0, 0.005, img.shape).astype(np.float32)
+        channels.append((np.clip(img, 0, 1) * max_val).astype(dtype))
+    return np.stack(channels)
+
+
+def make_ome_xml(
+    ch_names: List[str], size: int, dtype: str, options: DatasetOptions
+) -> str:
+    channels = "".join(
+        f'<Channel ID="Channel:0:{i}" Name="{name}" SamplesPerPixel="1"/>'
+        for i, name in enumerate(ch_names)
+    )
+    tiffdata = "".join(
+        f'<TiffData FirstC="{i}" FirstT="0" FirstZ="0" IFD="{i}" PlaneCount="1"/>'
+        for i in range(len(ch_names))
+    )
+    unit = units[options.unit]
+    physical_size = "325" if options.unit == "nm" else "0.325"
+    annotations = ""
+    if options.structured_annotations:
+        annotations = (
+            "<StructuredAnnotations>"
+            '<XMLAnnotation ID="Annotation:0"><Value><OriginalMetadata>'
+            "<Key>Instrument</Key><Value>CellDIVE</Value>"
+            "</OriginalMetadata></Value></XMLAnnotation>"
+            "</StructuredAnnotations>"
+        )
+    namespace = f' xmlns="{ome_namespace}"' if options.namespaced else ""
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f"<OME{namespace}>"
+        '<Image ID="Image:0" Name="Image0">'
+        f'<Pixels ID="Pixels:0" DimensionOrder="XYZCT" Type="{dtype}" '
+        f'SizeX="{size}" SizeY="{size}" SizeC="{len(ch_names)}" SizeZ="1" SizeT="1" '
+        f'PhysicalSizeX="{physical_size}" PhysicalSizeXUnit="{unit}" '
+        f'PhysicalSizeY="{physical_size}" PhysicalSizeYUnit="{unit}">'
+        f"{channels}{tiffdata}</Pixels></Image>{annotations}</OME>"
+    )
+
+
+def make_mask(path: Path, size: int, cell_size: int = 32):
+    """Cell and nucleus label images of a regular grid of square cells"""
+    yy, xx = np.mgrid[0:size, 0:size]
+    num_cols = (size + cell_size - 1) // cell_size
+    cells = ((yy // cell_size) * num_cols + xx // cell_size + 1).astype(np.uint32)
+    border = cell_size // 4
+    inside = ((yy % cell_size) >= border) & ((xx % cell_size) >= border)
+    nuclei = np.where(inside, cells, 0).astype(np.uint32)
+    cell_boundaries = np.where(inside, 0, cells).astype(np.uint32)
+    tif.imwrite(
+        path,
+        np.stack([cells, nuclei, cell_boundaries, nuclei]),
+        ome=True,
+        photometric="minisblack",
+        metadata={
+            "axes": "CYX",
+            "Channel": {
+                "Name": ["cells", "nuclei", "cell_boundaries", "nucleus_boundaries"]
+            },
+        },
+    )
+
+
+def generate_dataset(out_dir: Path, options: DatasetOptions) -> SyntheticDataset:
+    """
+    Writes a dataset in one of the layouts expected by collect_dataset_info,
+    segmentation masks as they come from the segmentation step,
+    and the metadata YAML with segmentation channels
+    """
+    data_dir = out_dir / "dataset"
+    img_dir = data_dir / layouts[options.layout]
+    mask_dir = out_dir / "masks"
+    ch_names = get_channel_names(options.num_channels)
+    ome_xml = make_ome_xml(ch_names, options.size, options.dtype, options)
+    compression = None if options.compression == "none" else options.compression
+    img_paths = []
+    for region in range(1, options.num_regions + 1):
+        region_dir = img_dir / f"region_{region:03d}"
+        region_mask_dir = mask_dir / f"region_{region:03d}"
+        region_dir.mkdir(parents=True, exist_ok=True)
+        region_mask_dir.mkdir(parents=True, exist_ok=True)
+        for slice_id in range(1, options.num_slices + 1):
+            slice_name = f"S{slice_id}_region_{region:03d}"
+            img_path = region_dir / f"{slice_name}.ome.tif"
+            tif.imwrite(
+                img_path,
+                make_channels(
+                    options.num_channels, options.size, options.dtype, seed=slice_id
+                ),
+                description=ome_xml.encode("utf-8"),
+                photometric="minisblack",
+                compression=compression,
+                metadata=None,
+            )
+            img_paths.append(img_path)
+            mask_name = f"reg{region:03d}_{slice_name}_mask.ome.tiff"
+            make_mask(region_mask_dir / mask_name, options.size)
+
+    meta_path = out_dir / "meta.yaml"
+    with open(meta_path, "w") as s:
+        yaml.safe_dump({"segmentation_channels": segmentation_channels}, s)
+    return SyntheticDataset(data_dir, mask_dir, meta_path, img_paths)
+
+
+def add_dataset_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--num_regions", type=int, default=2)
+    parser.add_argument("--num_slices", type=int, default=2, help="slices per region")
+    parser.add_argument("--num_channels", type=int, default=8)
+    parser.add_argument("--size", type=int, default=1024, help="size of square images")
+    parser.add_argument(
+        "--dtype", type=str, choices=["uint8", "uint16", "float32"], default="uint16"
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        choices=["none", "zlib", "zstd", "lzw"],
+        default="none",
+        help="codec of the source images",
+    )
+    parser.add_argument("--layout", type=str, choices=list(layouts), default="hubmap")
+    parser.add_argument(
+        "--unit",
+        type=str,
+        choices=list(units),
+        default="um",
+        help="unit of physical pixel sizes, um_escaped writes &#181;m into the XML",
+    )
+    parser.add_argument(
+        "--no_namespace", action="store_true", help="write OME-XML without xmlns"
+    )
+    parser.add_argument(
+        "--no_structured_annotations",
+        action="store_true",
+        help="write OME-XML without StructuredAnnotations block",
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generates a synthetic CellDIVE dataset with segmentation masks"
+    )
+    parser.add_argument("--out_dir", type=Path, help="directory to write dataset to")
+    add_dataset_args(parser)
+    args = parser.parse_args()
+
+    dataset = generate_dataset(args.out_dir, DatasetOptions.from_args(args))
+    print(
+        "Generated",
+        dataset.num_slices,
+        "slices,",
+        dataset.total_bytes,
+        "bytes in",
+        dataset.data_dir,
+    )
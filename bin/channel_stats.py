@@ -0,0 +1,202 @@
+import json
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from run_manifest import atomic_output
+
+Image = np.ndarray
+
+channel_stats_modes = ("none", "sidecar", "ome")
+default_num_bins = 1024
+percentiles = (1, 5, 50, 95, 99)
+# floating point images are expected to be normalized
+float_range = (0.0, 1.0)
+# planes are converted to float64 in chunks of this many pixels
+chunk_size = 1 << 20
+
+
+@dataclass
+class ChannelStats:
+    """
+    Mergeable accumulator of intensity statistics of one channel.
+    The histogram has fixed bins over the whole range of the dtype,
+    so accumulators of planes, images and regions of the same dtype
+    can be added together. Percentiles are interpolated within a bin.
+    """
+
+    lo: float
+    hi: float
+    histogram: np.ndarray
+    count: int = 0
+    min: Optional[float] = None
+    max: Optional[float] = None
+    sum: float = 0.0
+    sum_sq: float = 0.0
+
+    @classmethod
+    def for_dtype(
+        cls, dtype: np.dtype, num_bins: int = default_num_bins
+    ) -> "ChannelStats":
+        dtype = np.dtype(dtype)
+        if np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            lo, hi = int(info.min), int(info.max) + 1
+            num_bins = min(num_bins, hi - lo)
+        else:
+            lo, hi = float_range
+        return cls(lo, hi, np.zeros(num_bins, dtype=np.int64))
+
+    @property
+    def bin_width(self) -> float:
+        return (self.hi - self.lo) / len(self.histogram)
+
+    def get_bin_indexes(self, values: Image) -> Image:
+        num_bins = len(self.histogram)
+        width = (self.hi - self.lo) // num_bins
+        is_shiftable = (
+            np.issubdtype(values.dtype, np.unsignedinteger)
+            and values.dtype.itemsize < 8
+            and self.lo == 0
+            and width * num_bins == self.hi
+            and width & (width - 1) == 0
+        )
+        if is_shiftable:
+            return values >> (int(width).bit_length() - 1)
+        indexes = (values.astype(np.float64) - self.lo) / self.bin_width
+        return np.clip(indexes, 0, num_bins - 1).astype(np.intp)
+
+    def update(self, plane: Image):
+        values = np.asarray(plane).reshape(-1)
+        if values.size == 0:
+            return
+        self.count += values.size
+        plane_min, plane_max = values.min().item(), values.max().item()
+        self.min = plane_min if self.min is None else min(self.min, plane_min)
+        self.max = plane_max if self.max is None else max(self.max, plane_max)
+        for start in range(0, values.size, chunk_size):
+            chunk = values[start : start + chunk_size]
+            chunk_f = chunk.astype(np.float64)
+            self.sum += chunk_f.sum()
+            self.sum_sq += np.dot(chunk_f, chunk_f)
+            self.histogram += np.bincount(
+                self.get_bin_indexes(chunk), minlength=len(self.histogram)
+            )
+
+    def merge(self, other: "ChannelStats"):
+        if (self.lo, self.hi, len(self.histogram)) != (
+            other.lo,
+            other.hi,
+            len(other.histogram),
+        ):
+            raise ValueError("Cannot merge statistics with different histogram bins")
+        if other.count == 0:
+            return
+        self.count += other.count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        self.histogram += other.histogram
+
+    def get_percentile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        cumulative = np.cumsum(self.histogram)
+        rank = q / 100 * self.count
+        i = min(int(np.searchsorted(cumulative, rank)), len(cumulative) - 1)
+        below = cumulative[i - 1] if i > 0 else 0
+        fraction = (rank - below) / self.histogram[i] if self.histogram[i] else 0.0
+        value = self.lo + (i + fraction) * self.bin_width
+        return float(np.clip(value, self.min, self.max))
+
+    def to_dict(self) -> Dict[str, Any]:
+        mean = std = None
+        if self.count > 0:
+            mean = self.sum / self.count
+            std = max(0.0, self.sum_sq / self.count - mean**2) ** 0.5
+        return dict(
+            count=self.count,
+            min=self.min,
+            max=self.max,
+            mean=mean,
+            std=std,
+            percentiles={f"p{q}": self.get_percentile(q) for q in percentiles},
+            sum=self.sum,
+            sum_sq=self.sum_sq,
+            histogram=dict(lo=self.lo, hi=self.hi, counts=self.histogram.tolist()),
+        )
+
+    @classmethod
+    def from_dict(cls, stats: Dict[str, Any]) -> "ChannelStats":
+        histogram = stats["histogram"]
+        return cls(
+            lo=histogram["lo"],
+            hi=histogram["hi"],
+            histogram=np.array(histogram["counts"], dtype=np.int64),
+            count=stats["count"],
+            min=stats["min"],
+            max=stats["max"],
+            sum=stats["sum"],
+            sum_sq=stats["sum_sq"],
+        )
+
+
+@dataclass
+class ImageStats:
+    """
+    Statistics of every channel of an image, updated by a PlaneCallback.
+    Planes are matched to channels by their position in the channel list,
+    OME channel IDs do not have to be 0..C-1.
+    """
+
+    channels: List[Tuple[str, int]]
+    dtype: str
+    stats: Dict[str, ChannelStats] = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.names = [ch_name for ch_name, _ in self.channels]
+        for ch_name in self.names:
+            self.stats[ch_name] = ChannelStats.for_dtype(self.dtype)
+
+    def update(self, c: int, z: int, plane: Image):
+        # planes of channels missing from the OME-XML are not described
+        if c < len(self.names):
+            self.stats[self.names[c]].update(plane)
+
+    def to_dict(self) -> Dict[str, Dict[str, Any]]:
+        return {ch_name: stats.to_dict() for ch_name, stats in self.stats.items()}
+
+
+def merge_channel_stats(
+    slices: Dict[str, Dict[str, Dict[str, Any]]],
+) -> Dict[str, Dict[str, Any]]:
+    """Combines statistics of all slices per channel name"""
+    merged: Dict[str, ChannelStats] = dict()
+    for slice_stats in slices.values():
+        for ch_name, stats in slice_stats.items():
+            channel = ChannelStats.from_dict(stats)
+            if ch_name in merged:
+                merged[ch_name].merge(channel)
+            else:
+                merged[ch_name] = channel
+    return {ch_name: stats.to_dict() for ch_name, stats in merged.items()}
+
+
+def update_region_sidecar(
+    path: Path, region: int, slice_stats: Dict[str, Dict[str, Dict[str, Any]]]
+):
+    """
+    Adds statistics of newly written slices to the region sidecar JSON,
+    statistics of slices skipped as up to date are kept from the previous run
+    """
+    slices = dict()
+    if path.exists():
+        with open(path, "r") as s:
+            slices = json.load(s)["slices"]
+    slices.update(slice_stats)
+    sidecar = dict(region=region, channels=merge_channel_stats(slices), slices=slices)
+    with atomic_output(path) as tmp_path:
+        with open(tmp_path, "w") as s:
+            json.dump(sidecar, s)
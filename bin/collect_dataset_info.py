@@ -1,20 +1,35 @@
 import argparse
 from fnmatch import fnmatch
 from pathlib import Path
-from typing import Dict, List, Tuple, Union
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple, Union
 
-import tifffile as tif
 import yaml
-from dataset_path_arrangement import create_listing_for_each_region
+from dataset_path_arrangement import iter_region_listings, sort_dict
+from execution import ExecutionOptions, get_num_workers
+from metadata_cache import (
+    ImageMeta,
+    MetadataCache,
+    add_metadata_cache_args,
+    default_max_entries,
+)
+from task_planner import (
+    PlanOptions,
+    add_plan_args,
+    check_plan,
+    plan_expr_tasks,
+    plan_segm_channels_tasks,
+    print_plan,
+)
 from utils import (
-    get_channel_names_from_ome,
+    add_perf_report_args,
     get_img_subdir,
     make_dir_if_not_exists,
-    path_to_str,
     path_to_str_local,
+    perf_report,
+    save_perf_report_on_exit,
     save_pipeline_config,
 )
-from utils_ome import strip_namespace
 
 
 def read_meta(meta_path: Path) -> dict:
@@ -32,8 +47,8 @@ def convert_all_paths_to_str(listing: dict) -> Dict[int, Dict[str, str]]:
     return all_ch_dirs
 
 
-def get_segm_channel_ids_from_ome(
-    path: Path,
+def match_segm_channels(
+    ch_names_ids: List[Tuple[str, int]],
     segm_ch_names: Dict[str, Union[str, List[str]]],
 ) -> Tuple[Dict[str, int], Dict[str, str]]:
     """
@@ -41,10 +56,6 @@ def get_segm_channel_ids_from_ome(
      [0] Mapping from segmentation channel names to 0-based indexes into channel list
      [1] Adjustment of segm_ch_names listing the first segmentation channel found
     """
-    with tif.TiffFile(path_to_str(path)) as TF:
-        ome_meta = TF.ome_metadata
-    ome_xml = strip_namespace(ome_meta)
-    ch_names_ids = get_channel_names_from_ome(ome_xml)
     segm_ch_names_ids: Dict[str, int] = {}
     adj_segm_ch_names: Dict[str, str] = {}
     for ch_type, name_or_names in segm_ch_names.items():
@@ -55,9 +66,7 @@ def get_segm_channel_ids_from_ome(
             if found:
                 break
             for ch_name, ch_id in ch_names_ids:
-                print("Checking", ch_name, "against", name_to_search)
                 if found := fnmatch(ch_name, name_to_search):
-                    print("Matched", ch_name, "against", name_to_search)
                     segm_ch_names_ids[ch_name] = ch_id
                     adj_segm_ch_names[ch_type] = ch_name
                     break
@@ -66,37 +75,180 @@ def get_segm_channel_ids_from_ome(
     return segm_ch_names_ids, adj_segm_ch_names
 
 
-def get_first_img_path(data_dir: Path, listing: Dict[int, Dict[str, Path]]) -> Path:
+def get_first_img_key(listing: Dict[int, Dict[str, Path]]) -> Tuple[int, str]:
     first_region = min(list(listing.keys()))
-    first_img_path = list(listing[first_region].values())[0]
-    return Path(data_dir / first_img_path).absolute()
+    first_slice_name = list(listing[first_region].keys())[0]
+    return first_region, first_slice_name
+
+
+def collect_image_metas(
+    data_dir: Path,
+    listing: Dict[int, Dict[str, Path]],
+    metadata_cache: MetadataCache,
+    num_workers: Optional[int] = None,
+) -> Dict[Tuple[int, str], ImageMeta]:
+    """Headers that are not cached yet are read in a thread pool"""
+    img_keys = [
+        (region, slice_name)
+        for region, slices in listing.items()
+        for slice_name in slices
+    ]
+    img_paths = [
+        data_dir / listing[region][slice_name] for region, slice_name in img_keys
+    ]
+    img_metas = metadata_cache.get_all(img_paths, num_workers=num_workers)
+    return dict(zip(img_keys, img_metas))
+
+
+def plan_pipeline(
+    data_dir: Path,
+    listing: Dict[int, Dict[str, Path]],
+    img_metas: Dict[Tuple[int, str], ImageMeta],
+    num_segm_channels: int,
+    options: PlanOptions,
+):
+    """
+    Plans the steps that process pixels with their default options,
+    from the headers that were read for validation
+    """
+    img_paths = {
+        (region, slice_name): data_dir / listing[region][slice_name]
+        for region, slice_name in img_metas
+    }
+    steps = {
+        "prepare_segmentation_channels": plan_segm_channels_tasks(
+            img_paths, img_metas, num_segm_channels
+        ),
+        "collect_output expressions": plan_expr_tasks(img_paths, img_metas),
+    }
+    if options.plan:
+        num_workers = get_num_workers(ExecutionOptions())
+        for step, tasks in steps.items():
+            print_plan(step, tasks, num_workers, options)
+    for tasks in steps.values():
+        check_plan(tasks, options)
+
 
+def validate_segm_channels(
+    channel_table: Dict[Tuple[int, str], List[Tuple[str, int]]],
+    segm_ch_names: Dict[str, Union[str, List[str]]],
+    reference_key: Tuple[int, str],
+) -> Tuple[Dict[str, int], Dict[str, str], Dict[int, Dict[str, Dict[str, int]]]]:
+    """
+    Checks that segmentation channels can be found in every image,
+    raises an error listing all images with missing channels.
+    Returns a 3-tuple:
+     [0], [1] Output of match_segm_channels for the reference image
+     [2] Segmentation channel ids of images where they differ from
+         the reference image, keyed by the channel names of the reference image
+    """
+    matches = dict()
+    errors = []
+    for (region, slice_name), ch_names_ids in channel_table.items():
+        try:
+            matches[(region, slice_name)] = match_segm_channels(
+                ch_names_ids, segm_ch_names
+            )
+        except KeyError as e:
+            errors.append(f"region {region}, slice {slice_name}: {e}")
+    if errors:
+        raise ValueError(
+            f"Segmentation channels are missing in {len(errors)} images:\n"
+            + "\n".join(errors)
+        )
 
-def main(data_dir: Path, meta_path: Path):
+    def get_ids_per_type(segm_ch_names_ids, adj_segm_ch_names):
+        return {
+            ch_type: segm_ch_names_ids[ch_name]
+            for ch_type, ch_name in adj_segm_ch_names.items()
+        }
+
+    segm_ch_names_ids, adj_segm_ch_names = matches[reference_key]
+    reference_ids = get_ids_per_type(segm_ch_names_ids, adj_segm_ch_names)
+    ids_per_image = dict()
+    for (region, slice_name), match in matches.items():
+        img_ids = get_ids_per_type(*match)
+        if img_ids != reference_ids:
+            ids_per_image.setdefault(region, dict())[slice_name] = {
+                adj_segm_ch_names[ch_type]: ch_id for ch_type, ch_id in img_ids.items()
+            }
+    return segm_ch_names_ids, adj_segm_ch_names, ids_per_image
+
+
+def main(
+    data_dir: Path,
+    meta_path: Path,
+    num_workers: Optional[int] = None,
+    metadata_cache_path: Optional[Path] = None,
+    metadata_cache_entries: int = default_max_entries,
+    plan: Optional[PlanOptions] = None,
+    out_dir: Path = Path("/output"),
+):
+    plan = plan or PlanOptions()
     data_dir = get_img_subdir(data_dir)
     meta = read_meta(meta_path)
     segmentation_channels = meta["segmentation_channels"]
 
-    listing = create_listing_for_each_region(data_dir)
+    make_dir_if_not_exists(out_dir)
+
+    # only OME-XML headers are read, so missing channels are found
+    # before any pixel data is processed. Headers of a region are read
+    # while directories of the next regions are still being scanned
+    start = perf_counter()
+    listing = dict()
+    img_metas = dict()
+    with perf_report.stage("read_headers"), MetadataCache(
+        metadata_cache_path, data_dir, metadata_cache_entries
+    ) as metadata_cache:
+        for region, slices in iter_region_listings(data_dir, num_workers):
+            listing[region] = slices
+            img_metas.update(
+                collect_image_metas(
+                    data_dir, {region: slices}, metadata_cache, num_workers
+                )
+            )
+    channel_table = {key: img_meta.channels for key, img_meta in img_metas.items()}
     if listing == {}:
         raise ValueError(
             "Dataset directory is either empty or has unexpected structure"
         )
-
-    out_dir = Path("/output")
-    make_dir_if_not_exists(out_dir)
-
-    first_img_path = data_dir / get_first_img_path(data_dir, listing)
-    segm_ch_names_ids, adj_segmentation_channels = get_segm_channel_ids_from_ome(
-        first_img_path, segmentation_channels
+    listing = sort_dict(listing)
+    (
+        segm_ch_names_ids,
+        adj_segmentation_channels,
+        segm_ch_ids_per_image,
+    ) = validate_segm_channels(
+        channel_table, segmentation_channels, get_first_img_key(listing)
+    )
+    for ch_type, ch_name in adj_segmentation_channels.items():
+        print("Matched", ch_type, "channel", ch_name)
+    num_layouts = len(
+        set(tuple(ch_names_ids) for ch_names_ids in channel_table.values())
+    )
+    print(
+        "Validated channels of",
+        len(channel_table),
+        "images in",
+        round(perf_counter() - start, 2),
+        "s |",
+        num_layouts,
+        "distinct channel layouts |",
+        "segmentation channel ids differ in",
+        sum(len(slices) for slices in segm_ch_ids_per_image.values()),
+        "images",
     )
 
+    if plan.plan or plan.max_task_memory is not None:
+        plan_pipeline(data_dir, listing, img_metas, len(segm_ch_names_ids), plan)
+
     listing_str = convert_all_paths_to_str(listing)
 
     pipeline_config = dict()
     pipeline_config["segmentation_channels"] = adj_segmentation_channels
     pipeline_config["dataset_map_all_slices"] = listing_str
     pipeline_config["segmentation_channel_ids"] = segm_ch_names_ids
+    if segm_ch_ids_per_image:
+        pipeline_config["segmentation_channel_ids_per_image"] = segm_ch_ids_per_image
 
     pipeline_config_path = out_dir / "pipeline_config.yaml"
     save_pipeline_config(pipeline_config, pipeline_config_path)
@@ -106,6 +258,23 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--data_dir", type=Path, help="path to the dataset directory")
     parser.add_argument("--meta_path", type=Path, help="path to dataset metadata yaml")
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=None,
+        help="number of threads that read image headers",
+    )
+    add_metadata_cache_args(parser, default=Path("/output/metadata_cache.sqlite"))
+    add_plan_args(parser)
+    add_perf_report_args(parser)
     args = parser.parse_args()
 
-    main(args.data_dir, args.meta_path)
+    with save_perf_report_on_exit(args.perf_report, "collect_dataset_info"):
+        main(
+            args.data_dir,
+            args.meta_path,
+            args.num_workers,
+            args.metadata_cache,
+            args.metadata_cache_entries,
+            PlanOptions.from_args(args),
+        )
@@ -1,32 +1,91 @@
 import argparse
 import shutil
+import sys
+from concurrent.futures import Executor
+from dataclasses import asdict, dataclass
 from pathlib import Path
-from typing import Dict, Iterable
-from os import walk
-import re
-import dask
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
 import numpy as np
 import tifffile as tif
-from utils import get_img_subdir, make_dir_if_not_exists, path_to_str, read_pipeline_config
-from utils_ome import modify_initial_ome_meta
-
-ome_tiff_pattern = re.compile(r"(?P<basename>.*)\.ome\.tiff(f?)$")
-
-def find_ome_tiff(input_dir: Path) -> Path:
-    """
-    Yields 2-tuples:
-     [0] full Path to source file
-     [1] output file Path (source file relative to input_dir)
-    """
-    for dirpath_str, _, filenames in walk(input_dir):
-        dirpath = Path(dirpath_str)
-        for filename in filenames:
-            if ome_tiff_pattern.match(filename):
-                src_filepath = dirpath / filename
-                return src_filepath
+from channel_stats import ImageStats, channel_stats_modes, update_region_sidecar
+from execution import (
+    ExecutionOptions,
+    add_execution_args,
+    get_executor,
+    get_num_workers,
+    schedule_tasks,
+    schedulers,
+)
+from file_transfer import transfer_file, transfer_methods
+from metadata_cache import (
+    ImageMeta,
+    MetadataCache,
+    add_metadata_cache_args,
+    default_max_entries,
+    read_image_meta,
+)
+from output_manifest import (
+    add_output_manifest_args,
+    open_output_file,
+    recorded_output,
+    save_output_manifest_on_exit,
+    verify_output_manifest,
+)
+from run_manifest import ResumeOptions, RunManifest, add_resume_args
+from sharding import ShardOptions, add_shard_args, select_shard
+from task_planner import (
+    PlanOptions,
+    TaskPlan,
+    add_plan_args,
+    check_plan,
+    estimate_expr_task,
+    plan_copy_tasks,
+    plan_expr_tasks,
+    plan_stitch_tasks,
+    print_plan,
+)
+from tiling import Tile, TiledImages, get_tile_label_map, read_tile_manifest
+from utils import (
+    add_perf_report_args,
+    build_source_index,
+    get_img_subdir,
+    make_dir_if_not_exists,
+    path_to_str,
+    perf_report,
+    read_pipeline_config,
+    save_perf_report_on_exit,
+)
+from utils_ome import (
+    add_sa_channel_stats,
+    modify_initial_ome_meta,
+    modify_mask_ome_meta,
+)
+from utils_tiff import (
+    PlaneCallback,
+    TiffEncoding,
+    add_encoding_args,
+    combine_plane_callbacks,
+    downsample_methods,
+    get_czyx_shape,
+    get_page_index,
+    iter_planes,
+    read_page,
+    tap_planes,
+    write_planes,
+)
+from utils_zarr import compression_codecs as zarr_compression_codecs
+from utils_zarr import write_ngff_image
 
 Image = np.ndarray
 
+output_formats = {"ome-tiff": ".ome.tiff", "ome-zarr": ".ome.zarr"}
+mask_dtypes = (np.uint8, np.uint16, np.uint32)
+default_mask_tile_size = 512
+# masks written by segmentation, per region directory
+mask_dir_name_template = "region_{region:03d}"
+mask_name_template = "reg{region:03d}_{slice_name}_mask.ome.tiff"
+
 
 def add_z_axis(img_stack: Image):
     stack_shape = img_stack.shape
@@ -35,116 +94,998 @@ def add_z_axis(img_stack: Image):
 
 
 def modify_and_save_img(
-    img_path: Path, out_path: Path, segmentation_channels: Dict[str, str]
+    img_path: Path,
+    out_path: Path,
+    segmentation_channels: Dict[str, str],
+    streaming: bool = True,
+    encoding: Optional[TiffEncoding] = None,
+    pyramid_levels: int = 0,
+    pyramid_method: str = "mean",
+    plane_callback: Optional[PlaneCallback] = None,
 ):
+    """
+    Rewrites the image with the new OME metadata and CZYX axes order.
+    In streaming mode planes are copied one at a time from the source series,
+    so only one plane is kept in memory instead of the whole stack.
+    With pyramid_levels > 0 sub-resolutions are written to SubIFDs
+    as the planes are copied.
+    plane_callback receives every plane as it is read, in streaming mode only.
+    """
+    encoding = encoding or TiffEncoding()
+    if plane_callback is not None and not streaming:
+        raise ValueError("Plane callback requires streaming mode")
     with tif.TiffFile(path_to_str(img_path)) as TF:
         ome_meta = TF.ome_metadata
-        img_stack = TF.series[0].asarray()
-    new_img_stack = add_z_axis(img_stack)
-    new_ome_meta = modify_initial_ome_meta(ome_meta, segmentation_channels)
-    with tif.TiffWriter(path_to_str(out_path), bigtiff=True) as TW:
-        TW.write(
-            new_img_stack,
-            contiguous=True,
-            photometric="minisblack",
-            description=new_ome_meta,
+        new_ome_meta = modify_initial_ome_meta(
+            ome_meta, segmentation_channels, pyramid_levels
         )
+        series = TF.series[0]
+        if streaming:
+            shape, dtype = get_czyx_shape(series), series.dtype
+            new_img_stack = tap_planes(
+                iter_planes(series, encoding.prefetch_depth), shape[1], plane_callback
+            )
+        else:
+            new_img_stack = add_z_axis(series.asarray())
+            shape, dtype = None, None
+        with open_output_file(out_path) as s, tif.TiffWriter(s, bigtiff=True) as TW:
+            write_planes(
+                TW,
+                new_img_stack,
+                encoding,
+                shape=shape,
+                dtype=dtype,
+                pyramid_levels=pyramid_levels,
+                pyramid_method=pyramid_method,
+                photometric="minisblack",
+                description=new_ome_meta.encode("utf-8"),
+            )
 
 
-def copy_files(
+def save_img_as_ngff(
+    img_path: Path,
+    out_path: Path,
+    segmentation_channels: Dict[str, str],
+    streaming: bool = True,
+    encoding: Optional[TiffEncoding] = None,
+    pyramid_levels: int = 0,
+    pyramid_method: str = "mean",
+    plane_callback: Optional[PlaneCallback] = None,
+):
+    """
+    Writes the image as OME-Zarr, planes are always streamed from the source.
+    Segmentation channels are stored next to the NGFF metadata.
+    """
+    encoding = encoding or TiffEncoding()
+    with tif.TiffFile(path_to_str(img_path)) as TF:
+        series = TF.series[0]
+        shape = get_czyx_shape(series)
+        write_ngff_image(
+            out_path,
+            tap_planes(
+                iter_planes(series, encoding.prefetch_depth), shape[1], plane_callback
+            ),
+            shape,
+            series.dtype,
+            TF.ome_metadata,
+            encoding,
+            pyramid_levels,
+            pyramid_method,
+            extra_attrs={"segmentation_channels": segmentation_channels},
+        )
+
+
+@dataclass
+class ExprOutputOptions:
+    """How expression images are written to the pipeline output"""
+
+    output_format: str = "ome-tiff"
+    rewrite_mode: str = "streaming"
+    pyramid_levels: int = 0
+    pyramid_method: str = "mean"
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "ExprOutputOptions":
+        return cls(
+            output_format=args.output_format,
+            rewrite_mode=args.rewrite_mode,
+            pyramid_levels=args.pyramid_levels,
+            pyramid_method=args.pyramid_method,
+        )
+
+    @property
+    def streaming(self) -> bool:
+        return self.rewrite_mode == "streaming"
+
+    @property
+    def out_name_template(self) -> str:
+        return "reg{region:03d}_{slice_name}_expr" + output_formats[self.output_format]
+
+    def validate(self, encoding: TiffEncoding):
+        if (
+            self.output_format == "ome-zarr"
+            and encoding.compression not in zarr_compression_codecs
+        ):
+            raise ValueError(
+                f"Compression {encoding.compression} is not supported for OME-Zarr, "
+                f"expected one of {zarr_compression_codecs}"
+            )
+
+    def get_save_kwargs(self) -> Dict[str, Any]:
+        return dict(
+            output_format=self.output_format,
+            streaming=self.streaming,
+            pyramid_levels=self.pyramid_levels,
+            pyramid_method=self.pyramid_method,
+        )
+
+
+def add_expr_output_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--rewrite_mode",
+        type=str,
+        choices=["streaming", "in_memory"],
+        default="streaming",
+        help="copy expression images plane by plane or load the whole stack",
+    )
+    parser.add_argument(
+        "--pyramid_levels",
+        type=int,
+        default=0,
+        help="number of 2x downsampled levels written to SubIFDs of expressions",
+    )
+    parser.add_argument(
+        "--pyramid_method",
+        type=str,
+        choices=downsample_methods,
+        default="mean",
+        help="how 2x2 blocks are reduced for pyramid levels",
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=list(output_formats),
+        default="ome-tiff",
+        help="format of expressions and masks in the pipeline output",
+    )
+
+
+def add_channel_stats_to_tiff(path: Path, stats: Dict[str, dict]):
+    """Replaces the OME-XML of a written image, pixel data is not touched"""
+    with tif.TiffFile(path_to_str(path)) as TF:
+        ome_meta = TF.ome_metadata
+    new_ome_meta = add_sa_channel_stats(ome_meta, stats)
+    with open_output_file(path, "r+b") as s:
+        tif.tiffcomment(s, new_ome_meta.encode("utf-8"))
+
+
+def save_expr_img(
+    img_path: Path,
+    out_path: Path,
+    output_format: str = "ome-tiff",
+    channel_stats: str = "none",
+    plane_callback: Optional[PlaneCallback] = None,
+    img_meta: Optional[ImageMeta] = None,
+    **kwargs,
+) -> Optional[Dict[str, dict]]:
+    """
+    Unless channel_stats is none, intensity statistics of every channel
+    are accumulated from the planes as they are streamed to the output
+    and returned per channel name. Channels and dtype are taken from img_meta
+    when the caller already has it from the metadata cache.
+    """
+    img_stats = None
+    if channel_stats != "none":
+        img_meta = img_meta or read_image_meta(img_path)
+        img_stats = ImageStats(img_meta.channels, img_meta.dtype)
+        plane_callback = combine_plane_callbacks(img_stats.update, plane_callback)
+    if output_format == "ome-zarr":
+        save_img_as_ngff(img_path, out_path, plane_callback=plane_callback, **kwargs)
+    else:
+        modify_and_save_img(img_path, out_path, plane_callback=plane_callback, **kwargs)
+    if img_stats is None:
+        return None
+    stats = img_stats.to_dict()
+    if channel_stats == "ome" and output_format == "ome-tiff":
+        add_channel_stats_to_tiff(out_path, stats)
+    return stats
+
+
+def copy_path(src: Path, dst: Path, transfer: str = "auto") -> str:
+    """
+    Copies a file or a directory, e.g. OME-Zarr image.
+    Returns the transfer method that was used for the file or the directory.
+    """
+    if src.is_dir():
+        methods = set()
+        shutil.copytree(
+            src,
+            dst,
+            dirs_exist_ok=True,
+            copy_function=lambda s, d: methods.add(
+                transfer_file(Path(s), Path(d), transfer)
+            ),
+        )
+        return ",".join(sorted(methods))
+    return transfer_file(src, dst, transfer)
+
+
+def get_label_dtype(min_label: int, max_label: int, dtype: np.dtype) -> np.dtype:
+    """Smallest unsigned dtype that fits labels, OME has no uint64 pixel type"""
+    if min_label < 0:
+        return dtype
+    for label_dtype in mask_dtypes:
+        if max_label <= np.iinfo(label_dtype).max:
+            return label_dtype
+    return dtype
+
+
+def get_mask_encoding(encoding: TiffEncoding) -> TiffEncoding:
+    """
+    Label images have long runs of the same value, that compress well
+    with horizontal differencing and a lossless codec
+    """
+    return TiffEncoding(
+        compression="zlib" if encoding.compression == "none" else encoding.compression,
+        tile_size=encoding.tile_size or default_mask_tile_size,
+        predictor=True,
+        encoder_threads=encoding.encoder_threads,
+    )
+
+
+def reencode_mask(
+    mask_path: Path,
+    out_path: Path,
+    output_format: str,
+    encoding: TiffEncoding,
+) -> str:
+    """
+    Rewrites the mask with the smallest dtype that fits its labels.
+    Planes are streamed twice, first to find the label range, then to write them.
+    """
+    with tif.TiffFile(path_to_str(mask_path)) as TF:
+        series = TF.series[0]
+        if not np.issubdtype(series.dtype, np.integer):
+            raise ValueError(f"Mask {mask_path} does not store integer labels")
+        shape = get_czyx_shape(series)
+        min_label, max_label = 0, 0
+        for plane in iter_planes(series, encoding.prefetch_depth):
+            min_label = min(min_label, int(plane.min()))
+            max_label = max(max_label, int(plane.max()))
+        dtype = get_label_dtype(min_label, max_label, series.dtype)
+        planes = (
+            plane.astype(dtype)
+            for plane in iter_planes(series, encoding.prefetch_depth)
+        )
+        mask_encoding = get_mask_encoding(encoding)
+        if output_format == "ome-zarr":
+            write_ngff_image(
+                out_path, planes, shape, dtype, TF.ome_metadata, mask_encoding
+            )
+        else:
+            new_ome_meta = modify_mask_ome_meta(TF.ome_metadata, np.dtype(dtype).name)
+            with open_output_file(out_path) as s, tif.TiffWriter(s, bigtiff=True) as TW:
+                write_planes(
+                    TW,
+                    planes,
+                    mask_encoding,
+                    shape=shape,
+                    dtype=dtype,
+                    photometric="minisblack",
+                    description=new_ome_meta.encode("utf-8"),
+                    metadata=None,
+                )
+    return f"reencoded {series.dtype} to {np.dtype(dtype).name}"
+
+
+def copy_mask(
+    mask_path: Path,
+    out_path: Path,
+    output_format: str = "ome-tiff",
+    encoding: Optional[TiffEncoding] = None,
+    transfer: str = "auto",
+    reencode: bool = False,
+) -> str:
+    """
+    Converts the mask to OME-Zarr, re-encodes it or transfers the file as is,
+    returns how the mask was written
+    """
+    encoding = encoding or TiffEncoding()
+    if reencode:
+        return reencode_mask(mask_path, out_path, output_format, encoding)
+    if output_format == "ome-zarr":
+        with tif.TiffFile(path_to_str(mask_path)) as TF:
+            series = TF.series[0]
+            write_ngff_image(
+                out_path,
+                iter_planes(series, encoding.prefetch_depth),
+                get_czyx_shape(series),
+                series.dtype,
+                TF.ome_metadata,
+                encoding,
+            )
+        return "ome-zarr"
+    return transfer_file(mask_path, out_path, transfer)
+
+
+def iter_src_dst(
     file_type: str,
     src_data_dir: Path,
-    src_dir_name: str,
-    img_name_template: str,
+    src_dir_name: Optional[str],
+    img_name_template: Optional[str],
     out_dir: Path,
     out_name_template: str,
     region: int,
     slices: Dict[str, str],
     additional_info=None,
-):
+) -> Iterator[Tuple[str, Path, Path]]:
+    """Yields slice name, source and destination paths of copy_files task"""
     for img_slice_name, slice_path in slices.items():
-        img_name = img_name_template.format(region=region, slice_name=img_slice_name)
-        src = src_data_dir / src_dir_name / img_name
         dst = out_dir / out_name_template.format(
             region=region, slice_name=img_slice_name
         )
-        if file_type == "mask":
-            shutil.copy(src, dst)
-        elif file_type == "expr":
-            segmentation_channels = additional_info
-            src = find_ome_tiff(src_data_dir)
-            modify_and_save_img(src, dst, segmentation_channels)
+        if file_type in ("mask", "copy"):
+            img_name = img_name_template.format(
+                region=region, slice_name=img_slice_name
+            )
+            src = src_data_dir / src_dir_name / img_name
+        else:
+            # expression slices are already resolved to their source images
+            src = slice_path
+        yield img_slice_name, src, dst
+
+
+def copy_files(
+    file_type: str,
+    src_data_dir: Path,
+    src_dir_name: Optional[str],
+    img_name_template: Optional[str],
+    out_dir: Path,
+    out_name_template: str,
+    region: int,
+    slices: Dict[str, str],
+    additional_info=None,
+) -> Dict[str, Dict[str, dict]]:
+    """Returns channel statistics of expression slices, if they were collected"""
+    slice_stats = dict()
+    for img_slice_name, src, dst in iter_src_dst(
+        file_type,
+        src_data_dir,
+        src_dir_name,
+        img_name_template,
+        out_dir,
+        out_name_template,
+        region,
+        slices,
+    ):
+        transfer = None
+        with recorded_output(dst) as tmp_dst:
+            if file_type == "mask":
+                transfer = copy_mask(src, tmp_dst, **(additional_info or {}))
+            elif file_type == "copy":
+                transfer = copy_path(src, tmp_dst, **(additional_info or {}))
+            elif file_type == "expr":
+                expr_info = dict(additional_info)
+                img_metas = expr_info.pop("img_metas", None) or {}
+                stats = save_expr_img(
+                    src, tmp_dst, img_meta=img_metas.get(img_slice_name), **expr_info
+                )
+                if stats is not None:
+                    slice_stats[img_slice_name] = stats
+
+        info = ["region:", region, "| src:", src, "| dst:", dst]
+        if transfer is not None:
+            info += ["| transfer:", transfer]
+        print(*info)
+    return slice_stats
 
-        print("region:", region, "| src:", src, "| dst:", dst)
+
+def run_copy_tasks(
+    executor: Executor,
+    tasks: List[tuple],
+    manifest: RunManifest,
+    task_estimates: Optional[List[Tuple[int, int]]] = None,
+    memory_budget: Optional[str] = None,
+    on_task_result: Optional[Callable[[tuple, Any], None]] = None,
+):
+    """
+    Runs copy_files tasks only for slices whose outputs are not up to date
+    and records finished ones in the run manifest.
+    on_task_result receives every finished task and its result.
+    """
+    pending_tasks = []
+    pending_estimates = []
+    num_skipped = 0
+    for i, task in enumerate(tasks):
+        slices = task[7]
+        outdated = {
+            img_slice_name: slices[img_slice_name]
+            for img_slice_name, src, dst in iter_src_dst(*task)
+            if not manifest.is_up_to_date([dst], [src])
+        }
+        num_skipped += len(slices) - len(outdated)
+        if outdated:
+            pending_tasks.append(task[:7] + (outdated,) + task[8:])
+            if task_estimates:
+                pending_estimates.append(task_estimates[i])
+    if num_skipped:
+        print("Skipping", num_skipped, "images with up to date outputs")
+
+    def record_task(i: int, result: Any):
+        for _, src, dst in iter_src_dst(*pending_tasks[i]):
+            manifest.record([dst], [src])
+        if on_task_result is not None:
+            on_task_result(pending_tasks[i], result)
+
+    task_sizes = [size for size, _ in pending_estimates]
+    task_costs = [cost for _, cost in pending_estimates]
+    try:
+        schedule_tasks(
+            executor,
+            copy_files,
+            pending_tasks,
+            task_sizes,
+            memory_budget,
+            task_costs,
+            on_task_done=record_task,
+            task_names=[f"{task[0]} region {task[6]}" for task in pending_tasks],
+        )
+    finally:
+        manifest.save()
 
 
 def collect_segm_masks(
-    data_dir: Path, listing: Dict[int, Dict[str, str]], out_dir: Path
+    data_dir: Path,
+    listing: Dict[int, Dict[str, str]],
+    out_dir: Path,
+    executor: Executor,
+    manifest: RunManifest,
+    output_format: str = "ome-tiff",
+    encoding: Optional[TiffEncoding] = None,
+    transfer: str = "auto",
+    reencode: bool = False,
 ):
-    out_name_template = "reg{region:03d}_{slice_name}_mask.ome.tiff"
-    img_name_template = "reg{region:03d}_{slice_name}_mask.ome.tiff"
-    dir_name_template = "region_{region:03d}"
+    out_name_template = (
+        "reg{region:03d}_{slice_name}_mask" + output_formats[output_format]
+    )
     tasks = []
     for region, slices in listing.items():
-        dir_name = dir_name_template.format(region=region)
-        task = dask.delayed(copy_files)(
+        dir_name = mask_dir_name_template.format(region=region)
+        task = (
             "mask",
             data_dir,
             dir_name,
-            img_name_template,
+            mask_name_template,
             out_dir,
             out_name_template,
             region,
             slices,
+            dict(
+                output_format=output_format,
+                encoding=encoding,
+                transfer=transfer,
+                reencode=reencode,
+            ),
         )
         tasks.append(task)
-    dask.compute(*tasks)
+    run_copy_tasks(executor, tasks, manifest)
+
+
+def read_mask_plane(mask_path: Path, channel_id: int) -> Image:
+    with tif.TiffFile(path_to_str(mask_path)) as TF:
+        series = TF.series[0]
+        return np.asarray(read_page(series.pages[get_page_index(series, channel_id)]))
+
+
+def iter_stitched_planes(
+    tile_paths: List[Path],
+    tiles: List[Tile],
+    label_maps: List[np.ndarray],
+    num_channels: int,
+    shape: Tuple[int, int],
+    dtype: np.dtype,
+    scratch_dir: Path,
+) -> Iterator[Image]:
+    """
+    Stitches one channel at a time into a memory-mapped scratch file,
+    so only one tile is held in memory. Where kept objects of neighbouring
+    tiles overlap, the pixels of the tile stitched first are kept.
+    """
+    for c in range(num_channels):
+        # a new file per channel, the writer may still hold tiles of the previous one
+        plane = np.memmap(
+            scratch_dir / f"stitch_c{c}.scratch", dtype=dtype, mode="w+", shape=shape
+        )
+        for path, tile, label_map in zip(tile_paths, tiles, label_maps):
+            labels = read_mask_plane(path, c).astype(np.intp, copy=False)
+            max_label = int(labels.max(initial=0))
+            if max_label >= len(label_map):
+                # labels without a cell are not kept
+                label_map = np.pad(label_map, (0, max_label + 1 - len(label_map)))
+            dst = plane[tile.y : tile.y + tile.height, tile.x : tile.x + tile.width]
+            np.copyto(dst, label_map[labels].astype(dtype), where=dst == 0)
+        yield plane
+
+
+def stitch_mask(
+    tile_paths: List[Path],
+    tiles: List[Tile],
+    shape: Tuple[int, int],
+    out_path: Path,
+    output_format: str = "ome-tiff",
+    encoding: Optional[TiffEncoding] = None,
+) -> int:
+    """
+    Combines masks of the tiles of a slide into one mask. Every object is kept
+    from the tile that has the centroid of its cell, the first channel,
+    in its core. Labels are renumbered to be unique across tiles.
+    Returns the number of objects.
+    """
+    encoding = encoding or TiffEncoding()
+    label_maps = []
+    num_labels = 0
+    for path, tile in zip(tile_paths, tiles):
+        label_map, num_kept = get_tile_label_map(
+            read_mask_plane(path, 0), tile, num_labels + 1
+        )
+        label_maps.append(label_map)
+        num_labels += num_kept
+    dtype = get_label_dtype(0, num_labels, np.uint32)
+    with tif.TiffFile(path_to_str(tile_paths[0])) as TF:
+        num_channels = get_czyx_shape(TF.series[0])[0]
+        ome_meta = modify_mask_ome_meta(TF.ome_metadata, np.dtype(dtype).name, shape)
+    scratch_dir = out_path.parent / f".stitch-{out_path.name}"
+    make_dir_if_not_exists(scratch_dir)
+    try:
+        planes = iter_stitched_planes(
+            tile_paths, tiles, label_maps, num_channels, shape, dtype, scratch_dir
+        )
+        czyx_shape = (num_channels, 1) + tuple(shape)
+        mask_encoding = get_mask_encoding(encoding)
+        if output_format == "ome-zarr":
+            write_ngff_image(
+                out_path, planes, czyx_shape, dtype, ome_meta, mask_encoding
+            )
+        else:
+            with open_output_file(out_path) as s, tif.TiffWriter(s, bigtiff=True) as TW:
+                write_planes(
+                    TW,
+                    planes,
+                    mask_encoding,
+                    shape=czyx_shape,
+                    dtype=dtype,
+                    photometric="minisblack",
+                    description=ome_meta.encode("utf-8"),
+                    metadata=None,
+                )
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    return num_labels
+
+
+def get_tile_mask_paths(mask_dir: Path, region: int, tiles: List[Tile]) -> List[Path]:
+    return [
+        mask_dir
+        / mask_dir_name_template.format(region=region)
+        / mask_name_template.format(region=region, slice_name=tile.name)
+        for tile in tiles
+    ]
+
+
+def stitch_tiled_mask(
+    mask_dir: Path,
+    region: int,
+    shape: Tuple[int, int],
+    tiles: List[Tile],
+    dst: Path,
+    output_format: str = "ome-tiff",
+    encoding: Optional[TiffEncoding] = None,
+):
+    tile_paths = get_tile_mask_paths(mask_dir, region, tiles)
+    with recorded_output(dst) as tmp_dst:
+        num_labels = stitch_mask(
+            tile_paths, tiles, shape, tmp_dst, output_format, encoding
+        )
+    print(
+        "region:",
+        region,
+        "| tiles:",
+        len(tiles),
+        "| objects:",
+        num_labels,
+        "| dst:",
+        dst,
+    )
+
+
+def collect_tiled_segm_masks(
+    mask_dir: Path,
+    listing: Dict[int, Dict[str, str]],
+    tiled_images: TiledImages,
+    out_dir: Path,
+    executor: Executor,
+    manifest: RunManifest,
+    output_format: str = "ome-tiff",
+    encoding: Optional[TiffEncoding] = None,
+):
+    """Stitches masks of the tiles listed in the tile manifest, one task per slide"""
+    out_name_template = (
+        "reg{region:03d}_{slice_name}_mask" + output_formats[output_format]
+    )
+    tasks = []
+    task_names = []
+    task_paths = []
+    num_skipped = 0
+    for region, slices in listing.items():
+        for img_slice_name in slices:
+            shape, tiles = tiled_images[region][img_slice_name]
+            dst = out_dir / out_name_template.format(
+                region=region, slice_name=img_slice_name
+            )
+            tile_paths = get_tile_mask_paths(mask_dir, region, tiles)
+            if manifest.is_up_to_date([dst], tile_paths):
+                num_skipped += 1
+                continue
+            tasks.append((mask_dir, region, shape, tiles, dst, output_format, encoding))
+            task_names.append(f"stitch region {region} {img_slice_name}")
+            task_paths.append((dst, tile_paths))
+    if num_skipped:
+        print("Skipping", num_skipped, "images with up to date outputs")
+
+    def record_task(i: int, _):
+        dst, tile_paths = task_paths[i]
+        manifest.record([dst], tile_paths)
+
+    try:
+        schedule_tasks(
+            executor,
+            stitch_tiled_mask,
+            tasks,
+            [],
+            on_task_done=record_task,
+            task_names=task_names,
+        )
+    finally:
+        manifest.save()
 
 
 def collect_expr(
-    data_dir: Path, listing: dict, out_dir: Path, segmentation_channels: Dict[str, str]
+    data_dir: Path,
+    listing: dict,
+    out_dir: Path,
+    segmentation_channels: Dict[str, str],
+    executor: Executor,
+    manifest: RunManifest,
+    metadata_cache: MetadataCache,
+    memory_budget: Optional[str] = None,
+    encoding: Optional[TiffEncoding] = None,
+    expr_options: Optional[ExprOutputOptions] = None,
+    channel_stats: str = "none",
+    stats_dir: Optional[Path] = None,
 ):
-    out_name_template = "reg{region:03d}_{slice_name}_expr.ome.tiff"
-    img_name_template = "{slice_name}.ome.tif"  # one f
-    dir_name_template = "region_{region}"
-    dir_name_template_3d = "region_{region:03d}"
+    expr_options = expr_options or ExprOutputOptions()
+    src_index = build_source_index(data_dir, listing)
 
     tasks = []
+    task_estimates = []
     for region, slices in listing.items():
-        dir_name = dir_name_template.format(region=region) if (data_dir /
-                    dir_name_template.format(region=region)).exists() else (dir_name_template_3d.format(region=region))
-        task = dask.delayed(copy_files)(
+        src_paths = {
+            slice_name: src_index[(region, slice_name)] for slice_name in slices
+        }
+        img_metas = None
+        if memory_budget is not None or channel_stats != "none":
+            img_metas = metadata_cache.get_all(list(src_paths.values()))
+        if memory_budget is not None:
+            task_estimates.append(estimate_expr_task(img_metas, expr_options.streaming))
+        task = (
             "expr",
             data_dir,
-            dir_name,
-            img_name_template,
+            None,
+            None,
             out_dir,
-            out_name_template,
+            expr_options.out_name_template,
+            region,
+            src_paths,
+            dict(
+                segmentation_channels=segmentation_channels,
+                encoding=encoding,
+                channel_stats=channel_stats,
+                img_metas=(
+                    dict(zip(src_paths, img_metas)) if channel_stats != "none" else None
+                ),
+                **expr_options.get_save_kwargs(),
+            ),
+        )
+        tasks.append(task)
+
+    def save_region_stats(task: tuple, slice_stats: Dict[str, Dict[str, dict]]):
+        if slice_stats:
+            region = task[6]
+            sidecar_path = stats_dir / f"reg{region:03d}_channel_stats.json"
+            update_region_sidecar(sidecar_path, region, slice_stats)
+
+    run_copy_tasks(
+        executor,
+        tasks,
+        manifest,
+        task_estimates,
+        memory_budget,
+        on_task_result=save_region_stats if channel_stats != "none" else None,
+    )
+
+
+def collect_ingested_expr(
+    expr_dir: Path,
+    listing: dict,
+    out_dir: Path,
+    executor: Executor,
+    manifest: RunManifest,
+    expr_options: Optional[ExprOutputOptions] = None,
+    transfer: str = "auto",
+):
+    """
+    Copies expressions that were already written by
+    prepare_segmentation_channels in the ingest mode
+    """
+    expr_options = expr_options or ExprOutputOptions()
+    tasks = []
+    for region, slices in listing.items():
+        task = (
+            "copy",
+            expr_dir,
+            "",
+            expr_options.out_name_template,
+            out_dir,
+            expr_options.out_name_template,
             region,
             slices,
-            segmentation_channels,
+            dict(transfer=transfer),
         )
         tasks.append(task)
-    dask.compute(*tasks)
+    run_copy_tasks(executor, tasks, manifest)
+
 
+def plan_collect_output(
+    data_dir: Path,
+    mask_dir: Path,
+    listing: Dict[int, Dict[str, str]],
+    metadata_cache: MetadataCache,
+    expr_options: ExprOutputOptions,
+    encoding: TiffEncoding,
+    expr_dir: Optional[Path] = None,
+    reencode_masks: bool = False,
+    tiled_images: Optional[TiledImages] = None,
+) -> Tuple[List[TaskPlan], List[TaskPlan]]:
+    """Returns plans of mask and expression tasks, from headers only"""
+    keys = [
+        (region, slice_name)
+        for region, slices in listing.items()
+        for slice_name in slices
+    ]
+    if tiled_images is not None:
+        tile_paths = {
+            (region, slice_name): get_tile_mask_paths(
+                mask_dir, region, tiled_images[region][slice_name][1]
+            )
+            for region, slice_name in keys
+        }
+        mask_tasks = plan_stitch_tasks(
+            tile_paths,
+            {key: metadata_cache.get_all(paths) for key, paths in tile_paths.items()},
+            {
+                (region, slice_name): tiled_images[region][slice_name][0]
+                for region, slice_name in keys
+            },
+        )
+    else:
+        mask_paths = {
+            (region, slice_name): mask_dir
+            / mask_dir_name_template.format(region=region)
+            / mask_name_template.format(region=region, slice_name=slice_name)
+            for region, slice_name in keys
+        }
+        mask_metas = None
+        if reencode_masks or expr_options.output_format == "ome-zarr":
+            existing_mask_paths = {
+                key: path for key, path in mask_paths.items() if path.exists()
+            }
+            mask_metas = dict(
+                zip(
+                    existing_mask_paths,
+                    metadata_cache.get_all(list(existing_mask_paths.values())),
+                )
+            )
+        mask_tasks = plan_copy_tasks(mask_paths, "mask", mask_metas)
+
+    if expr_dir is not None:
+        expr_paths = {
+            (region, slice_name): expr_dir
+            / expr_options.out_name_template.format(
+                region=region, slice_name=slice_name
+            )
+            for region, slice_name in keys
+        }
+        return mask_tasks, plan_copy_tasks(expr_paths, "expr")
+    img_paths = build_source_index(data_dir, listing)
+    img_metas = metadata_cache.get_all(list(img_paths.values()))
+    expr_tasks = plan_expr_tasks(
+        img_paths,
+        dict(zip(img_paths, img_metas)),
+        expr_options.streaming,
+        encoding.prefetch_depth,
+    )
+    return mask_tasks, expr_tasks
 
-def main(data_dir: Path, mask_dir: Path, pipeline_config_path: Path):
+
+def main(
+    data_dir: Path,
+    mask_dir: Path,
+    pipeline_config_path: Path,
+    execution: Optional[ExecutionOptions] = None,
+    mask_scheduler: str = "threads",
+    encoding: Optional[TiffEncoding] = None,
+    expr_options: Optional[ExprOutputOptions] = None,
+    expr_dir: Optional[Path] = None,
+    resume: Optional[ResumeOptions] = None,
+    metadata_cache_path: Optional[Path] = None,
+    metadata_cache_entries: int = default_max_entries,
+    transfer: str = "auto",
+    reencode_masks: bool = False,
+    shard: Optional[ShardOptions] = None,
+    channel_stats: str = "none",
+    tile_manifest_path: Optional[Path] = None,
+    plan: Optional[PlanOptions] = None,
+    out_dir: Path = Path("/output"),
+):
+    execution = execution or ExecutionOptions()
+    encoding = encoding or TiffEncoding()
+    expr_options = expr_options or ExprOutputOptions()
+    resume = resume or ResumeOptions()
+    shard = shard or ShardOptions()
+    plan = plan or PlanOptions()
+    expr_options.validate(encoding)
+    manifest_path = out_dir / "run_manifest.json"
     data_dir = get_img_subdir(data_dir)
     pipeline_config = read_pipeline_config(pipeline_config_path)
-    listing = pipeline_config["dataset_map_all_slices"]
+    listing = select_shard(data_dir, pipeline_config["dataset_map_all_slices"], shard)
     segmentation_channels = pipeline_config["segmentation_channels"]
 
-    out_dir = Path("/output/pipeline_output")
-    mask_out_dir = out_dir / "mask"
-    expr_out_dir = out_dir / "expr"
+    if plan.plan or plan.max_task_memory is not None:
+        tiled_images = None
+        if tile_manifest_path is not None:
+            _, tiled_images = read_tile_manifest(tile_manifest_path)
+        with MetadataCache(
+            metadata_cache_path, data_dir, metadata_cache_entries
+        ) as metadata_cache:
+            mask_tasks, expr_tasks = plan_collect_output(
+                data_dir,
+                mask_dir,
+                listing,
+                metadata_cache,
+                expr_options,
+                encoding,
+                expr_dir,
+                reencode_masks,
+                tiled_images,
+            )
+        if plan.plan:
+            num_workers = get_num_workers(execution)
+            print_plan("collect_output masks", mask_tasks, num_workers, plan)
+            print_plan("collect_output expressions", expr_tasks, num_workers, plan)
+        check_plan(mask_tasks + expr_tasks, plan)
+        if plan.plan:
+            return
+
+    pipeline_out_dir = out_dir / "pipeline_output"
+    mask_out_dir = pipeline_out_dir / "mask"
+    expr_out_dir = pipeline_out_dir / "expr"
     make_dir_if_not_exists(mask_out_dir)
     make_dir_if_not_exists(expr_out_dir)
 
-    dask.config.set({"num_workers": 5, "scheduler": "processes"})
-    print("\nCollecting segmentation masks")
-    collect_segm_masks(mask_dir, listing, mask_out_dir)
+    if tile_manifest_path is not None:
+        print("\nStitching segmentation masks of tiles")
+        tiling, tiled_images = read_tile_manifest(tile_manifest_path)
+        manifest = resume.open_manifest(
+            manifest_path,
+            dict(
+                step="stitch",
+                output_format=expr_options.output_format,
+                encoding=encoding.get_output_config(),
+                tiling=asdict(tiling),
+            ),
+        )
+        with perf_report.stage("stitch_segm_masks"), get_executor(
+            execution
+        ) as executor:
+            collect_tiled_segm_masks(
+                mask_dir,
+                listing,
+                tiled_images,
+                mask_out_dir,
+                executor,
+                manifest,
+                expr_options.output_format,
+                encoding,
+            )
+    else:
+        print("\nCollecting segmentation masks")
+        manifest = resume.open_manifest(
+            manifest_path,
+            dict(
+                step="mask",
+                output_format=expr_options.output_format,
+                encoding=encoding.get_output_config(),
+                reencode=reencode_masks,
+            ),
+        )
+        with perf_report.stage("collect_segm_masks"), get_executor(
+            execution, mask_scheduler
+        ) as executor:
+            collect_segm_masks(
+                mask_dir,
+                listing,
+                mask_out_dir,
+                executor,
+                manifest,
+                expr_options.output_format,
+                encoding,
+                transfer,
+                reencode_masks,
+            )
+    if expr_dir is not None:
+        if channel_stats != "none":
+            raise ValueError(
+                "Channel statistics are computed while expressions are written, "
+                "they are not available for expressions written during ingest"
+            )
+        print("\nCollecting expressions written during ingest")
+        manifest = resume.open_manifest(manifest_path, dict(step="copy"))
+        with perf_report.stage("collect_ingested_expr"), get_executor(
+            execution, mask_scheduler
+        ) as executor:
+            collect_ingested_expr(
+                expr_dir,
+                listing,
+                expr_out_dir,
+                executor,
+                manifest,
+                expr_options,
+                transfer,
+            )
+        return
     print("\nCollecting expressions")
-    collect_expr(data_dir, listing, expr_out_dir, segmentation_channels)
+    manifest = resume.open_manifest(
+        manifest_path,
+        dict(
+            step="expr",
+            segmentation_channels=segmentation_channels,
+            encoding=encoding.get_output_config(),
+            expr_options=asdict(expr_options),
+            channel_stats=channel_stats,
+        ),
+    )
+    stats_dir = pipeline_out_dir / "channel_stats"
+    if channel_stats != "none":
+        make_dir_if_not_exists(stats_dir)
+    with perf_report.stage("collect_expr"), get_executor(
+        execution
+    ) as executor, MetadataCache(
+        metadata_cache_path, data_dir, metadata_cache_entries
+    ) as metadata_cache:
+        collect_expr(
+            data_dir,
+            listing,
+            expr_out_dir,
+            segmentation_channels,
+            executor,
+            manifest,
+            metadata_cache,
+            memory_budget=execution.memory_budget,
+            encoding=encoding,
+            expr_options=expr_options,
+            channel_stats=channel_stats,
+            stats_dir=stats_dir,
+        )
 
 
 if __name__ == "__main__":
@@ -156,6 +1097,83 @@ if __name__ == "__main__":
     parser.add_argument(
         "--pipeline_config", type=Path, help="path to region map file YAML"
     )
+    parser.add_argument(
+        "--expr_dir",
+        type=Path,
+        default=None,
+        help="path to expressions already written by the ingest mode",
+    )
+    add_execution_args(parser)
+    parser.add_argument(
+        "--mask_scheduler",
+        type=str,
+        choices=schedulers,
+        default="threads",
+        help="backend that copies segmentation masks and ingested expressions",
+    )
+    parser.add_argument(
+        "--transfer",
+        type=str,
+        choices=transfer_methods,
+        default="auto",
+        help="how masks and ingested expressions are copied, auto tries "
+        "reflink, hardlink and copy in this order. Hardlinked outputs "
+        "share data with their sources",
+    )
+    parser.add_argument(
+        "--reencode_masks",
+        action="store_true",
+        help="rewrite masks with the smallest unsigned dtype that fits the labels "
+        "and a tiled lossless codec, zlib unless --compression is set",
+    )
+    parser.add_argument(
+        "--channel_stats",
+        type=str,
+        choices=channel_stats_modes,
+        default="none",
+        help="compute intensity statistics of every channel while writing "
+        "expressions and save them to a JSON per region, ome also adds them "
+        "to StructuredAnnotations of OME-TIFF expressions",
+    )
+    parser.add_argument(
+        "--tile_manifest",
+        type=Path,
+        default=None,
+        help="tile_manifest.json of segmentation channels exported as tiles, "
+        "masks of the tiles are stitched into one mask per image",
+    )
+    add_encoding_args(parser)
+    add_expr_output_args(parser)
+    add_resume_args(parser)
+    add_shard_args(parser)
+    add_plan_args(parser)
+    add_metadata_cache_args(parser, default=None)
+    add_perf_report_args(parser)
+    add_output_manifest_args(parser)
     args = parser.parse_args()
 
-    main(args.data_dir, args.mask_dir, args.pipeline_config)
+    if args.verify:
+        verify_output_manifest(args.output_manifest, args.num_workers)
+        sys.exit()
+    with save_perf_report_on_exit(
+        args.perf_report, "collect_output"
+    ), save_output_manifest_on_exit(args.output_manifest):
+        main(
+            args.data_dir,
+            args.mask_dir,
+            args.pipeline_config,
+            ExecutionOptions.from_args(args),
+            args.mask_scheduler,
+            TiffEncoding.from_args(args),
+            ExprOutputOptions.from_args(args),
+            args.expr_dir,
+            ResumeOptions.from_args(args),
+            args.metadata_cache,
+            args.metadata_cache_entries,
+            args.transfer,
+            args.reencode_masks,
+            ShardOptions.from_args(args),
+            args.channel_stats,
+            args.tile_manifest,
+            PlanOptions.from_args(args),
+        )
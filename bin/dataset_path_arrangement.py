@@ -1,6 +1,14 @@
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, Iterator, List, Optional, Tuple
+
+allowed_extensions = (".tif", ".tiff")
+# patterns are compiled once, they are applied to every file of the dataset
+digits_pattern = re.compile(r"(\d+)")
+tiff_extension_pattern = re.compile(r"(\.ome)?\.ti(ff|f)", re.IGNORECASE)
+region_pattern = re.compile("Region", re.IGNORECASE)
 
 
 def alpha_num_order(string: str) -> str:
@@ -10,7 +18,7 @@ def alpha_num_order(string: str) -> str:
     return "".join(
         [
             format(int(x), "05d") if x.isdigit() else x
-            for x in re.split(r"(\d+)", string)
+            for x in digits_pattern.split(string)
         ]
     )
 
@@ -22,22 +30,25 @@ def sort_dict(item: dict) -> dict:
 
 
 def get_img_listing(in_dir: Path) -> List[Path]:
-    allowed_extensions = (".tif", ".tiff")
-    listing = list(in_dir.iterdir())
-    img_listing = [f for f in listing if f.suffix in allowed_extensions]
-    img_listing = sorted(img_listing, key=lambda x: alpha_num_order(x.name))
-    return img_listing
+    # scandir returns names without a stat call per entry
+    with os.scandir(in_dir) as entries:
+        img_names = [
+            entry.name
+            for entry in entries
+            if os.path.splitext(entry.name)[1] in allowed_extensions
+        ]
+    return [in_dir / name for name in sorted(img_names, key=alpha_num_order)]
 
 
 def extract_digits_from_string(string: str) -> List[int]:
     digits = [
-        int(x) for x in re.split(r"(\d+)", string) if x.isdigit()
+        int(x) for x in digits_pattern.split(string) if x.isdigit()
     ]  # '1_00001_Z02_CH3' -> '1', '00001', '02', '3' -> [1,1,2,3]
     return digits
 
 
 def extract_channel_name(file_name: str) -> str:
-    return re.sub(r"(\.ome)?\.ti(ff|f)", "", file_name, flags=re.IGNORECASE)
+    return tiff_extension_pattern.sub("", file_name)
 
 
 def get_channel_listing(dataset_dir: Path, listing: List[Path]) -> Dict[str, Path]:
@@ -49,33 +60,36 @@ def get_channel_listing(dataset_dir: Path, listing: List[Path]) -> Dict[str, Pat
     return arranged_listing
 
 
-def name_contains(pattern, name) -> bool:
-    res = re.search(pattern, name, re.IGNORECASE) is not None
-    return res
-
-
 def get_region_listing(dataset_dir: Path) -> Dict[int, Path]:
-    regions_dirs = [p for p in list(dataset_dir.iterdir()) if p.is_dir()]
-    regions_dirs = sorted(regions_dirs, key=lambda path: alpha_num_order(path.name))
+    # file type of DirEntry comes from the directory listing itself,
+    # so subdirectories are found without a stat call per entry
+    with os.scandir(dataset_dir) as entries:
+        region_names = [entry.name for entry in entries if entry.is_dir()]
     arranged_listing = dict()
-    for region_dir in regions_dirs:
+    for region_name in sorted(region_names, key=alpha_num_order):
         # dir names expected to be Region_001, Region_002 ...
-        if name_contains("Region", region_dir.name):
-            digits = extract_digits_from_string(region_dir.name)
+        if region_pattern.search(region_name) is not None:
+            digits = extract_digits_from_string(region_name)
             region = digits[0]
-            arranged_listing[region] = region_dir
+            arranged_listing[region] = dataset_dir / region_name
     return arranged_listing
 
 
-def create_listing_for_each_region(dataset_dir: Path) -> Dict[int, Dict[str, Path]]:
-    # output of this function contains local paths to regions and channels relative to dataset_dir
+def iter_region_listings(
+    dataset_dir: Path, num_workers: Optional[int] = None
+) -> Iterator[Tuple[int, Dict[str, Path]]]:
+    """
+    Scans region directories concurrently and yields every region
+    with its images as soon as its directory is scanned, in no particular order,
+    so the work on the first regions can start before the whole tree is scanned
+    """
     dataset_dir = dataset_dir.absolute()
     region_dict = get_region_listing(dataset_dir)
-    arranged_listing = dict()
-    for region, dir_path in region_dict.items():
-        this_region_img_listing = get_img_listing(dataset_dir / dir_path)
-        arranged_listing[region] = get_channel_listing(
-            dataset_dir, this_region_img_listing
-        )
-    arranged_listing = sort_dict(arranged_listing)
-    return arranged_listing
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            executor.submit(get_img_listing, dir_path): region
+            for region, dir_path in region_dict.items()
+        }
+        for future in as_completed(futures):
+            region = futures[future]
+            yield region, get_channel_listing(dataset_dir, future.result())
@@ -0,0 +1,315 @@
+import argparse
+import os
+import time
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Iterator, List, Optional, Sequence
+
+from utils import parse_size, perf_report, run_measured, written_outputs
+
+schedulers = ("threads", "processes", "distributed")
+# receives index and result of a finished task
+TaskCallback = Callable[[int, Any], None]
+default_memory_per_worker = "2G"
+
+
+def read_cgroup_value(path: Path) -> Optional[str]:
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return None
+
+
+def get_cgroup_cpu_limit() -> Optional[float]:
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    cpu_max = read_cgroup_value(Path("/sys/fs/cgroup/cpu.max"))
+    if cpu_max is not None:
+        quota, period = cpu_max.split()
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    # cgroup v1: quota is -1 when unlimited
+    quota = read_cgroup_value(Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us"))
+    period = read_cgroup_value(Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us"))
+    if quota is not None and period is not None and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def get_available_cpus() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        num_cpus = len(os.sched_getaffinity(0))
+    else:
+        num_cpus = os.cpu_count() or 1
+    cpu_limit = get_cgroup_cpu_limit()
+    if cpu_limit is not None:
+        num_cpus = min(num_cpus, max(1, int(cpu_limit)))
+    return num_cpus
+
+
+def get_memory_limit() -> Optional[int]:
+    """Memory available to the container in bytes, None if it can't be found"""
+    limits = []
+    for cgroup_file in (
+        Path("/sys/fs/cgroup/memory.max"),
+        Path("/sys/fs/cgroup/memory/memory.limit_in_bytes"),
+    ):
+        value = read_cgroup_value(cgroup_file)
+        if value is not None and value.isdigit():
+            limits.append(int(value))
+    try:
+        limits.append(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"))
+    except (ValueError, OSError, AttributeError):
+        pass
+    return min(limits) if limits else None
+
+
+def get_default_num_workers(memory_per_worker: int) -> int:
+    """Number of workers that fit into available cores and memory limits"""
+    num_workers = get_available_cpus()
+    memory_limit = get_memory_limit()
+    if memory_limit is not None:
+        num_workers = min(num_workers, memory_limit // memory_per_worker)
+    return max(1, num_workers)
+
+
+@dataclass
+class ExecutionOptions:
+    scheduler: str = "processes"
+    num_workers: Optional[int] = None
+    memory_per_worker: str = default_memory_per_worker
+    memory_budget: Optional[str] = None
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "ExecutionOptions":
+        return cls(
+            scheduler=args.scheduler,
+            num_workers=args.num_workers,
+            memory_per_worker=args.memory_per_worker,
+            memory_budget=args.memory_budget,
+        )
+
+
+def get_num_workers(options: ExecutionOptions) -> int:
+    if options.num_workers is not None:
+        return options.num_workers
+    return get_default_num_workers(parse_size(options.memory_per_worker))
+
+
+@contextmanager
+def get_executor(
+    options: ExecutionOptions, scheduler: Optional[str] = None
+) -> Iterator[Executor]:
+    """
+    Creates an executor for one of the backends:
+    threads - suitable for I/O bound tasks, tifffile and zlib release the GIL,
+    processes - local process pool,
+    distributed - dask.distributed LocalCluster with one thread per worker.
+    The scheduler argument overrides the one from options.
+    """
+    scheduler = scheduler or options.scheduler
+    num_workers = get_num_workers(options)
+    print("Using", scheduler, "scheduler with", num_workers, "workers")
+    if scheduler == "threads":
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            yield executor
+    elif scheduler == "processes":
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            yield executor
+    elif scheduler == "distributed":
+        try:
+            from dask.distributed import Client, LocalCluster
+        except ImportError as e:
+            raise ImportError(
+                "Scheduler 'distributed' requires dask.distributed to be installed"
+            ) from e
+        with LocalCluster(
+            n_workers=num_workers,
+            threads_per_worker=1,
+            memory_limit=parse_size(options.memory_per_worker),
+            dashboard_address=None,
+        ) as cluster, Client(cluster) as client:
+            yield client.get_executor()
+    else:
+        raise ValueError(f"Unknown scheduler {scheduler}, expected one of {schedulers}")
+
+
+def submit_measured(executor: Executor, func: Callable, args: tuple) -> Future:
+    return executor.submit(run_measured, func, time.time(), *args)
+
+
+def get_task_name(task_names: Optional[Sequence[str]], i: int) -> str:
+    return task_names[i] if task_names is not None else str(i)
+
+
+def collect_result(
+    future: Future,
+    i: int,
+    results: List[Any],
+    errors: List[BaseException],
+    on_task_done: Optional[TaskCallback],
+    task_name: str,
+):
+    error = future.exception()
+    if error is not None:
+        errors.append(error)
+        return
+    results[i], metrics = future.result()
+    written_outputs.update(metrics.pop("outputs", {}))
+    perf_report.add_task(task_name, metrics)
+    if on_task_done is not None:
+        on_task_done(i, results[i])
+
+
+def raise_first_error(errors: List[BaseException], num_tasks: int):
+    if errors:
+        print(len(errors), "of", num_tasks, "tasks failed")
+        raise errors[0]
+
+
+def run_tasks(
+    executor: Executor,
+    func: Callable,
+    tasks_args: Sequence[tuple],
+    on_task_done: Optional[TaskCallback] = None,
+    task_names: Optional[Sequence[str]] = None,
+) -> List[Any]:
+    """
+    Submits all tasks at once and returns their results in submission order.
+    on_task_done is called with the index and result of every successful task
+    as soon as it finishes. If some tasks fail, the other tasks still run
+    to completion and the first error is raised at the end.
+    Measurements of every task are added to the perf_report under task_names.
+    """
+    futures = {
+        submit_measured(executor, func, args): i for i, args in enumerate(tasks_args)
+    }
+    results = [None] * len(futures)
+    errors = []
+    for future in as_completed(futures):
+        i = futures[future]
+        collect_result(
+            future, i, results, errors, on_task_done, get_task_name(task_names, i)
+        )
+    raise_first_error(errors, len(futures))
+    return results
+
+
+def run_tasks_within_budget(
+    executor: Executor,
+    func: Callable,
+    tasks_args: Sequence[tuple],
+    task_sizes: Sequence[int],
+    memory_budget: int,
+    task_costs: Optional[Sequence[int]] = None,
+    on_task_done: Optional[TaskCallback] = None,
+    task_names: Optional[Sequence[str]] = None,
+) -> List[Any]:
+    """
+    Submits tasks starting from the largest ones, only while the sum of
+    estimated memory of running tasks stays under the budget.
+    A task larger than the whole budget runs alone.
+    Tasks are ordered by task_costs, e.g. bytes to process, if given,
+    otherwise by their memory size.
+    Returns results in the order of tasks_args, errors are handled
+    the same way as in run_tasks.
+    """
+    task_costs = task_costs or task_sizes
+    pending = deque(
+        sorted(range(len(tasks_args)), key=lambda i: task_costs[i], reverse=True)
+    )
+    running = dict()
+    used_memory = 0
+    results = [None] * len(tasks_args)
+    errors = []
+    while pending or running:
+        # admit the largest pending tasks that fit into the remaining budget
+        for i in list(pending):
+            if running and used_memory + task_sizes[i] > memory_budget:
+                continue
+            pending.remove(i)
+            running[submit_measured(executor, func, tasks_args[i])] = i
+            used_memory += task_sizes[i]
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            i = running.pop(future)
+            used_memory -= task_sizes[i]
+            collect_result(
+                future, i, results, errors, on_task_done, get_task_name(task_names, i)
+            )
+    raise_first_error(errors, len(tasks_args))
+    return results
+
+
+def schedule_tasks(
+    executor: Executor,
+    func: Callable,
+    tasks_args: Sequence[tuple],
+    task_sizes: Sequence[int],
+    memory_budget: Optional[str] = None,
+    task_costs: Optional[Sequence[int]] = None,
+    on_task_done: Optional[TaskCallback] = None,
+    task_names: Optional[Sequence[str]] = None,
+) -> List[Any]:
+    """Runs tasks within the memory budget if it is set, otherwise all at once"""
+    if memory_budget is None:
+        return run_tasks(executor, func, tasks_args, on_task_done, task_names)
+    budget = parse_size(memory_budget)
+    print(
+        "Scheduling",
+        len(tasks_args),
+        "tasks within memory budget of",
+        budget,
+        "bytes, estimated total",
+        sum(task_sizes),
+        "bytes",
+    )
+    return run_tasks_within_budget(
+        executor,
+        func,
+        tasks_args,
+        task_sizes,
+        budget,
+        task_costs,
+        on_task_done,
+        task_names,
+    )
+
+
+def add_execution_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--scheduler",
+        type=str,
+        choices=schedulers,
+        default="processes",
+        help="backend that runs per image tasks",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=None,
+        help="number of workers, by default derived from available cores and memory",
+    )
+    parser.add_argument(
+        "--memory_per_worker",
+        type=str,
+        default=default_memory_per_worker,
+        help="expected memory use of one worker, e.g. 512M, 4G",
+    )
+    parser.add_argument(
+        "--memory_budget",
+        type=str,
+        default=None,
+        help="limit on estimated memory of concurrently running tasks, e.g. 32G",
+    )
@@ -0,0 +1,81 @@
+import fcntl
+import os
+import shutil
+from pathlib import Path
+from typing import Callable, Dict
+
+from utils import add_perf_counter
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+transfer_methods = ("auto", "reflink", "hardlink", "copy")
+
+
+def reflink_file(src: Path, dst: Path) -> str:
+    """
+    Shares data extents of src with dst on filesystems that support it,
+    e.g. btrfs, XFS. Raises OSError on other filesystems.
+    """
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    return "reflink"
+
+
+def hardlink_file(src: Path, dst: Path) -> str:
+    os.link(src, dst)
+    return "hardlink"
+
+
+def copy_file(src: Path, dst: Path) -> str:
+    """
+    Copies with copy_file_range that lets the kernel copy the data
+    without passing it through user space, falls back to streaming the data
+    where it is not supported, e.g. between filesystems on older kernels
+    """
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        remaining = os.fstat(s.fileno()).st_size
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(s.fileno(), d.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+            if remaining == 0:
+                return "copy_file_range"
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+transfer_functions: Dict[str, Callable[[Path, Path], str]] = {
+    "reflink": reflink_file,
+    "hardlink": hardlink_file,
+    "copy": copy_file,
+}
+
+
+def transfer_file(src: Path, dst: Path, method: str = "auto") -> str:
+    """
+    Transfers src to dst with the given method, with "auto" tries reflink,
+    hardlink and copy in this order until one of them succeeds.
+    The size of dst is checked after every attempt.
+    Returns the name of the method that was used.
+    """
+    if method not in transfer_methods:
+        raise ValueError(f"Unknown transfer method {method}")
+    methods = ["reflink", "hardlink", "copy"] if method == "auto" else [method]
+    src_size = src.stat().st_size
+    error = None
+    for name in methods:
+        try:
+            used_method = transfer_functions[name](src, dst)
+            if dst.stat().st_size != src_size:
+                raise OSError(f"{name} produced {dst} with unexpected size")
+            if used_method in ("copy_file_range", "copy"):
+                add_perf_counter("read_bytes", src_size)
+            return used_method
+        except OSError as e:
+            error = e
+            dst.unlink(missing_ok=True)
+    raise error
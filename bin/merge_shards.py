@@ -0,0 +1,148 @@
+import argparse
+import json
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from file_transfer import transfer_file, transfer_methods
+from output_manifest import OutputManifest
+from utils import make_dir_if_not_exists, path_to_str
+
+
+def merge_dirs(src_dirs: List[Path], out_dir: Path, transfer: str = "auto"):
+    """
+    Combines files of per-shard output directories into one directory.
+    Shards process disjoint regions, so the same file in two shards is an error.
+    """
+    merged_from = dict()
+    for shard_index, src_dir in enumerate(src_dirs):
+        for src in sorted(p for p in src_dir.rglob("*") if p.is_file()):
+            rel_path = src.relative_to(src_dir)
+            if rel_path in merged_from:
+                raise ValueError(
+                    f"{rel_path} is produced by shards {merged_from[rel_path]} "
+                    f"and {shard_index}"
+                )
+            merged_from[rel_path] = shard_index
+            dst = out_dir / rel_path
+            make_dir_if_not_exists(dst.parent)
+            transfer_file(src, dst, transfer)
+    print("Merged", len(merged_from), "files of", len(src_dirs), "shards")
+
+
+def merge_perf_reports(reports: List[dict]) -> dict:
+    """
+    Shards run in parallel, so wall time and peak RSS of the merged report
+    are the maximum over shards, I/O totals are summed.
+    Stages and tasks are kept with the index of their shard.
+    """
+    totals = Counter()
+    stages = []
+    tasks = []
+    for shard_index, report in enumerate(reports):
+        totals.update(report["totals"])
+        stages.extend(dict(shard=shard_index, **stage) for stage in report["stages"])
+        tasks.extend(dict(shard=shard_index, **task) for task in report["tasks"])
+    return dict(
+        script=reports[0]["script"],
+        num_shards=len(reports),
+        wall_time_s=max(report["wall_time_s"] for report in reports),
+        peak_rss_bytes=max(report["peak_rss_bytes"] for report in reports),
+        peak_rss_children_bytes=max(
+            report["peak_rss_children_bytes"] for report in reports
+        ),
+        totals=dict(totals),
+        stages=stages,
+        tasks=tasks,
+    )
+
+
+def merge_perf_report_files(report_paths: List[Path], out_dir: Path):
+    """Writes one {script}_perf_report.json per script that produced the reports"""
+    reports_per_script: Dict[str, List[dict]] = defaultdict(list)
+    for path in report_paths:
+        with open(path, "r") as s:
+            report = json.load(s)
+        reports_per_script[report["script"]].append(report)
+    for script, reports in reports_per_script.items():
+        out_path = out_dir / f"{script}_perf_report.json"
+        with open(out_path, "w") as s:
+            json.dump(merge_perf_reports(reports), s, indent=1)
+        print("Merged", len(reports), script, "reports to", path_to_str(out_path))
+
+
+def merge_output_manifests(manifest_paths: List[Path], out_path: Path):
+    """
+    Files of the shards are transferred unchanged and keep their paths
+    relative to the manifest, so their records are merged as they are
+    """
+    merged = OutputManifest(out_path)
+    merged_from = dict()
+    for shard_index, path in enumerate(manifest_paths):
+        manifest = OutputManifest(path)
+        for rel_path in manifest.files:
+            if rel_path in merged_from:
+                raise ValueError(
+                    f"{rel_path} is listed in manifests of shards "
+                    f"{merged_from[rel_path]} and {shard_index}"
+                )
+            merged_from[rel_path] = shard_index
+        merged.files.update(manifest.files)
+    merged.save()
+    print("Merged", len(manifest_paths), "output manifests to", path_to_str(out_path))
+
+
+def main(
+    pipeline_output_dirs: List[Path],
+    perf_report_paths: List[Path],
+    transfer: str = "auto",
+    output_manifest_paths: Optional[List[Path]] = None,
+    out_dir: Path = Path("/output"),
+):
+    pipeline_out_dir = out_dir / "pipeline_output"
+    make_dir_if_not_exists(pipeline_out_dir)
+    merge_dirs(pipeline_output_dirs, pipeline_out_dir, transfer)
+    merge_perf_report_files(perf_report_paths, out_dir)
+    if output_manifest_paths:
+        merge_output_manifests(output_manifest_paths, out_dir / "manifest.json")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Combines outputs and performance reports of region shards"
+    )
+    parser.add_argument(
+        "--pipeline_output_dirs",
+        type=Path,
+        nargs="+",
+        help="pipeline_output directories of collect_output shards",
+    )
+    parser.add_argument(
+        "--perf_reports",
+        type=Path,
+        nargs="*",
+        default=[],
+        help="perf_report.json files of the shards of any step",
+    )
+    parser.add_argument(
+        "--output_manifests",
+        type=Path,
+        nargs="*",
+        default=[],
+        help="manifest.json files of collect_output shards",
+    )
+    parser.add_argument(
+        "--transfer",
+        type=str,
+        choices=transfer_methods,
+        default="auto",
+        help="how files of the shards are copied to the merged output",
+    )
+    args = parser.parse_args()
+
+    main(
+        args.pipeline_output_dirs,
+        args.perf_reports,
+        args.transfer,
+        args.output_manifests,
+    )
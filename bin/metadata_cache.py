@@ -0,0 +1,289 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import tifffile as tif
+from utils import (
+    add_perf_counter,
+    get_channel_names_from_ome,
+    path_to_str,
+    perf_report,
+    run_measured,
+)
+from utils_ome import strip_namespace
+from utils_tiff import Image, get_czyx_shape, get_page_index
+
+default_max_entries = 100000
+physical_size_attrs = [
+    "PhysicalSizeX",
+    "PhysicalSizeXUnit",
+    "PhysicalSizeY",
+    "PhysicalSizeYUnit",
+    "PhysicalSizeZ",
+    "PhysicalSizeZUnit",
+]
+
+
+@dataclass
+class ImageMeta:
+    """Parsed OME and TIFF header information of a source image"""
+
+    channels: List[Tuple[str, int]]
+    shape: Tuple[int, int, int, int]
+    dtype: str
+    physical_sizes: Dict[str, str]
+    # data offsets of planes in CZ order, None for pages that can't be memory-mapped
+    page_offsets: Optional[List[Optional[int]]] = None
+
+    @property
+    def plane_nbytes(self) -> int:
+        _, _, size_y, size_x = self.shape
+        return size_y * size_x * np.dtype(self.dtype).itemsize
+
+    @property
+    def num_planes(self) -> int:
+        num_channels, num_z, _, _ = self.shape
+        return num_channels * num_z
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, meta_str: str) -> "ImageMeta":
+        meta = json.loads(meta_str)
+        meta["channels"] = [tuple(ch) for ch in meta["channels"]]
+        meta["shape"] = tuple(meta["shape"])
+        return cls(**meta)
+
+
+def get_page_offsets(series: tif.TiffPageSeries) -> List[Optional[int]]:
+    """Walks the IFDs of all planes, that is a seek per page"""
+    page_offsets = []
+    num_channels, num_z, _, _ = get_czyx_shape(series)
+    for c in range(num_channels):
+        for z in range(num_z):
+            page = series.pages[get_page_index(series, c, z)].aspage()
+            page_offsets.append(page.dataoffsets[0] if page.is_memmappable else None)
+    return page_offsets
+
+
+def read_page_offsets(path: Path) -> List[Optional[int]]:
+    with tif.TiffFile(path_to_str(path)) as TF:
+        return get_page_offsets(TF.series[0])
+
+
+def read_image_meta(path: Path, with_page_offsets: bool = False) -> ImageMeta:
+    """Reads OME-XML and TIFF headers, pages are walked only for page offsets"""
+    with tif.TiffFile(path_to_str(path)) as TF:
+        ome_xml = strip_namespace(TF.ome_metadata)
+        series = TF.series[0]
+        shape = get_czyx_shape(series)
+        dtype = np.dtype(TF.byteorder + series.dtype.char).str
+        page_offsets = get_page_offsets(series) if with_page_offsets else None
+    px_node = ome_xml.find("Image").find("Pixels")
+    physical_sizes = {
+        attr: px_node.get(attr)
+        for attr in physical_size_attrs
+        if attr in px_node.attrib
+    }
+    return ImageMeta(
+        channels=get_channel_names_from_ome(ome_xml),
+        shape=shape,
+        dtype=dtype,
+        physical_sizes=physical_sizes,
+        page_offsets=page_offsets,
+    )
+
+
+def read_planes_by_offset(
+    path: Path, meta: ImageMeta, plane_ids: Sequence[int]
+) -> Optional[List[Image]]:
+    """
+    Memory-maps planes at cached offsets without parsing the TIFF file,
+    returns None if some of the planes are not stored contiguously
+    """
+    if meta.page_offsets is None:
+        return None
+    offsets = [meta.page_offsets[i] for i in plane_ids]
+    if any(offset is None for offset in offsets):
+        return None
+    _, _, size_y, size_x = meta.shape
+    add_perf_counter("read_bytes", meta.plane_nbytes * len(offsets))
+    add_perf_counter("decoded_bytes", meta.plane_nbytes * len(offsets))
+    return [
+        np.memmap(
+            path_to_str(path),
+            dtype=np.dtype(meta.dtype),
+            mode="r",
+            offset=offset,
+            shape=(size_y, size_x),
+        )
+        for offset in offsets
+    ]
+
+
+class MetadataCache:
+    """
+    SQLite cache of ImageMeta keyed by the image path relative to the
+    dataset directory, so it stays valid when the dataset is mounted elsewhere.
+    Entries are invalidated when size or mtime of the file change,
+    the least recently used ones are evicted above max_entries.
+    Without a path the cache lives in memory for the current run only.
+    Page offsets are read only by steps that ask for them, entries cached
+    without them are completed by walking the pages, not parsing the headers again.
+    """
+
+    def __init__(
+        self,
+        path: Optional[Path],
+        root: Path,
+        max_entries: int = default_max_entries,
+    ):
+        self.root = root
+        self.max_entries = max_entries
+        self.num_hits = 0
+        self.num_misses = 0
+        if path is None:
+            self.connection = sqlite3.connect(":memory:")
+            self.writable = True
+        elif path.exists() and not os.access(path, os.W_OK):
+            # e.g. a cache staged as a read-only input of a workflow step
+            self.connection = sqlite3.connect(
+                f"file:{path_to_str(path)}?mode=ro", uri=True
+            )
+            self.writable = False
+        else:
+            self.connection = sqlite3.connect(path_to_str(path))
+            self.writable = True
+        if self.writable:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS image_meta ("
+                "key TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                "last_used REAL, meta TEXT)"
+            )
+
+    def __enter__(self) -> "MetadataCache":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_key(self, path: Path) -> str:
+        try:
+            return path.absolute().relative_to(self.root.absolute()).as_posix()
+        except ValueError:
+            return path_to_str(path)
+
+    def lookup(self, path: Path) -> Optional[ImageMeta]:
+        stat = path.stat()
+        row = self.connection.execute(
+            "SELECT meta FROM image_meta WHERE key = ? AND size = ? AND mtime_ns = ?",
+            (self.get_key(path), stat.st_size, stat.st_mtime_ns),
+        ).fetchone()
+        if row is None:
+            return None
+        meta = ImageMeta.from_json(row[0])
+        if self.writable:
+            self.connection.execute(
+                "UPDATE image_meta SET last_used = ? WHERE key = ?",
+                (time.time(), self.get_key(path)),
+            )
+        return meta
+
+    def store(self, path: Path, meta: ImageMeta):
+        if not self.writable:
+            return
+        stat = path.stat()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO image_meta VALUES (?, ?, ?, ?, ?)",
+            (
+                self.get_key(path),
+                stat.st_size,
+                stat.st_mtime_ns,
+                time.time(),
+                meta.to_json(),
+            ),
+        )
+
+    def get_all(
+        self,
+        paths: Sequence[Path],
+        with_page_offsets: bool = False,
+        num_workers: Optional[int] = None,
+    ) -> List[ImageMeta]:
+        """
+        Returns metadata of all images, headers of missing ones
+        and missing page offsets of cached ones are read in threads
+        """
+        metas = [self.lookup(path) for path in paths]
+        missing = [i for i, meta in enumerate(metas) if meta is None]
+        missing_offsets = [
+            i
+            for i, meta in enumerate(metas)
+            if with_page_offsets and meta is not None and meta.page_offsets is None
+        ]
+        self.num_hits += len(paths) - len(missing)
+        self.num_misses += len(missing)
+        if missing or missing_offsets:
+            submit_time = time.time()
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                results = executor.map(
+                    lambda i: run_measured(
+                        read_image_meta, submit_time, paths[i], with_page_offsets
+                    ),
+                    missing,
+                )
+                offset_results = executor.map(
+                    lambda i: run_measured(read_page_offsets, submit_time, paths[i]),
+                    missing_offsets,
+                )
+                for i, (meta, metrics) in zip(missing, results):
+                    perf_report.add_task(
+                        "read header " + self.get_key(paths[i]), metrics
+                    )
+                    self.store(paths[i], meta)
+                    metas[i] = meta
+                for i, (page_offsets, metrics) in zip(missing_offsets, offset_results):
+                    perf_report.add_task(
+                        "read page offsets " + self.get_key(paths[i]), metrics
+                    )
+                    metas[i].page_offsets = page_offsets
+                    self.store(paths[i], metas[i])
+        return metas
+
+    def evict(self):
+        """Keeps only max_entries most recently used entries"""
+        self.connection.execute(
+            "DELETE FROM image_meta WHERE key NOT IN "
+            "(SELECT key FROM image_meta ORDER BY last_used DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+
+    def close(self):
+        print("Metadata cache:", self.num_hits, "hits,", self.num_misses, "misses")
+        if self.writable:
+            self.evict()
+            self.connection.commit()
+        self.connection.close()
+
+
+def add_metadata_cache_args(parser: argparse.ArgumentParser, default: Optional[Path]):
+    parser.add_argument(
+        "--metadata_cache",
+        type=Path,
+        default=default,
+        help="path to SQLite cache of parsed image headers",
+    )
+    parser.add_argument(
+        "--metadata_cache_entries",
+        type=int,
+        default=default_max_entries,
+        help="number of images kept in the metadata cache",
+    )
@@ -0,0 +1,454 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Set
+
+import numpy as np
+import tifffile as tif
+from run_manifest import atomic_output, get_path_identity
+from utils import add_perf_counter, add_task_output, path_to_str, written_outputs
+from utils_tiff import get_czyx_shape
+
+# described in README, so that outputs can be checked without the pipeline
+checksum_scheme = "sha256-blocks"
+checksum_block_size = 1024 * 1024
+# blocks kept in memory while they are written, patches of recent IFDs go there
+checksum_buffered_blocks = 4
+# checksums of outputs that are being written, by temporary path
+_output_checksums: Dict[str, "OutputChecksum"] = dict()
+_output_checksums_lock = threading.Lock()
+
+
+def hash_blocks(s: BinaryIO) -> List[bytes]:
+    digests = []
+    while block := s.read(checksum_block_size):
+        digests.append(hashlib.sha256(block).digest())
+    return digests
+
+
+def combine_digests(digests: List[bytes]) -> str:
+    return hashlib.sha256(b"".join(digests)).hexdigest()
+
+
+def checksum_bytes(data: bytes) -> str:
+    return combine_digests(hash_blocks(io.BytesIO(data)))
+
+
+def checksum_file(path: Path) -> str:
+    with open(path, "rb") as s:
+        return combine_digests(hash_blocks(s))
+
+
+def checksum_dir(file_checksums: Dict[str, str]) -> str:
+    """Checksum of a directory from checksums of its files by relative path"""
+    sha = hashlib.sha256()
+    for rel_path, checksum in sorted(file_checksums.items()):
+        sha.update(f"{rel_path}\0{checksum}\n".encode("utf-8"))
+    return sha.hexdigest()
+
+
+def list_dir_files(path: Path) -> List[str]:
+    return [
+        Path(os.path.relpath(os.path.join(dir_path, name), path)).as_posix()
+        for dir_path, _, names in os.walk(path)
+        for name in names
+    ]
+
+
+class WrittenBlock:
+    """Bytes of a block of a file and the ranges of it that were written"""
+
+    def __init__(self):
+        self.data = bytearray()
+        # sorted disjoint [start, end) ranges
+        self.ranges: List[List[int]] = []
+
+    def write(self, start: int, data: memoryview):
+        end = start + len(data)
+        if start > len(self.data):
+            self.data.extend(bytes(start - len(self.data)))
+        self.data[start:end] = data
+        if self.ranges and self.ranges[-1][1] == start:
+            # sequential write, the common case
+            self.ranges[-1][1] = end
+            return
+        ranges = []
+        for range_start, range_end in self.ranges:
+            if range_end < start or range_start > end:
+                ranges.append([range_start, range_end])
+            else:
+                start, end = min(start, range_start), max(end, range_end)
+        ranges.append([start, end])
+        self.ranges = sorted(ranges)
+
+    def get_digest(self, size: int) -> Optional[bytes]:
+        """Digest of the block if all its size bytes were written"""
+        if self.ranges == [[0, size]] and len(self.data) == size:
+            return hashlib.sha256(self.data).digest()
+        return None
+
+
+class OutputChecksum:
+    """
+    Checksum of an output accumulated from the bytes as they are written.
+    Files are hashed in blocks and the checksum is SHA-256 of the block
+    digests. TiffWriter seeks back to write IFDs and patch their offsets,
+    so the last blocks are kept in memory and hashed only when they leave it.
+    Blocks changed after that are read back from the file at the end.
+    Files of directory outputs, e.g. OME-Zarr, are hashed one by one.
+    """
+
+    def __init__(self):
+        self.digests: Dict[int, bytes] = dict()
+        # blocks that are being written, in the order they were started
+        self.blocks: Dict[int, WrittenBlock] = dict()
+        self.stale: Set[int] = set()
+        self.files: Dict[str, str] = dict()
+        # size of the file, seeking past it leaves zeros
+        self.size = 0
+
+    def start_file(self, size: int):
+        """Called when the file is opened, with its size after opening"""
+        if size < self.size:
+            self.digests.clear()
+            self.blocks.clear()
+            self.stale.clear()
+        self.size = size
+
+    def update(self, offset: int, data: bytes):
+        """Adds bytes written at offset of the file"""
+        while self.size < offset:
+            self.update(self.size, bytes(min(offset - self.size, checksum_block_size)))
+        data = memoryview(data).cast("B")
+        self.size = max(self.size, offset + len(data))
+        while len(data):
+            block, start = divmod(offset, checksum_block_size)
+            size = min(len(data), checksum_block_size - start)
+            self.update_block(block, start, data[:size])
+            offset += size
+            data = data[size:]
+
+    def update_block(self, block: int, start: int, data: memoryview):
+        if block in self.stale:
+            return
+        if block in self.digests:
+            # hashed bytes are overwritten, the block is read later
+            self.stale.add(block)
+            del self.digests[block]
+            return
+        if len(data) == checksum_block_size and block not in self.blocks:
+            # pixels of large pages fill whole blocks with one write
+            self.digests[block] = hashlib.sha256(data).digest()
+            return
+        if block not in self.blocks:
+            self.blocks[block] = WrittenBlock()
+            self.hash_old_blocks()
+        self.blocks[block].write(start, data)
+
+    def hash_old_blocks(self):
+        while len(self.blocks) > checksum_buffered_blocks:
+            # the first block has the header and the first IFD, that can be
+            # patched after all pixels are written, so it is hashed last
+            block = next(block for block in self.blocks if block != 0)
+            digest = self.blocks.pop(block).get_digest(checksum_block_size)
+            if digest is not None:
+                self.digests[block] = digest
+            else:
+                self.stale.add(block)
+
+    def update_file(self, rel_path: str, data: bytes):
+        """Adds a whole file of a directory output"""
+        self.files[rel_path] = checksum_bytes(data)
+
+    def get_block_digest(self, block: int, size: int) -> Optional[bytes]:
+        if block in self.blocks:
+            return self.blocks[block].get_digest(size)
+        if size == checksum_block_size:
+            return self.digests.get(block)
+        return None
+
+    def finish_file(self, path: Path) -> str:
+        size = path.stat().st_size
+        digests = []
+        with open(path, "rb") as s:
+            for block in range(-(-size // checksum_block_size)):
+                offset = block * checksum_block_size
+                block_size = min(checksum_block_size, size - offset)
+                digest = self.get_block_digest(block, block_size)
+                if digest is None:
+                    s.seek(offset)
+                    digest = hashlib.sha256(s.read(block_size)).digest()
+                    add_perf_counter("checksum_read_bytes", block_size)
+                digests.append(digest)
+        return combine_digests(digests)
+
+    def finish_dir(self, path: Path) -> str:
+        file_checksums = dict()
+        for rel_path in list_dir_files(path):
+            checksum = self.files.get(rel_path)
+            if checksum is None:
+                checksum = checksum_file(path / rel_path)
+                add_perf_counter(
+                    "checksum_read_bytes", (path / rel_path).stat().st_size
+                )
+            file_checksums[rel_path] = checksum
+        return checksum_dir(file_checksums)
+
+    def finish(self, path: Path) -> str:
+        """Checksum of the written output, reads only what was not hashed"""
+        if path.is_dir():
+            return self.finish_dir(path)
+        return self.finish_file(path)
+
+
+def get_output_checksum(path: Path) -> Optional[OutputChecksum]:
+    """Checksum of the output that is written to path, None if it is not recorded"""
+    with _output_checksums_lock:
+        return _output_checksums.get(path_to_str(path))
+
+
+class ChecksumFile(io.RawIOBase):
+    """
+    Binary file that adds written bytes to a checksum. It has no file
+    descriptor, so tifffile writes numpy arrays with write as well.
+    """
+
+    def __init__(self, path: Path, checksum: OutputChecksum, mode: str = "wb"):
+        super().__init__()
+        self.file = open(path, mode)
+        self.checksum = checksum
+        self.checksum.start_file(os.fstat(self.file.fileno()).st_size)
+        self.name = path_to_str(path)
+
+    def readable(self) -> bool:
+        return self.file.readable()
+
+    def writable(self) -> bool:
+        return self.file.writable()
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        return self.file.readinto(buffer)
+
+    def write(self, data) -> int:
+        offset = self.file.tell()
+        size = self.file.write(data)
+        self.checksum.update(offset, data)
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self.file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if not self.closed:
+            try:
+                super().close()
+            finally:
+                self.file.close()
+
+
+@contextmanager
+def open_output_file(path: Path, mode: str = "wb") -> Iterator[BinaryIO]:
+    """
+    Opens a file for TiffWriter. If the output is recorded,
+    written bytes are added to its checksum as they are written.
+    """
+    checksum = get_output_checksum(path)
+    s = open(path, mode) if checksum is None else ChecksumFile(path, checksum, mode)
+    try:
+        yield s
+    finally:
+        s.close()
+
+
+def read_zarr_info(path: Path) -> Dict[str, Any]:
+    with open(path / ".zattrs", "r") as s:
+        datasets = json.load(s)["multiscales"][0]["datasets"]
+    with open(path / datasets[0]["path"] / ".zarray", "r") as s:
+        array = json.load(s)
+    return dict(
+        format="ome-zarr",
+        shape=array["shape"],
+        dtype=np.dtype(array["dtype"]).name,
+        channels=array["shape"][0],
+        levels=len(datasets),
+    )
+
+
+def read_image_info(path: Path) -> Dict[str, Any]:
+    """Shape in CZYX order, dtype, channel and page count from headers only"""
+    if path.is_dir():
+        return read_zarr_info(path)
+    with tif.TiffFile(path_to_str(path)) as TF:
+        series = TF.series[0]
+        shape = get_czyx_shape(series)
+        return dict(
+            format="ome-tiff" if TF.is_ome else "tiff",
+            shape=list(shape),
+            dtype=series.dtype.name,
+            channels=shape[0],
+            pages=len(TF.pages),
+        )
+
+
+def describe_output(
+    path: Path, checksum: Optional[OutputChecksum] = None
+) -> Dict[str, Any]:
+    """Record of the output in the manifest, pixels are not decoded"""
+    checksum = checksum or OutputChecksum()
+    record = dict(size=get_path_identity(path)["size"], checksum=checksum.finish(path))
+    record.update(read_image_info(path))
+    return record
+
+
+@contextmanager
+def recorded_output(dst: Path) -> Iterator[Path]:
+    """
+    Same as atomic_output, also records size, checksum and image info of
+    the output for the output manifest. Files opened with open_output_file
+    and OME-Zarr images are hashed while they are written, other outputs,
+    e.g. transferred files, are read once to compute the checksum.
+    """
+    with atomic_output(dst) as tmp_path:
+        key = path_to_str(tmp_path)
+        with _output_checksums_lock:
+            _output_checksums[key] = OutputChecksum()
+        try:
+            yield tmp_path
+            record = describe_output(tmp_path, _output_checksums[key])
+        finally:
+            with _output_checksums_lock:
+                del _output_checksums[key]
+    add_task_output(path_to_str(dst), record)
+
+
+class OutputManifest:
+    """
+    Size, checksum, shape, dtype, channel and page count of every output.
+    Paths are relative to the directory of the manifest, so outputs can be
+    verified after the directory is moved.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.root = path.absolute().parent
+        self.files: Dict[str, Dict[str, Any]] = dict()
+        if path.exists():
+            with open(path, "r") as s:
+                manifest = json.load(s)
+            if manifest["checksum"] == self.get_checksum_info():
+                self.files = manifest["files"]
+
+    @staticmethod
+    def get_checksum_info() -> Dict[str, Any]:
+        return dict(scheme=checksum_scheme, block_size=checksum_block_size)
+
+    def add(self, outputs: Dict[str, Dict[str, Any]]):
+        """Adds records of outputs by their absolute paths"""
+        for path, record in outputs.items():
+            self.files[Path(os.path.relpath(path, self.root)).as_posix()] = record
+
+    def save(self):
+        # outputs of previous runs are kept while they exist
+        files = {
+            rel_path: record
+            for rel_path, record in sorted(self.files.items())
+            if (self.root / rel_path).exists()
+        }
+        with atomic_output(self.path) as tmp_path:
+            with open(tmp_path, "w") as s:
+                json.dump(
+                    dict(checksum=self.get_checksum_info(), files=files), s, indent=1
+                )
+
+
+@contextmanager
+def save_output_manifest_on_exit(path: Optional[Path]) -> Iterator[None]:
+    """Adds outputs written during the run to the manifest, also when the run fails"""
+    try:
+        yield
+    finally:
+        if path is not None and written_outputs:
+            manifest = OutputManifest(path)
+            manifest.add(written_outputs)
+            manifest.save()
+            print("Output manifest of", len(manifest.files), "outputs saved to", path)
+
+
+def verify_output(path: Path, record: Dict[str, Any]) -> List[str]:
+    """
+    Returns differences of the output from its record. Size and headers are
+    checked first, the checksum is computed only if they match.
+    """
+    if not path.exists():
+        return ["missing"]
+    size = get_path_identity(path)["size"]
+    if size != record["size"]:
+        return [f"size {size} != {record['size']}"]
+    info = read_image_info(path)
+    errors = [
+        f"{key} {info.get(key)} != {value}"
+        for key, value in record.items()
+        if key not in ("size", "checksum") and info.get(key) != value
+    ]
+    if errors:
+        return errors
+    checksum = OutputChecksum().finish(path)
+    if checksum != record["checksum"]:
+        return [f"checksum {checksum} != {record['checksum']}"]
+    return []
+
+
+def verify_output_manifest(path: Path, num_workers: Optional[int] = None):
+    """Checks all outputs of the manifest, files are hashed in threads"""
+    manifest = OutputManifest(path)
+    if not path.exists() or not manifest.files:
+        raise ValueError(f"Output manifest {path} does not list any outputs")
+    rel_paths = list(manifest.files)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        results = executor.map(
+            lambda rel_path: verify_output(
+                manifest.root / rel_path, manifest.files[rel_path]
+            ),
+            rel_paths,
+        )
+        num_failed = 0
+        for rel_path, errors in zip(rel_paths, results):
+            if errors:
+                num_failed += 1
+                print(rel_path, "|", ", ".join(errors))
+    if num_failed:
+        raise ValueError(
+            f"{num_failed} of {len(rel_paths)} outputs do not match manifest {path}"
+        )
+    print("Verified", len(rel_paths), "outputs of", path)
+
+
+def add_output_manifest_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--output_manifest",
+        type=Path,
+        default=Path("/output/manifest.json"),
+        help="path to JSON manifest with size, checksum, shape, dtype, "
+        "channel and page count of every written image",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="check outputs listed in the output manifest against their headers "
+        "and checksums without decoding pixels, then exit",
+    )
@@ -1,15 +1,72 @@
 import argparse
+import sys
+from concurrent.futures import Executor
+from contextlib import contextmanager
+from dataclasses import asdict
+from itertools import groupby
 from pathlib import Path
-from typing import Dict, List
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
-import dask
+import numpy as np
 import tifffile as tif
+from collect_output import ExprOutputOptions, add_expr_output_args, save_expr_img
+from execution import (
+    ExecutionOptions,
+    add_execution_args,
+    get_executor,
+    get_num_workers,
+    schedule_tasks,
+)
+from metadata_cache import (
+    ImageMeta,
+    MetadataCache,
+    add_metadata_cache_args,
+    default_max_entries,
+    read_planes_by_offset,
+)
+from output_manifest import (
+    add_output_manifest_args,
+    open_output_file,
+    recorded_output,
+    save_output_manifest_on_exit,
+    verify_output_manifest,
+)
+from run_manifest import ResumeOptions, RunManifest, add_resume_args
+from sharding import ShardOptions, add_shard_args, select_shard
+from task_planner import (
+    PlanOptions,
+    add_plan_args,
+    check_plan,
+    estimate_expr_task,
+    estimate_segm_channels_task,
+    plan_segm_channels_tasks,
+    print_plan,
+)
+from tiling import (
+    Tile,
+    TiledImages,
+    TilingOptions,
+    add_tiling_args,
+    get_tiles,
+    save_tile_manifest,
+)
 from utils import (
+    add_perf_report_args,
+    build_source_index,
     get_img_subdir,
     make_dir_if_not_exists,
-    path_to_str,
     path_to_str_local,
+    perf_report,
     read_pipeline_config,
+    save_perf_report_on_exit,
+)
+from utils_tiff import (
+    Image,
+    TiffEncoding,
+    add_encoding_args,
+    iter_channels,
+    open_channels,
+    prefetch_planes,
 )
 
 
@@ -32,14 +89,106 @@ def change_vals_to_keys(input_dict: dict) -> dict:
     return vals_to_keys
 
 
-def extract_segm_channels(path: Path, segm_ch_ids: Dict[str, int]):
-    stack = tif.imread(path_to_str(path))
-    if len(stack.shape) < 3:
-        raise ValueError("Input image is not multichannel")
-    segm_channels = dict()
-    for ch_name, _id in segm_ch_ids.items():
-        segm_channels[ch_name] = stack[_id, ...]
-    return segm_channels
+def read_segm_channels_by_offset(
+    path: Path, segm_ch_ids: Dict[str, int], img_meta: Optional[ImageMeta] = None
+) -> Optional[List[Image]]:
+    if img_meta is None:
+        return None
+    num_z = img_meta.shape[1]
+    return read_planes_by_offset(
+        path, img_meta, [ch_id * num_z for ch_id in segm_ch_ids.values()]
+    )
+
+
+def extract_segm_channels(
+    path: Path,
+    segm_ch_ids: Dict[str, int],
+    img_meta: Optional[ImageMeta] = None,
+    prefetch_depth: int = 0,
+) -> Iterator[Tuple[str, Image]]:
+    # decode only the pages of segmentation channels, not the whole stack
+    planes = read_segm_channels_by_offset(path, segm_ch_ids, img_meta)
+    if planes is None:
+        planes = iter_channels(path, segm_ch_ids.values())
+    return zip(segm_ch_ids, prefetch_planes(iter(planes), prefetch_depth))
+
+
+@contextmanager
+def open_segm_channels(
+    path: Path, segm_ch_ids: Dict[str, int], img_meta: Optional[ImageMeta] = None
+) -> Iterator[List[Tuple[str, Any]]]:
+    """Views of segmentation channels that decode only the sliced rows"""
+    planes = read_segm_channels_by_offset(path, segm_ch_ids, img_meta)
+    if planes is not None:
+        yield list(zip(segm_ch_ids, planes))
+        return
+    with open_channels(path, segm_ch_ids.values()) as planes:
+        yield list(zip(segm_ch_ids, planes))
+
+
+def get_segm_channel_path(
+    dirs_per_region: Dict[int, Path],
+    img_slice_name: str,
+    region: int,
+    segm_ch_type: str,
+) -> Path:
+    new_name_template = "reg{region:03d}_{slice_name}_{segm_ch_type}.tif"
+    new_name = new_name_template.format(
+        region=region, slice_name=img_slice_name, segm_ch_type=segm_ch_type
+    )
+    return dirs_per_region[region] / new_name
+
+
+def save_segm_channel(
+    dirs_per_region: Dict[int, Path],
+    img_slice_name: str,
+    region: int,
+    segm_ch_type: str,
+    ch_name: str,
+    img: Image,
+    encoding: TiffEncoding,
+):
+    dst = get_segm_channel_path(dirs_per_region, img_slice_name, region, segm_ch_type)
+    with recorded_output(dst) as tmp_dst, open_output_file(tmp_dst) as s:
+        tif.imwrite(s, img, **encoding.get_write_kwargs())
+    print("region:", region, "| channel:", ch_name, "| new_location:", dst)
+
+
+def save_segm_channel_tiles(
+    dirs_per_region: Dict[int, Path],
+    region: int,
+    segm_ch_type: str,
+    ch_name: str,
+    img: Any,
+    tiles: List[Tile],
+    encoding: TiffEncoding,
+):
+    """
+    Saves every tile as a separate image. Tiles are cut from one row of tiles
+    at a time, so only these rows of the source page are decoded at once.
+    """
+    for (y, height), row_tiles in groupby(tiles, key=lambda t: (t.y, t.height)):
+        rows = np.asarray(img[y : y + height])
+        for tile in row_tiles:
+            dst = get_segm_channel_path(
+                dirs_per_region, tile.name, region, segm_ch_type
+            )
+            with recorded_output(dst) as tmp_dst, open_output_file(tmp_dst) as s:
+                tif.imwrite(
+                    s,
+                    rows[:, tile.x : tile.x + tile.width],
+                    **encoding.get_write_kwargs(),
+                )
+    print(
+        "region:",
+        region,
+        "| channel:",
+        ch_name,
+        "| tiles:",
+        len(tiles),
+        "| new_location:",
+        dirs_per_region[region],
+    )
 
 
 def copy_channels(
@@ -49,17 +198,107 @@ def copy_channels(
     region: int,
     segm_ch_index: int,
     segmentation_channel_ids: Dict[str, int],
+    encoding: Optional[TiffEncoding] = None,
+    img_meta: Optional[ImageMeta] = None,
+    tiles: Optional[List[Tile]] = None,
 ):
-    new_name_template = "reg{region:03d}_{slice_name}_{segm_ch_type}.tif"
-    segm_channels = extract_segm_channels(img_path, segmentation_channel_ids)
-    for ch_name, img in segm_channels.items():
-        segm_ch_type = segm_ch_index[ch_name]
-        new_name = new_name_template.format(
-            region=region, slice_name=img_slice_name, segm_ch_type=segm_ch_type
+    encoding = encoding or TiffEncoding()
+    if tiles is not None:
+        with open_segm_channels(
+            img_path, segmentation_channel_ids, img_meta
+        ) as segm_channels:
+            for ch_name, img in segm_channels:
+                save_segm_channel_tiles(
+                    dirs_per_region,
+                    region,
+                    segm_ch_index[ch_name],
+                    ch_name,
+                    img,
+                    tiles,
+                    encoding,
+                )
+        return
+    segm_channels = extract_segm_channels(
+        img_path, segmentation_channel_ids, img_meta, encoding.prefetch_depth
+    )
+    for ch_name, img in segm_channels:
+        save_segm_channel(
+            dirs_per_region,
+            img_slice_name,
+            region,
+            segm_ch_index[ch_name],
+            ch_name,
+            img,
+            encoding,
+        )
+
+
+def get_expr_path(
+    expr_out_dir: Path,
+    img_slice_name: str,
+    region: int,
+    expr_options: ExprOutputOptions,
+) -> Path:
+    return expr_out_dir / expr_options.out_name_template.format(
+        region=region, slice_name=img_slice_name
+    )
+
+
+def ingest_img(
+    dirs_per_region: Dict[int, Path],
+    img_path: Path,
+    img_slice_name: str,
+    region: int,
+    segm_ch_index: int,
+    segmentation_channel_ids: Dict[str, int],
+    encoding: Optional[TiffEncoding],
+    expr_out_dir: Path,
+    segmentation_channels: Dict[str, str],
+    expr_options: ExprOutputOptions,
+    tiles: Optional[List[Tile]] = None,
+):
+    """
+    Reads the source image once: every plane is written to the expression
+    output and planes of segmentation channels are also saved for segmentation
+    """
+    encoding = encoding or TiffEncoding()
+    ch_ids_to_names = change_vals_to_keys(segmentation_channel_ids)
+
+    def save_if_segm_channel(c: int, z: int, plane: Image):
+        if z == 0 and c in ch_ids_to_names:
+            ch_name = ch_ids_to_names[c]
+            if tiles is not None:
+                save_segm_channel_tiles(
+                    dirs_per_region,
+                    region,
+                    segm_ch_index[ch_name],
+                    ch_name,
+                    plane,
+                    tiles,
+                    encoding,
+                )
+                return
+            save_segm_channel(
+                dirs_per_region,
+                img_slice_name,
+                region,
+                segm_ch_index[ch_name],
+                ch_name,
+                plane,
+                encoding,
+            )
+
+    dst = get_expr_path(expr_out_dir, img_slice_name, region, expr_options)
+    with recorded_output(dst) as tmp_dst:
+        save_expr_img(
+            img_path,
+            tmp_dst,
+            segmentation_channels=segmentation_channels,
+            encoding=encoding,
+            plane_callback=save_if_segm_channel,
+            **expr_options.get_save_kwargs(),
         )
-        dst = dirs_per_region[region] / new_name
-        tif.imwrite(dst, img)
-        print("region:", region, "| channel:", ch_name, "| new_location:", dst)
+    print("region:", region, "| src:", img_path, "| dst:", dst)
 
 
 def copy_segm_channels_to_out_dirs(
@@ -68,43 +307,244 @@ def copy_segm_channels_to_out_dirs(
     segmentation_channels: Dict[str, str],
     segmentation_channel_ids: Dict[str, int],
     dirs_per_region: Dict[int, Path],
-):
+    executor: Executor,
+    manifest: RunManifest,
+    metadata_cache: MetadataCache,
+    memory_budget: Optional[str] = None,
+    encoding: Optional[TiffEncoding] = None,
+    expr_out_dir: Optional[Path] = None,
+    expr_options: Optional[ExprOutputOptions] = None,
+    segmentation_channel_ids_per_image: Optional[Dict] = None,
+    tiling: Optional[TilingOptions] = None,
+) -> TiledImages:
+    """
+    With expr_out_dir set, runs in the ingest mode that also writes
+    expressions from the same read of the source images.
+    segmentation_channel_ids_per_image overrides channel ids of images
+    with a different channel order.
+    With tiling enabled, segmentation channels are saved as tiles,
+    returns the tiles of every image.
+    """
+    ids_per_image = segmentation_channel_ids_per_image or dict()
+    ingest = expr_out_dir is not None
+    expr_options = expr_options or ExprOutputOptions()
+    tiling = tiling or TilingOptions()
     tasks = []
+    task_outputs = []
+    task_estimates = []
     segm_ch_index = change_vals_to_keys(segmentation_channels)
-    for region, slices in listing.items():
-        for img_slice_name, path in slices.items():
-            img_path = data_dir / path
-            task = dask.delayed(copy_channels)(
-                dirs_per_region,
-                img_path,
-                img_slice_name,
-                region,
-                segm_ch_index,
-                segmentation_channel_ids,
+    src_index = build_source_index(data_dir, listing)
+    tiled_images: TiledImages = dict()
+    if tiling.is_enabled:
+        # tile outputs depend on image sizes, so headers of all images are read
+        images = [
+            (region, img_slice_name)
+            for region, slices in listing.items()
+            for img_slice_name in slices
+        ]
+        all_img_metas = metadata_cache.get_all(
+            [src_index[image] for image in images], with_page_offsets=not ingest
+        )
+        for (region, img_slice_name), img_meta in zip(images, all_img_metas):
+            _, _, size_y, size_x = img_meta.shape
+            tiled_images.setdefault(region, dict())[img_slice_name] = (
+                (size_y, size_x),
+                get_tiles(img_slice_name, size_y, size_x, tiling),
             )
-            tasks.append(task)
-    dask.compute(*tasks)
+    num_skipped = 0
+    pending = []
+    for region, slices in listing.items():
+        for img_slice_name in slices:
+            img_path = src_index[(region, img_slice_name)]
+            out_names = [img_slice_name]
+            if tiling.is_enabled:
+                out_names = [
+                    tile.name for tile in tiled_images[region][img_slice_name][1]
+                ]
+            outputs = [
+                get_segm_channel_path(
+                    dirs_per_region, out_name, region, segm_ch_index[ch_name]
+                )
+                for ch_name in segmentation_channel_ids
+                for out_name in out_names
+            ]
+            if ingest:
+                outputs.append(
+                    get_expr_path(expr_out_dir, img_slice_name, region, expr_options)
+                )
+            if manifest.is_up_to_date(outputs, [img_path]):
+                num_skipped += 1
+                continue
+            pending.append((region, img_slice_name, img_path, outputs))
+
+    # page offsets let segmentation channels be read without parsing the file
+    img_metas = metadata_cache.get_all(
+        [img_path for _, _, img_path, _ in pending], with_page_offsets=not ingest
+    )
+    for (region, img_slice_name, img_path, outputs), img_meta in zip(
+        pending, img_metas
+    ):
+        img_segm_ch_ids = ids_per_image.get(region, dict()).get(
+            img_slice_name, segmentation_channel_ids
+        )
+        task = (
+            dirs_per_region,
+            img_path,
+            img_slice_name,
+            region,
+            segm_ch_index,
+            img_segm_ch_ids,
+            encoding,
+        )
+        if ingest:
+            task += (expr_out_dir, segmentation_channels, expr_options)
+        else:
+            task += (img_meta,)
+        if tiling.is_enabled:
+            task += (tiled_images[region][img_slice_name][1],)
+        tasks.append(task)
+        task_outputs.append((outputs, img_path))
+        if memory_budget is not None:
+            if ingest:
+                estimate = estimate_expr_task([img_meta], streaming=True)
+            else:
+                estimate = estimate_segm_channels_task(
+                    img_meta, len(segmentation_channel_ids)
+                )
+            task_estimates.append(estimate)
+    task_sizes = [size for size, _ in task_estimates]
+    task_costs = [cost for _, cost in task_estimates]
+    if num_skipped:
+        print("Skipping", num_skipped, "images with up to date outputs")
 
+    def record_task(i: int, _):
+        outputs, img_path = task_outputs[i]
+        manifest.record(outputs, [img_path])
 
-def main(data_dir: Path, pipeline_config_path: Path):
-    data_dir = get_img_subdir(data_dir)
-    pipeline_config = read_pipeline_config(pipeline_config_path)
+    task_func = ingest_img if ingest else copy_channels
+    try:
+        schedule_tasks(
+            executor,
+            task_func,
+            tasks,
+            task_sizes,
+            memory_budget,
+            task_costs,
+            on_task_done=record_task,
+            task_names=[
+                f"region {region} {img_slice_name}"
+                for region, img_slice_name, _, _ in pending
+            ],
+        )
+    finally:
+        manifest.save()
+    return tiled_images
 
-    segm_ch_out_dir = Path("/output") / "segmentation_channels"
-    make_dir_if_not_exists(segm_ch_out_dir)
 
-    listing = pipeline_config["dataset_map_all_slices"]
+def main(
+    data_dir: Path,
+    pipeline_config_path: Path,
+    execution: Optional[ExecutionOptions] = None,
+    encoding: Optional[TiffEncoding] = None,
+    ingest: bool = False,
+    expr_options: Optional[ExprOutputOptions] = None,
+    resume: Optional[ResumeOptions] = None,
+    metadata_cache_path: Optional[Path] = None,
+    metadata_cache_entries: int = default_max_entries,
+    shard: Optional[ShardOptions] = None,
+    tiling: Optional[TilingOptions] = None,
+    plan: Optional[PlanOptions] = None,
+    out_dir: Path = Path("/output"),
+):
+    execution = execution or ExecutionOptions()
+    encoding = encoding or TiffEncoding()
+    expr_options = expr_options or ExprOutputOptions()
+    resume = resume or ResumeOptions()
+    shard = shard or ShardOptions()
+    tiling = tiling or TilingOptions()
+    plan = plan or PlanOptions()
+    if ingest and not expr_options.streaming:
+        raise ValueError("Ingest mode requires streaming rewrite mode")
+    expr_options.validate(encoding)
+    tiling.validate()
+    data_dir = get_img_subdir(data_dir)
+    pipeline_config = read_pipeline_config(pipeline_config_path)
+    listing = select_shard(data_dir, pipeline_config["dataset_map_all_slices"], shard)
 
     segm_ch = pipeline_config["segmentation_channels"]
     segm_ch_ids = pipeline_config["segmentation_channel_ids"]
+    segm_ch_ids_per_image = pipeline_config.get("segmentation_channel_ids_per_image")
 
-    dask.config.set({"num_workers": 5, "scheduler": "processes"})
+    if plan.plan or plan.max_task_memory is not None:
+        img_paths = build_source_index(data_dir, listing)
+        with MetadataCache(
+            metadata_cache_path, data_dir, metadata_cache_entries
+        ) as metadata_cache:
+            img_metas = metadata_cache.get_all(list(img_paths.values()))
+        tasks = plan_segm_channels_tasks(
+            img_paths,
+            dict(zip(img_paths, img_metas)),
+            len(segm_ch_ids),
+            ingest,
+            encoding.prefetch_depth,
+        )
+        if plan.plan:
+            print_plan(
+                "prepare_segmentation_channels",
+                tasks,
+                get_num_workers(execution),
+                plan,
+            )
+        check_plan(tasks, plan)
+        if plan.plan:
+            return
+
+    segm_ch_out_dir = out_dir / "segmentation_channels"
+    make_dir_if_not_exists(segm_ch_out_dir)
 
     segm_ch_dirs_per_region = create_dirs_per_region(listing, segm_ch_out_dir)
 
-    copy_segm_channels_to_out_dirs(
-        data_dir, listing, segm_ch, segm_ch_ids, segm_ch_dirs_per_region
+    expr_out_dir = None
+    if ingest:
+        expr_out_dir = out_dir / "expr"
+        make_dir_if_not_exists(expr_out_dir)
+
+    manifest_config = dict(
+        step="segmentation_channels",
+        segmentation_channels=segm_ch,
+        segmentation_channel_ids=segm_ch_ids,
+        segmentation_channel_ids_per_image=segm_ch_ids_per_image,
+        encoding=encoding.get_output_config(),
     )
+    if ingest:
+        manifest_config["expr_options"] = asdict(expr_options)
+    if tiling.is_enabled:
+        manifest_config["tiling"] = asdict(tiling)
+    manifest = resume.open_manifest(out_dir / "run_manifest.json", manifest_config)
+
+    with perf_report.stage("copy_segm_channels"), get_executor(
+        execution
+    ) as executor, MetadataCache(
+        metadata_cache_path, data_dir, metadata_cache_entries
+    ) as metadata_cache:
+        tiled_images = copy_segm_channels_to_out_dirs(
+            data_dir,
+            listing,
+            segm_ch,
+            segm_ch_ids,
+            segm_ch_dirs_per_region,
+            executor,
+            manifest,
+            metadata_cache,
+            execution.memory_budget,
+            encoding,
+            expr_out_dir,
+            expr_options,
+            segm_ch_ids_per_image,
+            tiling,
+        )
+    if tiling.is_enabled:
+        save_tile_manifest(out_dir / "tile_manifest.json", tiling, tiled_images)
 
 
 if __name__ == "__main__":
@@ -113,6 +553,40 @@ if __name__ == "__main__":
     parser.add_argument(
         "--pipeline_config", type=Path, help="path to dataset metadata yaml"
     )
+    add_execution_args(parser)
+    add_encoding_args(parser)
+    parser.add_argument(
+        "--ingest",
+        action="store_true",
+        help="also write expressions for the final output from the same read",
+    )
+    add_expr_output_args(parser)
+    add_resume_args(parser)
+    add_shard_args(parser)
+    add_tiling_args(parser)
+    add_plan_args(parser)
+    add_metadata_cache_args(parser, default=None)
+    add_perf_report_args(parser)
+    add_output_manifest_args(parser)
     args = parser.parse_args()
 
-    main(args.data_dir, args.pipeline_config)
+    if args.verify:
+        verify_output_manifest(args.output_manifest, args.num_workers)
+        sys.exit()
+    with save_perf_report_on_exit(
+        args.perf_report, "prepare_segmentation_channels"
+    ), save_output_manifest_on_exit(args.output_manifest):
+        main(
+            args.data_dir,
+            args.pipeline_config,
+            ExecutionOptions.from_args(args),
+            TiffEncoding.from_args(args),
+            args.ingest,
+            ExprOutputOptions.from_args(args),
+            ResumeOptions.from_args(args),
+            args.metadata_cache,
+            args.metadata_cache_entries,
+            ShardOptions.from_args(args),
+            TilingOptions.from_args(args),
+            PlanOptions.from_args(args),
+        )
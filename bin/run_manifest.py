@@ -0,0 +1,160 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from utils import add_perf_counter, path_to_str
+
+hash_chunk_size = 8 * 1024 * 1024
+
+
+def hash_file(path: Path) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as s:
+        while chunk := s.read(hash_chunk_size):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_path_identity(path: Path, content_hash: bool = False) -> Dict[str, Any]:
+    """Size and modification time of a file, or of all files of a directory"""
+    if path.is_dir():
+        files = sorted(p for p in path.rglob("*") if p.is_file())
+        size = sum(p.stat().st_size for p in files)
+        mtime = max((p.stat().st_mtime_ns for p in files), default=0)
+    else:
+        stat = path.stat()
+        size, mtime = stat.st_size, stat.st_mtime_ns
+    identity = {"size": size, "mtime_ns": mtime}
+    if content_hash and path.is_file():
+        identity["sha256"] = hash_file(path)
+    return identity
+
+
+def get_config_hash(config: Dict[str, Any]) -> str:
+    config_str = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(config_str.encode("utf-8")).hexdigest()
+
+
+@contextmanager
+def atomic_output(dst: Path) -> Iterator[Path]:
+    """
+    Yields a temporary path with the same name as dst inside a hidden
+    directory next to it, and moves it to dst only if writing succeeded.
+    An interrupted task never leaves a partially written file at dst.
+    """
+    tmp_dir = dst.parent / f".partial-{os.getpid()}-{dst.name}"
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = tmp_dir / dst.name
+    try:
+        yield tmp_path
+        add_perf_counter("written_bytes", get_path_identity(tmp_path)["size"])
+        if dst.is_dir():
+            shutil.rmtree(dst)
+        os.replace(tmp_path, dst)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class RunManifest:
+    """
+    Records for every output the identity of its sources and the config
+    it was produced with, so reruns can skip outputs that are up to date.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        config: Dict[str, Any],
+        content_hash: bool = False,
+        force: bool = False,
+    ):
+        self.path = path
+        self.config_hash = get_config_hash(config)
+        self.content_hash = content_hash
+        self.force = force
+        self.entries: Dict[str, Dict[str, Any]] = dict()
+        if path.exists():
+            with open(path, "r") as s:
+                self.entries = json.load(s)
+
+    def get_sources_identity(self, sources: Sequence[Path]) -> List[Dict[str, Any]]:
+        return [
+            {"path": path_to_str(src), **get_path_identity(src, self.content_hash)}
+            for src in sources
+        ]
+
+    def is_up_to_date(self, outputs: Sequence[Path], sources: Sequence[Path]) -> bool:
+        if self.force:
+            return False
+        sources_identity = None
+        for output in outputs:
+            entry = self.entries.get(path_to_str(output))
+            if entry is None or not output.exists():
+                return False
+            if entry["config_hash"] != self.config_hash:
+                return False
+            if entry["output"] != get_path_identity(output):
+                return False
+            if sources_identity is None:
+                sources_identity = self.get_sources_identity(sources)
+            if entry["sources"] != sources_identity:
+                return False
+        return True
+
+    def record(self, outputs: Sequence[Path], sources: Sequence[Path]):
+        sources_identity = self.get_sources_identity(sources)
+        for output in outputs:
+            self.entries[path_to_str(output)] = {
+                "sources": sources_identity,
+                "config_hash": self.config_hash,
+                "output": get_path_identity(output),
+            }
+
+    def save(self):
+        with atomic_output(self.path) as tmp_path:
+            with open(tmp_path, "w") as s:
+                json.dump(self.entries, s, indent=1, sort_keys=True)
+
+
+@dataclass
+class ResumeOptions:
+    run_manifest: Optional[Path] = None
+    force: bool = False
+    hash_sources: bool = False
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "ResumeOptions":
+        return cls(
+            run_manifest=args.run_manifest,
+            force=args.force,
+            hash_sources=args.hash_sources,
+        )
+
+    def open_manifest(self, default_path: Path, config: Dict[str, Any]) -> RunManifest:
+        path = self.run_manifest or default_path
+        return RunManifest(path, config, self.hash_sources, self.force)
+
+
+def add_resume_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--run_manifest",
+        type=Path,
+        default=None,
+        help="path to the manifest of produced outputs, used to skip up to date ones",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="recompute all outputs even if they are up to date",
+    )
+    parser.add_argument(
+        "--hash_sources",
+        action="store_true",
+        help="compare sources by content hash instead of size and mtime",
+    )
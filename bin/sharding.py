@@ -0,0 +1,113 @@
+import argparse
+import heapq
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from utils import build_source_index
+
+
+@dataclass
+class ShardOptions:
+    """Which regions of the dataset are processed by this instance of a step"""
+
+    shard_index: int = 0
+    shard_count: int = 1
+    regions: Optional[List[int]] = None
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "ShardOptions":
+        return cls(
+            shard_index=args.shard_index,
+            shard_count=args.shard_count,
+            regions=args.regions,
+        )
+
+    @property
+    def is_sharded(self) -> bool:
+        return self.shard_count > 1 or self.regions is not None
+
+
+def get_region_sizes(
+    data_dir: Path, listing: Dict[int, Dict[str, str]]
+) -> Dict[int, int]:
+    """Total size of source images of every region"""
+    region_sizes = {region: 0 for region in listing}
+    for (region, _), path in build_source_index(data_dir, listing).items():
+        region_sizes[region] += path.stat().st_size
+    return region_sizes
+
+
+def assign_regions_to_shards(
+    region_sizes: Dict[int, int], shard_count: int
+) -> List[List[int]]:
+    """
+    Greedily gives the largest remaining region to the shard with
+    the smallest total size. Ties are broken by region and shard index,
+    so every instance of every step computes the same assignment.
+    """
+    shards = [[] for _ in range(shard_count)]
+    loads = [(0, i) for i in range(shard_count)]
+    for region, size in sorted(region_sizes.items(), key=lambda rs: (-rs[1], rs[0])):
+        load, i = heapq.heappop(loads)
+        shards[i].append(region)
+        heapq.heappush(loads, (load + size, i))
+    return [sorted(regions) for regions in shards]
+
+
+def select_shard(
+    data_dir: Path, listing: Dict[int, Dict[str, str]], options: ShardOptions
+) -> Dict[int, Dict[str, str]]:
+    """Returns the part of dataset_map_all_slices this instance has to process"""
+    if not options.is_sharded:
+        return listing
+    if not 0 <= options.shard_index < options.shard_count:
+        raise ValueError(
+            f"Shard index {options.shard_index} is out of range "
+            f"for {options.shard_count} shards"
+        )
+    if options.regions is not None:
+        unknown = sorted(set(options.regions) - set(listing))
+        if unknown:
+            raise ValueError(f"Regions {unknown} are not in the dataset")
+        listing = {
+            region: slices
+            for region, slices in listing.items()
+            if region in options.regions
+        }
+    region_sizes = get_region_sizes(data_dir, listing)
+    shards = assign_regions_to_shards(region_sizes, options.shard_count)
+    regions = shards[options.shard_index]
+    print(
+        "Shard",
+        options.shard_index + 1,
+        "of",
+        options.shard_count,
+        "| regions:",
+        regions,
+        "| bytes:",
+        sum(region_sizes[region] for region in regions),
+    )
+    return {region: listing[region] for region in regions}
+
+
+def add_shard_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--shard_index",
+        type=int,
+        default=0,
+        help="0-based index of the shard of regions processed by this instance",
+    )
+    parser.add_argument(
+        "--shard_count",
+        type=int,
+        default=1,
+        help="number of shards regions are split into, balanced by size",
+    )
+    parser.add_argument(
+        "--regions",
+        type=int,
+        nargs="+",
+        default=None,
+        help="process only these regions, applied before sharding",
+    )
@@ -0,0 +1,325 @@
+import argparse
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from metadata_cache import ImageMeta
+from utils import parse_size
+
+# region and slice name
+ImageKey = Tuple[int, str]
+
+
+def estimate_segm_channels_task(
+    img_meta: ImageMeta, num_segm_channels: int
+) -> Tuple[int, int]:
+    """
+    Uses only cached TIFF and OME headers, no pixel data.
+    Returns a 2-tuple:
+     [0] estimated peak memory of the task in bytes
+     [1] decoded bytes the task processes
+    """
+    task_nbytes = img_meta.plane_nbytes * num_segm_channels
+    return task_nbytes, task_nbytes
+
+
+def estimate_expr_task(img_metas: List[ImageMeta], streaming: bool) -> Tuple[int, int]:
+    """
+    Estimate for the task that rewrites expression images one after another.
+    In streaming mode only one plane is held in memory, otherwise the whole stack.
+    Returns a 2-tuple:
+     [0] estimated peak memory of the task in bytes
+     [1] decoded bytes the task processes
+    """
+    if not img_metas:
+        return 0, 0
+    stack_sizes = [
+        img_meta.plane_nbytes * img_meta.num_planes for img_meta in img_metas
+    ]
+    if streaming:
+        peak_memory = max(img_meta.plane_nbytes for img_meta in img_metas)
+    else:
+        peak_memory = max(stack_sizes)
+    return peak_memory, sum(stack_sizes)
+
+
+@dataclass
+class TaskPlan:
+    """Estimated I/O and memory of one task, from headers and file sizes only"""
+
+    name: str
+    region: int
+    read_bytes: int
+    written_bytes: int
+    peak_memory: int
+
+
+@dataclass
+class PlanOptions:
+    plan: bool = False
+    read_throughput: str = "200M"
+    write_throughput: str = "200M"
+    max_task_memory: Optional[str] = None
+    num_largest_tasks: int = 5
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "PlanOptions":
+        return cls(
+            plan=args.plan,
+            read_throughput=args.plan_read_throughput,
+            write_throughput=args.plan_write_throughput,
+            max_task_memory=args.max_task_memory,
+            num_largest_tasks=args.plan_largest_tasks,
+        )
+
+    def get_task_time(self, task: TaskPlan) -> float:
+        return task.read_bytes / parse_size(
+            self.read_throughput
+        ) + task.written_bytes / parse_size(self.write_throughput)
+
+
+def get_read_bytes(img_path: Path, img_meta: ImageMeta, num_planes: int) -> int:
+    """Part of the file size that stores the planes, compressed or not"""
+    file_size = img_path.stat().st_size
+    return file_size * num_planes // max(img_meta.num_planes, 1)
+
+
+def plan_segm_channels_tasks(
+    img_paths: Dict[ImageKey, Path],
+    img_metas: Dict[ImageKey, ImageMeta],
+    num_segm_channels: int,
+    ingest: bool = False,
+    prefetch_depth: int = 0,
+) -> List[TaskPlan]:
+    """One task per image, in the ingest mode it also writes expressions"""
+    tasks = []
+    for (region, slice_name), img_path in img_paths.items():
+        img_meta = img_metas[(region, slice_name)]
+        plane_nbytes = img_meta.plane_nbytes
+        segm_nbytes = plane_nbytes * num_segm_channels
+        if ingest:
+            peak_memory, _ = estimate_expr_task([img_meta], streaming=True)
+            read_bytes = get_read_bytes(img_path, img_meta, img_meta.num_planes)
+            written_bytes = plane_nbytes * img_meta.num_planes + segm_nbytes
+        else:
+            peak_memory, _ = estimate_segm_channels_task(img_meta, num_segm_channels)
+            read_bytes = get_read_bytes(img_path, img_meta, num_segm_channels)
+            written_bytes = segm_nbytes
+        tasks.append(
+            TaskPlan(
+                f"region {region} {slice_name}",
+                region,
+                read_bytes,
+                written_bytes,
+                peak_memory + plane_nbytes * prefetch_depth,
+            )
+        )
+    return tasks
+
+
+def plan_expr_tasks(
+    img_paths: Dict[ImageKey, Path],
+    img_metas: Dict[ImageKey, ImageMeta],
+    streaming: bool = True,
+    prefetch_depth: int = 0,
+) -> List[TaskPlan]:
+    """One task per region, that rewrites its images one after another"""
+    keys_per_region: Dict[int, List[ImageKey]] = dict()
+    for key in img_paths:
+        keys_per_region.setdefault(key[0], []).append(key)
+    tasks = []
+    for region, keys in keys_per_region.items():
+        region_metas = [img_metas[key] for key in keys]
+        peak_memory, decoded_bytes = estimate_expr_task(region_metas, streaming)
+        if streaming:
+            peak_memory += prefetch_depth * max(
+                img_meta.plane_nbytes for img_meta in region_metas
+            )
+        read_bytes = sum(
+            get_read_bytes(img_paths[key], img_metas[key], img_metas[key].num_planes)
+            for key in keys
+        )
+        tasks.append(
+            TaskPlan(f"region {region}", region, read_bytes, decoded_bytes, peak_memory)
+        )
+    return tasks
+
+
+def plan_copy_tasks(
+    paths: Dict[ImageKey, Path],
+    kind: str,
+    metas: Optional[Dict[ImageKey, ImageMeta]] = None,
+) -> List[TaskPlan]:
+    """
+    Files are transferred as they are, unless their headers are given,
+    then they are rewritten one plane at a time. Missing files are skipped.
+    """
+    tasks = []
+    for (region, slice_name), path in paths.items():
+        if not path.exists():
+            continue
+        read_bytes = written_bytes = path.stat().st_size
+        peak_memory = 0
+        if metas is not None:
+            meta = metas[(region, slice_name)]
+            # a plane and its copy with the new dtype
+            peak_memory = 2 * meta.plane_nbytes
+            written_bytes = meta.plane_nbytes * meta.num_planes
+        tasks.append(
+            TaskPlan(
+                f"{kind} region {region} {slice_name}",
+                region,
+                read_bytes,
+                written_bytes,
+                peak_memory,
+            )
+        )
+    return tasks
+
+
+def plan_stitch_tasks(
+    tile_paths: Dict[ImageKey, List[Path]],
+    tile_metas: Dict[ImageKey, List[ImageMeta]],
+    shapes: Dict[ImageKey, Tuple[int, int]],
+) -> List[TaskPlan]:
+    """
+    Tile masks are read once for the cells and once per channel,
+    the stitched mask is written with labels of up to 4 bytes
+    """
+    tasks = []
+    for (region, slice_name), paths in tile_paths.items():
+        metas = tile_metas[(region, slice_name)]
+        num_channels = metas[0].shape[0]
+        size_y, size_x = shapes[(region, slice_name)]
+        tile_nbytes = max(meta.plane_nbytes for meta in metas)
+        tasks.append(
+            TaskPlan(
+                f"stitch region {region} {slice_name}",
+                region,
+                sum(path.stat().st_size for path in paths)
+                * (num_channels + 1)
+                // num_channels,
+                size_y * size_x * 4 * num_channels,
+                # labels of a tile as indexes, their new values and the centroids
+                tile_nbytes * 8,
+            )
+        )
+    return tasks
+
+
+def format_size(nbytes: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(nbytes) < 1024:
+            return f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+    return f"{nbytes:.1f} TiB"
+
+
+def format_task(task: TaskPlan, options: PlanOptions) -> str:
+    return " | ".join(
+        [
+            task.name,
+            "read " + format_size(task.read_bytes),
+            "write " + format_size(task.written_bytes),
+            "peak memory " + format_size(task.peak_memory),
+            f"time {options.get_task_time(task):.1f} s",
+        ]
+    )
+
+
+def print_plan(
+    step: str, tasks: List[TaskPlan], num_workers: int, options: PlanOptions
+):
+    """
+    Prints estimates per region, in total and for the largest tasks.
+    Wall time assumes tasks are spread evenly over workers that share
+    the storage throughput, but can't be shorter than the longest task.
+    """
+    print(f"\nPlan of {step} | {len(tasks)} tasks | {num_workers} workers")
+    regions: Dict[int, List[TaskPlan]] = dict()
+    for task in tasks:
+        regions.setdefault(task.region, []).append(task)
+    for region, region_tasks in sorted(regions.items()):
+        print(
+            format_task(
+                TaskPlan(
+                    f"region {region} ({len(region_tasks)} tasks)",
+                    region,
+                    sum(task.read_bytes for task in region_tasks),
+                    sum(task.written_bytes for task in region_tasks),
+                    max(task.peak_memory for task in region_tasks),
+                ),
+                options,
+            )
+        )
+    if not tasks:
+        return
+    task_times = [options.get_task_time(task) for task in tasks]
+    peak_memories = sorted((task.peak_memory for task in tasks), reverse=True)
+    print(
+        "total",
+        "| read",
+        format_size(sum(task.read_bytes for task in tasks)),
+        "| write",
+        format_size(sum(task.written_bytes for task in tasks)),
+        "| peak memory per worker",
+        format_size(peak_memories[0]),
+        "| peak memory of all workers",
+        format_size(sum(peak_memories[:num_workers])),
+        f"| wall time {max(sum(task_times) / num_workers, max(task_times)):.1f} s",
+    )
+    print("Largest tasks:")
+    largest_tasks = sorted(
+        tasks,
+        key=lambda task: (task.peak_memory, options.get_task_time(task)),
+        reverse=True,
+    )
+    for task in largest_tasks[: options.num_largest_tasks]:
+        print("  " + format_task(task, options))
+
+
+def check_plan(tasks: List[TaskPlan], options: PlanOptions):
+    """Raises an error listing tasks that would exceed the memory limit"""
+    if options.max_task_memory is None:
+        return
+    limit = parse_size(options.max_task_memory)
+    too_large = [task for task in tasks if task.peak_memory > limit]
+    if too_large:
+        raise ValueError(
+            f"{len(too_large)} tasks exceed the memory limit of "
+            f"{options.max_task_memory}:\n"
+            + "\n".join(format_task(task, options) for task in too_large)
+        )
+
+
+def add_plan_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="print estimated I/O, memory and time of every task "
+        "from image headers, without processing any pixels",
+    )
+    parser.add_argument(
+        "--plan_read_throughput",
+        type=str,
+        default="200M",
+        help="read throughput of the storage per second, e.g. 500M",
+    )
+    parser.add_argument(
+        "--plan_write_throughput",
+        type=str,
+        default="200M",
+        help="write throughput of the storage per second, e.g. 500M",
+    )
+    parser.add_argument(
+        "--plan_largest_tasks",
+        type=int,
+        default=5,
+        help="number of the largest tasks printed in the plan",
+    )
+    parser.add_argument(
+        "--max_task_memory",
+        type=str,
+        default=None,
+        help="fail if the estimated peak memory of a task exceeds this size",
+    )
@@ -0,0 +1,178 @@
+import argparse
+import json
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from run_manifest import atomic_output
+
+# (start, end, core start, core end) of a tile along one axis
+AxisTile = Tuple[int, int, int, int]
+# region -> slice name -> (shape YX, tiles)
+TiledImages = Dict[int, Dict[str, Tuple[Tuple[int, int], List["Tile"]]]]
+
+
+@dataclass
+class Tile:
+    """
+    Part of a slide exported for segmentation. The core is the part of the
+    tile closer to its center than to the center of any neighbouring tile,
+    objects with a centroid in the core belong to this tile when stitching.
+    All coordinates are in pixels of the whole slide.
+    """
+
+    name: str
+    y: int
+    x: int
+    height: int
+    width: int
+    core: Tuple[int, int, int, int]
+
+    @classmethod
+    def from_dict(cls, tile: dict) -> "Tile":
+        return cls(**{**tile, "core": tuple(tile["core"])})
+
+
+@dataclass
+class TilingOptions:
+    tile_size: Optional[int] = None
+    overlap: int = 0
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "TilingOptions":
+        return cls(tile_size=args.segm_tile_size, overlap=args.segm_tile_overlap)
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.tile_size is not None
+
+    def validate(self):
+        if self.is_enabled and not 0 <= self.overlap < self.tile_size:
+            raise ValueError("Tile overlap must be smaller than tile size")
+
+
+def get_axis_tiles(size: int, tile_size: int, overlap: int) -> List[AxisTile]:
+    """
+    Tiles start every tile_size - overlap pixels, the last one is cut
+    at the image border. Neighbouring cores meet in the middle of the overlap.
+    """
+    stride = tile_size - overlap
+    num_tiles = max(1, -(-(size - overlap) // stride))
+    axis_tiles = []
+    for i in range(num_tiles):
+        start = i * stride
+        end = min(start + tile_size, size)
+        core_start = 0 if i == 0 else start + overlap // 2
+        core_end = size if i == num_tiles - 1 else start + stride + overlap // 2
+        axis_tiles.append((start, end, core_start, core_end))
+    return axis_tiles
+
+
+def get_tile_name(slice_name: str, index: int) -> str:
+    return f"{slice_name}_tile{index:04d}"
+
+
+def get_tiles(
+    slice_name: str, size_y: int, size_x: int, options: TilingOptions
+) -> List[Tile]:
+    """Tiles of a slide in row-major order"""
+    tiles = []
+    for y, y_end, core_y, core_y_end in get_axis_tiles(
+        size_y, options.tile_size, options.overlap
+    ):
+        for x, x_end, core_x, core_x_end in get_axis_tiles(
+            size_x, options.tile_size, options.overlap
+        ):
+            tiles.append(
+                Tile(
+                    name=get_tile_name(slice_name, len(tiles)),
+                    y=y,
+                    x=x,
+                    height=y_end - y,
+                    width=x_end - x,
+                    core=(core_y, core_y_end, core_x, core_x_end),
+                )
+            )
+    return tiles
+
+
+def save_tile_manifest(path: Path, options: TilingOptions, images: TiledImages):
+    manifest = dict(
+        tile_size=options.tile_size,
+        overlap=options.overlap,
+        images={
+            str(region): {
+                slice_name: dict(shape=shape, tiles=[asdict(tile) for tile in tiles])
+                for slice_name, (shape, tiles) in slices.items()
+            }
+            for region, slices in images.items()
+        },
+    )
+    with atomic_output(path) as tmp_path:
+        with open(tmp_path, "w") as s:
+            json.dump(manifest, s, indent=1)
+
+
+def read_tile_manifest(path: Path) -> Tuple[TilingOptions, TiledImages]:
+    with open(path, "r") as s:
+        manifest = json.load(s)
+    options = TilingOptions(manifest["tile_size"], manifest["overlap"])
+    images = {
+        int(region): {
+            slice_name: (
+                tuple(image["shape"]),
+                [Tile.from_dict(tile) for tile in image["tiles"]],
+            )
+            for slice_name, image in slices.items()
+        }
+        for region, slices in manifest["images"].items()
+    }
+    return options, images
+
+
+def add_tiling_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--segm_tile_size",
+        type=int,
+        default=None,
+        help="export segmentation channels as tiles of this size "
+        "instead of whole slides",
+    )
+    parser.add_argument(
+        "--segm_tile_overlap",
+        type=int,
+        default=0,
+        help="overlap of neighbouring tiles in pixels, "
+        "should be larger than the largest cell",
+    )
+
+
+def get_tile_label_map(
+    cells: np.ndarray, tile: Tile, first_label: int
+) -> Tuple[np.ndarray, int]:
+    """
+    Maps labels of a tile mask to labels of the slide starting at first_label.
+    Only objects with a centroid in the core of the tile are kept, the others
+    are mapped to 0, they are kept by the neighbouring tile.
+    Returns the map and the number of kept objects.
+    """
+    labels = cells.reshape(-1).astype(np.intp, copy=False)
+    counts = np.bincount(labels)
+    rows = np.repeat(np.arange(cells.shape[0]), cells.shape[1])
+    cols = np.tile(np.arange(cells.shape[1]), cells.shape[0])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        centroid_y = tile.y + np.bincount(labels, rows, len(counts)) / counts
+        centroid_x = tile.x + np.bincount(labels, cols, len(counts)) / counts
+    core_y, core_y_end, core_x, core_x_end = tile.core
+    in_core = (
+        (centroid_y >= core_y)
+        & (centroid_y < core_y_end)
+        & (centroid_x >= core_x)
+        & (centroid_x < core_x_end)
+    )
+    in_core[0] = False
+    kept = np.flatnonzero(in_core)
+    label_map = np.zeros(len(counts), dtype=np.int64)
+    label_map[kept] = np.arange(first_label, first_label + len(kept))
+    return label_map, len(kept)
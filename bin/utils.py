@@ -1,8 +1,20 @@
+import argparse
+import json
+import os
+import re
+import resource
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Tuple
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 import yaml
 
+# counters of the task that runs in the current thread, see run_measured
+_task_counters = threading.local()
+
 
 def make_dir_if_not_exists(dir_path: Path):
     if not dir_path.exists():
@@ -17,6 +29,16 @@ def path_to_str_local(path: Path):
     return str(path.as_posix())
 
 
+def parse_size(size: str) -> int:
+    """Converts human readable size to bytes, e.g. 512M, 4G, 1.5GiB"""
+    units = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)(i?B)?\s*", str(size), re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Could not parse size {size}")
+    number, unit, _ = match.groups()
+    return int(float(number) * units[unit.upper()])
+
+
 def read_pipeline_config(config_path: Path):
     with open(config_path, "r") as s:
         config = yaml.safe_load(s)
@@ -28,6 +50,20 @@ def save_pipeline_config(config: dict, out_path: Path):
         yaml.safe_dump(config, s)
 
 
+def build_source_index(
+    data_dir: Path, listing: Dict[int, Dict[str, str]]
+) -> Dict[Tuple[int, str], Path]:
+    """
+    Maps (region, slice_name) to the full path of the source image,
+    using the listing from dataset_map_all_slices of the pipeline config
+    """
+    src_index = dict()
+    for region, slices in listing.items():
+        for slice_name, slice_path in slices.items():
+            src_index[(region, slice_name)] = data_dir / slice_path
+    return src_index
+
+
 def get_channel_names_from_ome(xml) -> List[Tuple[str, int]]:
     pixels = xml.find("Image").find("Pixels")
     channels = pixels.findall("Channel")
@@ -39,11 +75,152 @@ def get_channel_names_from_ome(xml) -> List[Tuple[str, int]]:
         ch_names_ids.append((ch_name, ch_id))
     return ch_names_ids
 
-def get_img_subdir(data_dir: Path)-> Path:
+
+def get_img_subdir(data_dir: Path) -> Path:
     subdir = data_dir / "lab_processed/images/"
     if subdir.is_dir():
         return subdir
     subdir = data_dir / "HuBMAP_OME/"
     if subdir.is_dir():
         return subdir
-    raise ValidationError(f"Directory {data_dir} does not contain subdirectory lab_processed/images/ or HuBMAP_OME/")
\ No newline at end of file
+    raise ValidationError(
+        f"Directory {data_dir} does not contain subdirectory lab_processed/images/ or HuBMAP_OME/"
+    )
+
+
+def get_perf_counters() -> Optional[Counter]:
+    return getattr(_task_counters, "values", None)
+
+
+def add_perf_counter(name: str, value: int):
+    """Adds to a counter of the measured task running in this thread, if any"""
+    counters = get_perf_counters()
+    if counters is not None:
+        counters[name] += value
+
+
+@contextmanager
+def share_perf_counters(counters: Optional[Counter]) -> Iterator[None]:
+    """Lets a helper thread add to the counters of the task that started it"""
+    _task_counters.values = counters
+    try:
+        yield
+    finally:
+        _task_counters.values = None
+
+
+def get_peak_rss(who: int = resource.RUSAGE_SELF) -> int:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss * 1024
+
+
+def add_task_output(path: str, record: dict):
+    """Records an output written by the measured task running in this thread, if any"""
+    outputs = getattr(_task_counters, "outputs", None)
+    if outputs is not None:
+        outputs[path] = record
+
+
+def run_measured(func: Callable, submit_time: float, *args) -> Tuple[Any, dict]:
+    """
+    Runs the task and returns its result with wall time, time spent waiting
+    in the executor queue, peak RSS of the worker and counters added
+    with add_perf_counter, e.g. bytes read, decoded and written,
+    and records of outputs added with add_task_output
+    """
+    start = time.time()
+    _task_counters.values = Counter()
+    _task_counters.outputs = dict()
+    try:
+        result = func(*args)
+        counters = _task_counters.values
+        outputs = _task_counters.outputs
+    finally:
+        _task_counters.values = None
+        _task_counters.outputs = None
+    metrics = dict(
+        wall_time_s=round(time.time() - start, 6),
+        queue_wait_s=round(max(0.0, start - submit_time), 6),
+        peak_rss_bytes=get_peak_rss(),
+        worker=f"{os.getpid()}:{threading.get_ident()}",
+        **counters,
+    )
+    if outputs:
+        metrics["outputs"] = outputs
+    return result, metrics
+
+
+class PerfReport:
+    """Stage and task measurements of one script run, saved as JSON"""
+
+    def __init__(self):
+        self.start = time.time()
+        self.stages: List[dict] = []
+        self.tasks: List[dict] = []
+        self.current_stage: Optional[str] = None
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        self.current_stage = name
+        start = time.time()
+        num_tasks = len(self.tasks)
+        try:
+            yield
+        finally:
+            self.stages.append(
+                dict(
+                    name=name,
+                    wall_time_s=round(time.time() - start, 6),
+                    num_tasks=len(self.tasks) - num_tasks,
+                )
+            )
+            self.current_stage = None
+
+    def add_task(self, name: str, metrics: dict):
+        self.tasks.append(dict(stage=self.current_stage, task=name, **metrics))
+
+    def get_totals(self) -> Dict[str, int]:
+        totals = Counter()
+        for task in self.tasks:
+            for key in ("read_bytes", "decoded_bytes", "written_bytes"):
+                totals[key] += task.get(key, 0)
+        return dict(totals)
+
+    def save(self, path: Path, script: str):
+        report = dict(
+            script=script,
+            wall_time_s=round(time.time() - self.start, 6),
+            peak_rss_bytes=get_peak_rss(),
+            peak_rss_children_bytes=get_peak_rss(resource.RUSAGE_CHILDREN),
+            totals=self.get_totals(),
+            stages=self.stages,
+            tasks=self.tasks,
+        )
+        with open(path, "w") as s:
+            json.dump(report, s, indent=1)
+        print("Performance report saved to", path)
+
+
+perf_report = PerfReport()
+# records of outputs written by the tasks of this run by path, see add_task_output
+written_outputs: Dict[str, dict] = dict()
+
+
+@contextmanager
+def save_perf_report_on_exit(path: Optional[Path], script: str) -> Iterator[None]:
+    """Saves the report also when the run fails, to see where it stopped"""
+    try:
+        yield
+    finally:
+        if path is not None:
+            make_dir_if_not_exists(path.parent)
+            perf_report.save(path, script)
+
+
+def add_perf_report_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--perf_report",
+        type=Path,
+        default=Path("/output/perf_report.json"),
+        help="path to JSON report with time, I/O and memory of every task",
+    )
@@ -1,12 +1,66 @@
 import html
+import re
 import unicodedata
+from decimal import Decimal
+from functools import lru_cache
 from io import StringIO
-from typing import Dict, Literal, Optional
+from typing import Dict, List, Literal, Optional, Tuple
 from xml.etree import ElementTree as ET
 
-from pint import Quantity, UnitRegistry
-
+ome_namespace = "http://www.openmicroscopy.org/Schemas/OME/2016-06"
+xml_declaration = '<?xml version="1.0" encoding="utf-8"?>\n'
 target_physical_size = "nm"
+# attributes that differ between slices that otherwise share the same header
+image_template_attrs = ("Name",)
+pixels_template_attrs = ("SizeX", "SizeY", "PhysicalSizeX", "PhysicalSizeY")
+template_field_prefix = "__ome_template_"
+template_field_pattern = re.compile(template_field_prefix + r"(\w+?)__")
+# patterns start with a literal, so they are matched with a fast substring
+# search, headers with namespace prefixes are rewritten without a template
+image_tag_pattern = re.compile(r"<Image\s[^>]*>")
+pixels_tag_pattern = re.compile(r"<Pixels\s[^>]*>")
+# removed with the whitespace that follows, as ElementTree removes the tail
+tiffdata_pattern = re.compile(r"<TiffData\b(?:[^>]*/>|.*?</TiffData\s*>)\s*", re.DOTALL)
+attr_pattern = re.compile(r"""([\w:.-]+)(\s*=\s*)(?:"([^"]*)"|'([^']*)')""")
+
+# power of ten that converts OME length units to nanometers,
+# keys are NFKC normalized, e.g. micro sign becomes greek mu
+unit_to_nm_exponents = {
+    unicodedata.normalize("NFKC", unit): exponent
+    for unit, exponent in {
+        "Ym": 33,
+        "Zm": 30,
+        "Em": 27,
+        "Pm": 24,
+        "Tm": 21,
+        "Gm": 18,
+        "Mm": 15,
+        "km": 12,
+        "hm": 11,
+        "dam": 10,
+        "m": 9,
+        "dm": 8,
+        "cm": 7,
+        "mm": 6,
+        "\u00b5m": 3,
+        "um": 3,
+        "nm": 0,
+        "\u00c5": -1,
+        "pm": -3,
+        "fm": -6,
+        "am": -9,
+        "zm": -12,
+        "ym": -15,
+    }.items()
+}
+
+
+def ome_to_str(ome_xml: ET.Element) -> str:
+    """
+    Serializes OME-XML as text with non-ASCII characters kept as they are,
+    it has to be written to TIFF as UTF-8 bytes
+    """
+    return xml_declaration + ET.tostring(ome_xml, encoding="unicode")
 
 
 def strip_namespace(xmlstr: str):
@@ -42,21 +96,120 @@ def add_sa_segmentation_channels_info(
     )
     annotation_value = ET.SubElement(annotation, "Value")
     original_metadata = ET.SubElement(annotation_value, "OriginalMetadata")
-    segmentation_channels_key = ET.SubElement(
-        original_metadata, "Key"
-    ).text = "SegmentationChannels"
+    segmentation_channels_key = ET.SubElement(original_metadata, "Key").text = (
+        "SegmentationChannels"
+    )
     segmentation_channels_value = ET.SubElement(original_metadata, "Value")
     ET.SubElement(segmentation_channels_value, "Nucleus").text = nucleus_channel
     ET.SubElement(segmentation_channels_value, "Cell").text = cell_channel
     omexml.append(structured_annotation)
 
 
-def physical_size_to_quantity(
+def add_sa_pyramid_info(omexml: ET.Element, num_levels: int):
+    """
+    Will add sizes of sub-resolution levels stored in SubIFDs
+    to the StructuredAnnotations, using Bio-Formats convention
+    <MapAnnotation ID="Annotation:Resolution:0"
+                   Namespace="openmicroscopy.org/PyramidResolution">
+        <Value>
+            <M K="1">2000 1500</M>
+            <M K="2">1000 750</M>
+        </Value>
+    </MapAnnotation>
+    and reference it from the Image node
+    """
+    annotation_id = "Annotation:Resolution:0"
+    image_node = omexml.find("Image")
+    px_node = image_node.find("Pixels")
+    size_x = int(px_node.get("SizeX"))
+    size_y = int(px_node.get("SizeY"))
+
+    structured_annotation = omexml.find("StructuredAnnotations")
+    if structured_annotation is None:
+        structured_annotation = ET.SubElement(omexml, "StructuredAnnotations")
+    annotation = ET.SubElement(
+        structured_annotation,
+        "MapAnnotation",
+        {"ID": annotation_id, "Namespace": "openmicroscopy.org/PyramidResolution"},
+    )
+    annotation_value = ET.SubElement(annotation, "Value")
+    for level, level_size in enumerate(
+        get_pyramid_sizes(size_x, size_y, num_levels), 1
+    ):
+        ET.SubElement(annotation_value, "M", {"K": str(level)}).text = level_size
+    ET.SubElement(image_node, "AnnotationRef", {"ID": annotation_id})
+
+
+def get_pyramid_sizes(size_x: int, size_y: int, num_levels: int) -> List[str]:
+    """Sizes of sub-resolution levels as "X Y" strings"""
+    sizes = []
+    for _ in range(num_levels):
+        # each level is downsampled 2x, odd sizes are rounded up
+        size_x = (size_x + 1) // 2
+        size_y = (size_y + 1) // 2
+        sizes.append(f"{size_x} {size_y}")
+    return sizes
+
+
+def add_sa_channel_stats(xml_str: str, channel_stats: Dict[str, dict]) -> str:
+    """
+    Adds intensity statistics of every channel as a MapAnnotation
+    <MapAnnotation ID="Annotation:ChannelStats:0"
+                   Namespace="hubmap/celldive-pipeline/ChannelStats">
+        <Value>
+            <M K="min">0</M>
+            <M K="p99">1234.5</M>
+            ...
+        </Value>
+    </MapAnnotation>
+    referenced from the Channel node
+    """
+    ome_xml: ET.Element = strip_namespace(xml_str)
+    ome_xml.set("xmlns", ome_namespace)
+    structured_annotation = ome_xml.find("StructuredAnnotations")
+    if structured_annotation is None:
+        structured_annotation = ET.SubElement(ome_xml, "StructuredAnnotations")
+    channels = ome_xml.find("Image").find("Pixels").findall("Channel")
+    for i, ch in enumerate(channels):
+        stats = channel_stats.get(ch.get("Name"))
+        if stats is None:
+            continue
+        annotation_id = f"Annotation:ChannelStats:{i}"
+        annotation = ET.SubElement(
+            structured_annotation,
+            "MapAnnotation",
+            {"ID": annotation_id, "Namespace": "hubmap/celldive-pipeline/ChannelStats"},
+        )
+        annotation_value = ET.SubElement(annotation, "Value")
+        values = {key: stats[key] for key in ("min", "max", "mean", "std")}
+        values.update(stats["percentiles"])
+        for key, value in values.items():
+            ET.SubElement(annotation_value, "M", {"K": key}).text = str(value)
+        ET.SubElement(ch, "AnnotationRef", {"ID": annotation_id})
+    return ome_to_str(ome_xml)
+
+
+@lru_cache(maxsize=None)
+def get_unit_registry():
+    # pint is slow to import and to set up, only needed for uncommon units
+    from pint import UnitRegistry
+
+    return UnitRegistry()
+
+
+def convert_to_nm(size_str: str, unit: str) -> float:
+    exponent = unit_to_nm_exponents.get(unit)
+    if exponent is None:
+        reg = get_unit_registry()
+        return (float(size_str) * reg(unit)).to(target_physical_size).magnitude
+    # shifting the decimal point of the original string is exact
+    return float(Decimal(size_str).scaleb(exponent))
+
+
+def physical_size_to_nm(
     px_node: ET.Element,
     dimension: Literal["X", "Y"],
-) -> Optional[Quantity]:
-    reg = UnitRegistry()
-
+) -> Optional[float]:
     unit_str = px_node.get(f"PhysicalSize{dimension}Unit", None)
     if unit_str is None:
         print("Could not find physical unit in OMEXML for dimension", dimension)
@@ -68,17 +221,15 @@ def physical_size_to_quantity(
         return None
 
     unit_normalized = unicodedata.normalize("NFKC", html.unescape(unit_str))
-    size = float(size_str) * reg[unit_normalized]
-    return size
+    return convert_to_nm(size_str, unit_normalized)
 
 
 def convert_size_to_nm(px_node: ET.Element):
     for dimension in "XY":
-        size = physical_size_to_quantity(px_node, dimension)
+        size = physical_size_to_nm(px_node, dimension)
         if size is not None:
-            size_converted = size.to(target_physical_size)
             px_node.set(f"PhysicalSize{dimension}Unit", target_physical_size)
-            px_node.set(f"PhysicalSize{dimension}", str(size_converted.magnitude))
+            px_node.set(f"PhysicalSize{dimension}", str(size))
 
 
 def remove_tiffdata(px_node: ET.Element):
@@ -106,20 +257,194 @@ def generate_and_add_new_tiffdata(px_node: ET.Element):
             ifd += 1
 
 
-def modify_initial_ome_meta(xml_str: str, segmentation_channels: Dict[str, str]):
-    new_dim_order = "XYZCT"
+def modify_mask_ome_meta(
+    xml_str: str, pixel_type: str, size: Optional[Tuple[int, int]] = None
+) -> str:
+    """
+    Keeps the metadata of the mask and updates only the pixel type
+    and the plane layout of the rewritten file,
+    and the YX size if the mask was stitched from tiles
+    """
     ome_xml: ET.Element = strip_namespace(xml_str)
-    ome_xml.set("xmlns", "http://www.openmicroscopy.org/Schemas/OME/2016-06")
+    ome_xml.set("xmlns", ome_namespace)
+    px_node = ome_xml.find("Image").find("Pixels")
+    px_node.set("DimensionOrder", "XYZCT")
+    px_node.set("Type", pixel_type)
+    if size is not None:
+        px_node.set("SizeY", str(size[0]))
+        px_node.set("SizeX", str(size[1]))
+    if "BigEndian" in px_node.attrib:
+        px_node.set("BigEndian", "false")
+    remove_tiffdata(px_node)
+    generate_and_add_new_tiffdata(px_node)
+    return ome_to_str(ome_xml)
+
+
+def rewrite_initial_ome_xml(
+    ome_xml: ET.Element, segmentation_channels: Dict[str, str], pyramid_levels: int = 0
+):
+    new_dim_order = "XYZCT"
+    ome_xml.set("xmlns", ome_namespace)
     px_node = ome_xml.find("Image").find("Pixels")
     px_node.set("DimensionOrder", new_dim_order)
     convert_size_to_nm(px_node)
     remove_tiffdata(px_node)
     generate_and_add_new_tiffdata(px_node)
 
-    ome_xml.remove(ome_xml.find("StructuredAnnotations"))
+    structured_annotations = ome_xml.find("StructuredAnnotations")
+    if structured_annotations is not None:
+        ome_xml.remove(structured_annotations)
     add_sa_segmentation_channels_info(
         ome_xml, segmentation_channels["nucleus"], segmentation_channels["cell"]
     )
-    new_xml_str = ET.tostring(ome_xml).decode("ascii")
-    res = '<?xml version="1.0" encoding="utf-8"?>\n' + new_xml_str
-    return res
+    if pyramid_levels > 0:
+        add_sa_pyramid_info(ome_xml, pyramid_levels)
+
+
+def get_template_field(name: str) -> str:
+    return f"{template_field_prefix}{name}__"
+
+
+def xml_unescape(value: str) -> str:
+    """Attribute value as ElementTree parses it"""
+    return html.unescape(re.sub(r"[\t\n\r]", " ", value))
+
+
+def replace_attrs(tag: str, names: Tuple[str, ...]) -> Tuple[str, Dict[str, str]]:
+    """
+    Replaces values of the named attributes of a start tag with template fields,
+    returns the new tag and unescaped values of all attributes of the tag
+    """
+    attrs = dict()
+
+    def replace(match: re.Match) -> str:
+        name, eq, double_quoted, single_quoted = match.groups()
+        value = double_quoted if double_quoted is not None else single_quoted
+        attrs[name] = xml_unescape(value)
+        if name not in names:
+            return match.group(0)
+        return f'{name}{eq}"{get_template_field(name)}"'
+
+    return attr_pattern.sub(replace, tag), attrs
+
+
+def split_per_image_fields(
+    xml_str: str,
+) -> Optional[Tuple[str, Dict[str, str], Dict[str, str]]]:
+    """
+    Replaces attributes that differ between slices with template fields and
+    removes TiffData that is regenerated anyway. Returns the header layout,
+    attributes of the Image and Pixels nodes, or None if the header
+    does not describe a single image.
+    """
+    if template_field_prefix in xml_str:
+        return None
+    image_tags = image_tag_pattern.findall(xml_str)
+    pixels_tags = pixels_tag_pattern.findall(xml_str)
+    if len(image_tags) != 1 or len(pixels_tags) != 1:
+        return None
+    image_tag, image_attrs = replace_attrs(image_tags[0], image_template_attrs)
+    pixels_tag, pixels_attrs = replace_attrs(pixels_tags[0], pixels_template_attrs)
+    layout = tiffdata_pattern.sub("", xml_str)
+    layout = layout.replace(image_tags[0], image_tag, 1)
+    layout = layout.replace(pixels_tags[0], pixels_tag, 1)
+    return layout, image_attrs, pixels_attrs
+
+
+@lru_cache(maxsize=16)
+def get_initial_ome_template(
+    layout: str, nucleus_channel: str, cell_channel: str, pyramid_levels: int
+) -> Tuple[str, ...]:
+    """
+    Rewrites the header layout once, returns literal parts of the new header
+    interleaved with names of the fields that are filled in per image
+    """
+    ome_xml: ET.Element = strip_namespace(layout)
+    px_node = ome_xml.find("Image").find("Pixels")
+    # placeholder values let sizes be converted and pyramid levels be added
+    fields = [name for name in pixels_template_attrs if name in px_node.attrib]
+    for name in fields:
+        px_node.set(name, "1")
+    rewrite_initial_ome_xml(
+        ome_xml, dict(nucleus=nucleus_channel, cell=cell_channel), pyramid_levels
+    )
+    for name in fields:
+        px_node.set(name, get_template_field(name))
+    if pyramid_levels > 0:
+        for annotation in ome_xml.find("StructuredAnnotations"):
+            if annotation.get("ID") == "Annotation:Resolution:0":
+                for m in annotation.find("Value"):
+                    m.text = get_template_field("Level" + m.get("K"))
+    return tuple(template_field_pattern.split(ome_to_str(ome_xml)))
+
+
+def get_per_image_values(
+    image_attrs: Dict[str, str], pixels_attrs: Dict[str, str], pyramid_levels: int
+) -> Dict[str, str]:
+    values = {
+        name: image_attrs[name] for name in image_template_attrs if name in image_attrs
+    }
+    values.update(
+        {
+            name: pixels_attrs[name]
+            for name in pixels_template_attrs
+            if name in pixels_attrs
+        }
+    )
+    for dimension in "XY":
+        size_str = pixels_attrs.get(f"PhysicalSize{dimension}")
+        unit_str = pixels_attrs.get(f"PhysicalSize{dimension}Unit")
+        if size_str is not None and unit_str is not None:
+            unit_normalized = unicodedata.normalize("NFKC", html.unescape(unit_str))
+            values[f"PhysicalSize{dimension}"] = str(
+                convert_to_nm(size_str, unit_normalized)
+            )
+    if pyramid_levels > 0:
+        level_sizes = get_pyramid_sizes(
+            int(pixels_attrs["SizeX"]), int(pixels_attrs["SizeY"]), pyramid_levels
+        )
+        for level, level_size in enumerate(level_sizes, 1):
+            values[f"Level{level}"] = level_size
+    return {name: escape_xml(value) for name, value in values.items()}
+
+
+def escape_xml(value: str) -> str:
+    """Escapes text and attribute values the same way as ElementTree"""
+    for char, entity in (
+        ("&", "&amp;"),
+        ("<", "&lt;"),
+        (">", "&gt;"),
+        ('"', "&quot;"),
+        ("\r", "&#13;"),
+        ("\n", "&#10;"),
+        ("\t", "&#09;"),
+    ):
+        value = value.replace(char, entity)
+    return value
+
+
+def modify_initial_ome_meta(
+    xml_str: str, segmentation_channels: Dict[str, str], pyramid_levels: int = 0
+) -> str:
+    """
+    Headers of slices of a dataset usually differ only in a few attributes,
+    so the new header is rendered from a template that is built once
+    per header layout, only these attributes are filled in per image
+    """
+    split = split_per_image_fields(xml_str)
+    if split is None:
+        ome_xml: ET.Element = strip_namespace(xml_str)
+        rewrite_initial_ome_xml(ome_xml, segmentation_channels, pyramid_levels)
+        return ome_to_str(ome_xml)
+    layout, image_attrs, pixels_attrs = split
+    template = get_initial_ome_template(
+        layout,
+        segmentation_channels["nucleus"],
+        segmentation_channels["cell"],
+        pyramid_levels,
+    )
+    values = get_per_image_values(image_attrs, pixels_attrs, pyramid_levels)
+    parts = list(template)
+    # odd parts are names of the fields
+    parts[1::2] = [values[name] for name in template[1::2]]
+    return "".join(parts)
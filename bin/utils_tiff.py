@@ -0,0 +1,380 @@
+import argparse
+import queue
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import tifffile as tif
+from utils import (
+    add_perf_counter,
+    get_perf_counters,
+    path_to_str,
+    share_perf_counters,
+)
+
+Image = np.ndarray
+# receives channel index, Z index and the plane
+PlaneCallback = Callable[[int, int, Image], None]
+
+non_plane_axes = "YXS"
+compression_codecs = ("none", "zlib", "zstd", "lzw")
+downsample_methods = ("mean", "max")
+
+
+@dataclass
+class TiffEncoding:
+    """Options of pixel data encoding for the output TIFF files"""
+
+    compression: str = "none"
+    tile_size: Optional[int] = None
+    predictor: bool = False
+    encoder_threads: Optional[int] = None
+    # planes read ahead by a reader thread while the previous ones are written
+    prefetch_depth: int = 0
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "TiffEncoding":
+        return cls(
+            compression=args.compression,
+            tile_size=args.tile_size,
+            predictor=args.predictor,
+            encoder_threads=args.encoder_threads,
+            prefetch_depth=args.prefetch_depth,
+        )
+
+    @property
+    def is_contiguous(self) -> bool:
+        """Uncompressed strips can be written as one contiguous block"""
+        return self.compression == "none" and self.tile_size is None
+
+    def get_output_config(self) -> Dict[str, Any]:
+        """Options that change the written bytes, thread count does not"""
+        return dict(
+            compression=self.compression,
+            tile_size=self.tile_size,
+            predictor=self.predictor,
+        )
+
+    def get_write_kwargs(self) -> Dict[str, Any]:
+        kwargs = dict(maxworkers=self.encoder_threads)
+        if self.compression != "none":
+            kwargs["compression"] = self.compression
+            kwargs["predictor"] = self.predictor
+        if self.tile_size is not None:
+            if self.tile_size % 16 != 0:
+                raise ValueError("Tile size must be a multiple of 16")
+            kwargs["tile"] = (self.tile_size, self.tile_size)
+        return kwargs
+
+
+def add_encoding_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--compression",
+        type=str,
+        choices=compression_codecs,
+        default="none",
+        help="codec of the output TIFF files",
+    )
+    parser.add_argument(
+        "--tile_size",
+        type=int,
+        default=None,
+        help="write tiles of this size (multiple of 16) instead of strips",
+    )
+    parser.add_argument(
+        "--predictor",
+        action="store_true",
+        help="apply horizontal differencing predictor before compression",
+    )
+    parser.add_argument(
+        "--encoder_threads",
+        type=int,
+        default=None,
+        help="number of threads that encode tiles or strips of one image",
+    )
+    parser.add_argument(
+        "--prefetch_depth",
+        type=int,
+        default=0,
+        help="number of planes a reader thread decodes ahead of the writer, "
+        "bounds the extra memory per task, 0 disables prefetching",
+    )
+
+
+def get_plane_dims(series: tif.TiffPageSeries) -> List[Tuple[str, int]]:
+    """Axes and sizes of a series that are stored as separate pages, e.g. C, Z, T"""
+    return [
+        (axis, size)
+        for axis, size in zip(series.axes, series.shape)
+        if axis not in non_plane_axes
+    ]
+
+
+def get_page_index(series: tif.TiffPageSeries, channel_id: int, z: int = 0) -> int:
+    """
+    Maps 0-based channel and Z indexes to the index of the page inside the series
+    that stores this plane (first T).
+    """
+    plane_dims = get_plane_dims(series)
+    if not plane_dims:
+        raise ValueError("Input image is not multichannel")
+    axes = [axis for axis, _ in plane_dims]
+    shape = [size for _, size in plane_dims]
+    # If channel axis is not labeled, the only non-spatial axis holds channels
+    ch_axis = axes.index("C") if "C" in axes else 0 if len(axes) == 1 else None
+    if ch_axis is None:
+        raise ValueError(f"Could not find channel axis in series axes {series.axes}")
+    if channel_id >= shape[ch_axis]:
+        raise ValueError(
+            f"Channel {channel_id} is out of range, image has {shape[ch_axis]} channels"
+        )
+    coords = [0] * len(shape)
+    coords[ch_axis] = channel_id
+    if "Z" in axes:
+        coords[axes.index("Z")] = z
+    elif z != 0:
+        raise ValueError(f"Z plane {z} is out of range, image has no Z axis")
+    return int(np.ravel_multi_index(coords, shape))
+
+
+def get_czyx_shape(series: tif.TiffPageSeries) -> Tuple[int, int, int, int]:
+    """Shape of the series in the CZYX order that is used for the output images"""
+    sizes = dict(get_plane_dims(series))
+    num_channels = sizes.get("C", series.shape[0] if len(sizes) == 1 else 1)
+    num_z = sizes.get("Z", 1)
+    size_y, size_x = series.keyframe.imagelength, series.keyframe.imagewidth
+    return num_channels, num_z, size_y, size_x
+
+
+def read_page(page: tif.TiffPage) -> Image:
+    """
+    Decodes a single page. Uncompressed contiguous pages are memory-mapped
+    instead, so only the pixels that are accessed later are read from disk.
+    """
+    page = page.aspage()
+    add_perf_counter("read_bytes", sum(page.databytecounts))
+    add_perf_counter("decoded_bytes", page.nbytes)
+    if page.is_memmappable:
+        dtype = np.dtype(page.parent.byteorder + page.dtype.char)
+        return np.memmap(
+            page.parent.filehandle.path,
+            dtype=dtype,
+            mode="r",
+            offset=page.dataoffsets[0],
+            shape=page.shape,
+        )
+    return page.asarray()
+
+
+def iter_channels(path: Path, channel_ids: Iterable[int]) -> Iterator[Image]:
+    """Reads only the pages that store the requested channels, one at a time"""
+    with tif.TiffFile(path_to_str(path)) as TF:
+        series = TF.series[0]
+        for ch_id in channel_ids:
+            yield read_page(series.pages[get_page_index(series, ch_id)])
+
+
+def open_lazy_page(page: tif.TiffPage) -> Any:
+    """
+    Array-like view of a page that decodes only the sliced part: a memmap for
+    uncompressed contiguous pages, otherwise a zarr array over the strips
+    or tiles of the page. Without zarr the whole page is decoded.
+    The file of the page has to stay open while the view is used.
+    """
+    page = page.aspage()
+    if page.is_memmappable:
+        return read_page(page)
+    try:
+        import zarr
+    except ImportError:
+        return read_page(page)
+    add_perf_counter("read_bytes", sum(page.databytecounts))
+    add_perf_counter("decoded_bytes", page.nbytes)
+    return zarr.open(page.aszarr(), mode="r")
+
+
+@contextmanager
+def open_channels(path: Path, channel_ids: Iterable[int]) -> Iterator[List[Any]]:
+    """Lazy views of the pages that store the requested channels"""
+    with tif.TiffFile(path_to_str(path)) as TF:
+        series = TF.series[0]
+        yield [
+            open_lazy_page(series.pages[get_page_index(series, ch_id)])
+            for ch_id in channel_ids
+        ]
+
+
+def read_channels(path: Path, channel_ids: Dict[str, int]) -> Dict[str, Image]:
+    return dict(zip(channel_ids, iter_channels(path, channel_ids.values())))
+
+
+def iter_planes(series: tif.TiffPageSeries, prefetch_depth: int = 0) -> Iterator[Image]:
+    """Yields planes of the series one at a time in CZ order"""
+    num_channels, num_z, _, _ = get_czyx_shape(series)
+    planes = (
+        read_page(series.pages[get_page_index(series, c, z)])
+        for c in range(num_channels)
+        for z in range(num_z)
+    )
+    return prefetch_planes(planes, prefetch_depth)
+
+
+def prefetch_planes(planes: Iterator[Image], depth: int) -> Iterator[Image]:
+    """
+    Reads planes in a background thread up to depth planes ahead of the
+    consumer, so reading the next planes overlaps with encoding and writing
+    the current one. Memory-mapped planes are loaded in the reader thread.
+    """
+    if depth <= 0:
+        yield from planes
+        return
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+    counters = get_perf_counters()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        with share_perf_counters(counters):
+            try:
+                for plane in planes:
+                    if isinstance(plane, np.memmap):
+                        plane = np.array(plane)
+                    if not put(plane):
+                        return
+                put(end)
+            except BaseException as e:
+                put(e)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    try:
+        while (item := buffer.get()) is not end:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        reader.join()
+
+
+def combine_plane_callbacks(
+    *callbacks: Optional[PlaneCallback],
+) -> Optional[PlaneCallback]:
+    """Calls all given callbacks in order, None callbacks are skipped"""
+    callbacks = [callback for callback in callbacks if callback is not None]
+    if len(callbacks) <= 1:
+        return callbacks[0] if callbacks else None
+
+    def call_all(c: int, z: int, plane: Image):
+        for callback in callbacks:
+            callback(c, z, plane)
+
+    return call_all
+
+
+def tap_planes(
+    planes: Iterator[Image], num_z: int, callback: Optional[PlaneCallback]
+) -> Iterator[Image]:
+    """Passes every plane in CZ order to the callback before yielding it"""
+    for i, plane in enumerate(planes):
+        if callback is not None:
+            c, z = divmod(i, num_z)
+            callback(c, z, plane)
+        yield plane
+
+
+def iter_tiles(planes: Iterator[Image], tile_size: int) -> Iterator[Image]:
+    """Splits every plane into tiles in the order TiffWriter expects"""
+    for plane in planes:
+        size_y, size_x = plane.shape[:2]
+        for y in range(0, size_y, tile_size):
+            for x in range(0, size_x, tile_size):
+                yield plane[y : y + tile_size, x : x + tile_size]
+
+
+def write_planes(
+    TW: tif.TiffWriter,
+    planes: Union[Image, Iterator[Image]],
+    encoding: TiffEncoding,
+    shape: Optional[Tuple[int, ...]] = None,
+    dtype: Optional[np.dtype] = None,
+    pyramid_levels: int = 0,
+    pyramid_method: str = "mean",
+    **kwargs,
+):
+    """
+    Writes a stack of planes, one page per plane, so the IFD of every plane
+    stays the same as in the TiffData of the OME metadata.
+    Planes can be an array or an iterator of planes with shape and dtype given.
+    """
+    if pyramid_levels > 0:
+        write_pyramid_planes(
+            TW, planes, encoding, pyramid_levels, pyramid_method, **kwargs
+        )
+        return
+    if not isinstance(planes, np.ndarray) and encoding.tile_size is not None:
+        planes = iter_tiles(planes, encoding.tile_size)
+    TW.write(
+        planes,
+        shape=shape,
+        dtype=dtype,
+        contiguous=encoding.is_contiguous,
+        **encoding.get_write_kwargs(),
+        **kwargs,
+    )
+
+
+def downsample(plane: Image, method: str = "mean") -> Image:
+    """Reduces every 2x2 block of the plane to its mean or max value"""
+    size_y, size_x = plane.shape
+    if size_y % 2 or size_x % 2:
+        plane = np.pad(plane, ((0, size_y % 2), (0, size_x % 2)), mode="edge")
+    blocks = plane.reshape(plane.shape[0] // 2, 2, plane.shape[1] // 2, 2)
+    if method == "max":
+        return blocks.max(axis=(1, 3))
+    elif method == "mean":
+        reduced = blocks.mean(axis=(1, 3), dtype=np.float32)
+        if np.issubdtype(plane.dtype, np.integer):
+            reduced = np.rint(reduced)
+        return reduced.astype(plane.dtype)
+    raise ValueError(f"Unknown downsample method {method}")
+
+
+def write_pyramid_planes(
+    TW: tif.TiffWriter,
+    planes: Union[Image, Iterator[Image]],
+    encoding: TiffEncoding,
+    num_levels: int,
+    method: str = "mean",
+    **kwargs,
+):
+    """
+    Writes every plane as a page followed by its sub-resolution levels
+    in SubIFDs. Levels are computed from the plane that was just written,
+    so the source is read only once and only one plane is kept in memory.
+    Top level IFDs are the same as without the pyramid.
+    """
+    if isinstance(planes, np.ndarray):
+        planes = iter(planes.reshape(-1, *planes.shape[-2:]))
+    write_kwargs = encoding.get_write_kwargs()
+    write_kwargs.update(photometric=kwargs.pop("photometric", None), metadata=None)
+    for i, plane in enumerate(planes):
+        # description and other kwargs belong to the first page only
+        page_kwargs = kwargs if i == 0 else {}
+        TW.write(plane, subifds=num_levels, **write_kwargs, **page_kwargs)
+        level = plane
+        for _ in range(num_levels):
+            level = downsample(level, method)
+            TW.write(level, subfiletype=1, **write_kwargs)
@@ -0,0 +1,179 @@
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+from xml.etree import ElementTree as ET
+
+import numpy as np
+from output_manifest import get_output_checksum
+from utils import get_channel_names_from_ome, path_to_str
+from utils_ome import convert_size_to_nm, strip_namespace
+from utils_tiff import Image, TiffEncoding, downsample
+
+ngff_version = "0.4"
+default_chunk_size = 1024
+compression_codecs = ("none", "zlib", "zstd")
+
+
+def import_zarr():
+    try:
+        import numcodecs
+        import zarr
+    except ImportError as e:
+        raise ImportError("OME-Zarr output requires zarr>=3 to be installed") from e
+    return zarr, numcodecs
+
+
+def get_compressor(compression: str):
+    _, numcodecs = import_zarr()
+    compressors = {
+        "none": None,
+        "zlib": numcodecs.Zlib(level=6),
+        "zstd": numcodecs.Zstd(level=3),
+    }
+    if compression not in compressors:
+        raise ValueError(f"Compression {compression} is not supported for OME-Zarr")
+    return compressors[compression]
+
+
+@lru_cache(maxsize=None)
+def get_checksum_store_class():
+    zarr, _ = import_zarr()
+
+    class ChecksumStore(zarr.storage.LocalStore):
+        """Local store that adds every written file to the checksum of the output"""
+
+        def __init__(self, root, *, read_only: bool = False, checksum=None):
+            super().__init__(root, read_only=read_only)
+            self.checksum = checksum
+
+        async def _set(self, key, value, exclusive: bool = False):
+            await super()._set(key, value, exclusive=exclusive)
+            if self.checksum is not None:
+                self.checksum.update_file(key, value.to_bytes())
+
+    return ChecksumStore
+
+
+def open_store(out_path: Path):
+    """Files of recorded outputs are hashed as they are written"""
+    checksum = get_output_checksum(out_path)
+    if checksum is None:
+        return path_to_str(out_path)
+    return get_checksum_store_class()(path_to_str(out_path), checksum=checksum)
+
+
+def get_physical_sizes_nm(ome_xml: ET.Element) -> Tuple[float, float]:
+    """Returns Y and X pixel sizes in nanometers, 1.0 if they are not set"""
+    px_node = ome_xml.find("Image").find("Pixels")
+    convert_size_to_nm(px_node)
+    size_y = float(px_node.get("PhysicalSizeY", 1.0))
+    size_x = float(px_node.get("PhysicalSizeX", 1.0))
+    return size_y, size_x
+
+
+def get_ngff_metadata(
+    name: str,
+    channel_names: List[str],
+    physical_sizes: Tuple[float, float],
+    num_levels: int,
+    dtype: np.dtype,
+) -> dict:
+    """NGFF multiscales and OMERO channel metadata for CZYX image"""
+    size_y, size_x = physical_sizes
+    datasets = []
+    for level in range(num_levels + 1):
+        factor = 2**level
+        datasets.append(
+            {
+                "path": str(level),
+                "coordinateTransformations": [
+                    {"type": "scale", "scale": [1, 1, size_y * factor, size_x * factor]}
+                ],
+            }
+        )
+    if np.issubdtype(dtype, np.integer):
+        window_max = int(np.iinfo(dtype).max)
+    else:
+        window_max = 1.0
+    channels = [
+        {
+            "label": ch_name,
+            "active": True,
+            "color": "FFFFFF",
+            "window": {"start": 0, "end": window_max, "min": 0, "max": window_max},
+        }
+        for ch_name in channel_names
+    ]
+    return {
+        "multiscales": [
+            {
+                "version": ngff_version,
+                "name": name,
+                "axes": [
+                    {"name": "c", "type": "channel"},
+                    {"name": "z", "type": "space"},
+                    {"name": "y", "type": "space", "unit": "nanometer"},
+                    {"name": "x", "type": "space", "unit": "nanometer"},
+                ],
+                "datasets": datasets,
+            }
+        ],
+        "omero": {"name": name, "version": ngff_version, "channels": channels},
+    }
+
+
+def write_ngff_image(
+    out_path: Path,
+    planes: Iterator[Image],
+    shape: Tuple[int, int, int, int],
+    dtype: np.dtype,
+    ome_meta: str,
+    encoding: TiffEncoding,
+    pyramid_levels: int = 0,
+    pyramid_method: str = "mean",
+    extra_attrs: Optional[Dict] = None,
+):
+    """
+    Writes CZYX planes in CZ order to a chunked OME-Zarr image group.
+    Chunks hold a single plane tile, so each plane is written as whole chunks
+    and images can be written by independent workers without locking.
+    """
+    zarr, _ = import_zarr()
+    ome_xml = strip_namespace(ome_meta)
+    channel_names = [ch_name for ch_name, _ in get_channel_names_from_ome(ome_xml)]
+    chunk_size = encoding.tile_size or default_chunk_size
+    compressor = get_compressor(encoding.compression)
+
+    group = zarr.open_group(open_store(out_path), mode="w", zarr_format=2)
+    num_channels, num_z, size_y, size_x = shape
+    arrays = []
+    for level in range(pyramid_levels + 1):
+        arrays.append(
+            group.create_array(
+                str(level),
+                shape=(num_channels, num_z, size_y, size_x),
+                chunks=(1, 1, min(chunk_size, size_y), min(chunk_size, size_x)),
+                dtype=dtype,
+                compressors=compressor,
+                fill_value=0,
+                chunk_key_encoding={"name": "v2", "separator": "/"},
+            )
+        )
+        size_y, size_x = (size_y + 1) // 2, (size_x + 1) // 2
+
+    for i, plane in enumerate(planes):
+        c, z = divmod(i, num_z)
+        for level, array in enumerate(arrays):
+            if level > 0:
+                plane = downsample(plane, pyramid_method)
+            array[c, z] = plane
+
+    attrs = get_ngff_metadata(
+        out_path.name,
+        channel_names,
+        get_physical_sizes_nm(ome_xml),
+        pyramid_levels,
+        np.dtype(dtype),
+    )
+    attrs.update(extra_attrs or {})
+    group.attrs.update(attrs)
@@ -0,0 +1,33 @@
+import numpy as np
+from channel_stats import ImageStats
+
+
+def make_planes(num_channels: int):
+    return [np.full((4, 4), 10 * (c + 1), dtype=np.uint16) for c in range(num_channels)]
+
+
+def test_non_contiguous_channel_ids():
+    img_stats = ImageStats([("DAPI", 0), ("CD45", 3), ("Ki67", 7)], "<u2")
+    for c, plane in enumerate(make_planes(3)):
+        img_stats.update(c, 0, plane)
+    stats = img_stats.to_dict()
+    assert [stats[name]["mean"] for name in ("DAPI", "CD45", "Ki67")] == [10, 20, 30]
+    assert all(stats[name]["count"] == 16 for name in stats)
+
+
+def test_channel_ids_not_starting_at_zero():
+    img_stats = ImageStats([("DAPI", 1), ("CD45", 2)], "<u2")
+    for c, plane in enumerate(make_planes(2)):
+        img_stats.update(c, 0, plane)
+    stats = img_stats.to_dict()
+    assert stats["DAPI"]["max"] == 10
+    assert stats["CD45"]["max"] == 20
+
+
+def test_planes_without_channel_are_skipped():
+    img_stats = ImageStats([("DAPI", 0), ("CD45", 1)], "<u2")
+    for c, plane in enumerate(make_planes(3)):
+        img_stats.update(c, 0, plane)
+    stats = img_stats.to_dict()
+    assert list(stats) == ["DAPI", "CD45"]
+    assert stats["CD45"]["max"] == 20
@@ -0,0 +1,57 @@
+import errno
+import os
+
+import file_transfer
+import pytest
+from file_transfer import transfer_file
+
+
+@pytest.fixture
+def src(tmp_path):
+    path = tmp_path / "src.ome.tiff"
+    path.write_bytes(os.urandom(100000))
+    return path
+
+
+@pytest.fixture
+def no_reflink(monkeypatch):
+    """Filesystem without reflink support, e.g. ext4"""
+
+    def ioctl(*args):
+        raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+
+    monkeypatch.setattr(file_transfer.fcntl, "ioctl", ioctl)
+
+
+def test_auto_hardlinks_without_reflink(src, no_reflink):
+    dst = src.parent / "dst.ome.tiff"
+    assert transfer_file(src, dst) == "hardlink"
+    assert os.path.samefile(src, dst)
+
+
+def test_reflink_fails_without_reflink(src, no_reflink):
+    dst = src.parent / "dst.ome.tiff"
+    with pytest.raises(OSError):
+        transfer_file(src, dst, "reflink")
+    assert not dst.exists()
+
+
+def test_auto_copies_without_reflink_and_hardlink(src, no_reflink, monkeypatch):
+    def link(*args):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    monkeypatch.setattr(file_transfer.os, "link", link)
+    dst = src.parent / "dst.ome.tiff"
+    assert transfer_file(src, dst) in ("copy_file_range", "copy")
+    assert dst.read_bytes() == src.read_bytes()
+    assert not os.path.samefile(src, dst)
+
+
+def test_copy_streams_without_copy_file_range(src, monkeypatch):
+    def copy_file_range(*args):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    monkeypatch.setattr(file_transfer.os, "copy_file_range", copy_file_range)
+    dst = src.parent / "dst.ome.tiff"
+    assert transfer_file(src, dst, "copy") == "copy"
+    assert dst.read_bytes() == src.read_bytes()